@@ -0,0 +1,49 @@
+#!/usr/bin/env node
+/*
+ * Long-lived Newman runner used by vng.utils.newman.NewmanRunner.
+ *
+ * Each line of stdin is a run:
+ *     {"id": ..., "collection": path, "globals": {name: value}, "html": path, "json": path, "timeoutRequest": ms}
+ * the collection is run with the htmlextra and json reporters exporting to
+ * the given paths, and a line is written on stdout when it completes:
+ *     {"id": ..., "error": null or message}
+ * The runs are independent, several of them can be in progress at once.
+ * The process ends once stdin is closed and the runs in progress are completed.
+ */
+'use strict';
+
+const readline = require('readline');
+const newman = require('newman');
+
+const results = process.stdout;
+// stdout carries the results, everything logged goes to stderr
+console.log = console.info = console.warn = console.error;
+
+function reply(id, error) {
+    results.write(JSON.stringify({id: id, error: error ? String(error.stack || error) : null}) + '\n');
+}
+
+readline.createInterface({input: process.stdin})
+    .on('line', (line) => {
+        let run;
+        try {
+            run = JSON.parse(line);
+        } catch (error) {
+            console.error('Invalid run: ' + line);
+            return;
+        }
+        try {
+            newman.run({
+                collection: run.collection,
+                globalVar: Object.keys(run.globals).map((key) => ({key: key, value: run.globals[key]})),
+                timeoutRequest: run.timeoutRequest,
+                reporters: ['htmlextra', 'json'],
+                reporter: {
+                    htmlextra: {export: run.html, darkTheme: true, testPaging: true, logs: true},
+                    json: {export: run.json},
+                },
+            }, (error) => reply(run.id, error));
+        } catch (error) {
+            reply(run.id, error);
+        }
+    });
@@ -0,0 +1,27 @@
+"""
+ASGI config for vng project.
+
+It exposes the ASGI callable as a module-level variable named ``application``.
+The calls to the exposed urls of the sessions are proxied natively on the
+event loop, all the other requests are served by the WSGI application in a
+thread pool. The proxied calls only go through the middleware listed in
+`vng.testsession.async_proxy.PROXY_MIDDLEWARE`. Run it with e.g.:
+
+    uvicorn --app-dir src vng.asgi:application
+
+For more information on this file, see
+https://asgi.readthedocs.io/en/latest/
+"""
+import os
+
+from dotenv import load_dotenv
+load_dotenv()
+
+from asgiref.wsgi import WsgiToAsgi
+from django.core.wsgi import get_wsgi_application
+
+wsgi_application = get_wsgi_application()
+
+from vng.testsession.async_proxy import ProxyRouter  # noqa: E402 the apps have to be loaded first
+
+application = ProxyRouter(WsgiToAsgi(wsgi_application))
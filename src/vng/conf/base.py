@@ -357,6 +357,76 @@ SHOW_ALERT = True
 
 RUN_KUBERNETES_CMD = False
 
+# Upstream connection pool used by the RunTest proxy (per process and per host)
+PROXY_POOL_CONNECTIONS = 10
+PROXY_POOL_MAXSIZE = 20
+PROXY_POOL_BLOCK = False
+PROXY_CONNECT_TIMEOUT = 5
+PROXY_READ_TIMEOUT = 60
+# Streaming mode of the proxy (see VNGEndpoint.streaming)
+PROXY_STREAM_CHUNK_SIZE = 64 * 1024
+PROXY_STREAM_LOG_PREFIX = 4096
+# Write-behind persistence of the proxied calls (SessionLog and Report)
+SESSION_LOG_WRITE_BEHIND = False
+SESSION_LOG_BATCH_SIZE = 100
+SESSION_LOG_FLUSH_INTERVAL = 1.0  # seconds
+# Redis shared by the processes queueing the calls, and the longest wait for the
+# process writing them (seconds)
+SESSION_LOG_QUEUE_URL = 'redis://127.0.0.1:6379/7'
+SESSION_LOG_LOCK_TIMEOUT = 60
+# Retries of the stop of a session while the queue is held by another process
+SESSION_LOG_STOP_RETRIES = 3
+
+# Reuse of the signed JWT credentials (seconds), the tokens only carry the issue time
+JWT_CACHE_TTL = 10 * 60
+JWT_CACHE_MARGIN = 30
+# Credentials cached by each process
+JWT_CACHE_SIZE = 1000
+
+# Lifetime of the cached badges (seconds), they are also invalidated when the results change
+BADGE_CACHE_TIMEOUT = 60 * 60
+# Kubernetes API used to deploy the sessions, without a server the service account
+# of the pod or the kubeconfig written by gcloud are used
+K8S_API_SERVER = None
+K8S_API_TOKEN = None
+K8S_API_CA_CERT = None
+K8S_NAMESPACE = 'default'
+K8S_API_TIMEOUT = 30
+# Cluster of the sessions, checked by the workers at most once per K8S_CLUSTER_CONTEXT_TTL seconds
+K8S_CLUSTER_ZONE = 'europe-west4-a'
+K8S_CLUSTER_PROJECT = 'vng-test-platform'
+K8S_CLUSTER_CONTEXT_TTL = 60 * 60
+# Deadlines of the deployment of a session (seconds)
+K8S_POD_READY_TIMEOUT = 5 * 60
+K8S_SERVICE_READY_TIMEOUT = 5 * 60
+K8S_MIGRATION_TIMEOUT = 10 * 60
+K8S_DB_SEED_TIMEOUT = 5 * 60
+# Longest blocking call of a wait of the deployment, a cancelled deployment stops waiting within it (seconds)
+K8S_WAIT_STOP_INTERVAL = 5
+# Threads running the independent steps of the deployment of a session
+K8S_DEPLOY_WORKERS = 8
+# Sessions whose objects are deleted with a single call to the API
+K8S_DELETE_BATCH_SIZE = 50
+# Collections of a server validation run by Newman at the same time
+NEWMAN_WORKERS = 4
+# Run the collections in a long-lived Node process (bin/newman_runner.js), else
+# with one run of the newman command line each
+NEWMAN_PERSISTENT_RUNNER = True
+NEWMAN_NODE = 'node'
+NEWMAN_RUNNER_SCRIPT = os.path.join(BASE_DIR, 'bin', 'newman_runner.js')
+# Seconds after which a run of the runner is given up
+NEWMAN_RUN_TIMEOUT = 30 * 60
+# Calls of a Newman report inserted at once while the report is read
+POSTMAN_CALL_BATCH_SIZE = 500
+# Scheduled server validations run at the same time against a host, the runs
+# waiting for a slot are retried after SERVER_RUN_HOST_RETRY_DELAY seconds
+SERVER_RUN_HOST_CONCURRENCY = 2
+SERVER_RUN_HOST_RETRY_DELAY = 60
+# Retries after which a run starts even if its hosts are still busy
+SERVER_RUN_HOST_MAX_RETRIES = 120
+# Seconds after which the slot of a run is released if its worker died
+SERVER_RUN_HOST_SLOT_TIMEOUT = 2 * 60 * 60
+
 #
 # Library settings
 #
@@ -404,6 +474,14 @@ CELERY_BEAT_SCHEDULE = {
         'task': 'vng.servervalidation.task.execute_test_scheduled',
         'schedule': crontab(hour=0, minute=0),
     },
+    'refill-warm-pools': {
+        'task': 'vng.testsession.task.refill_warm_pools',
+        'schedule': crontab(minute='*/5'),
+    },
+    'reconcile-sessions': {
+        'task': 'vng.testsession.task.reconcile_sessions',
+        'schedule': crontab(minute='*/30'),
+    },
 }
 
 # Elastic APM
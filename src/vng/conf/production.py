@@ -46,6 +46,8 @@ CACHES = {
 }
 
 CELERY_BROKER_URL = "redis://127.0.0.1:6379/5"
+# the scheduled server validations are aggregated with chords
+CELERY_RESULT_BACKEND = "redis://127.0.0.1:6379/6"
 # EMAIL_HOST = 'smtp.sendgrid.net'
 # EMAIL_HOST_USER = 'apikey'
 # EMAIL_HOST_PASSWORD = os.getenv('EMAIL_HOST_PASSWORD')
@@ -124,4 +126,6 @@ LOGGING['handlers'].update({
 
 RUN_KUBERNETES_CMD = True
 
+SESSION_LOG_WRITE_BEHIND = True
+
 SUBDOMAIN_SEPARATOR = '.'
@@ -79,6 +79,8 @@ LOGGING['loggers'].update({
 #
 
 CELERY_BROKER_URL = "redis://127.0.0.1:6379/13"
+# the scheduled server validations are aggregated with chords
+CELERY_RESULT_BACKEND = "redis://127.0.0.1:6379/12"
 # Show active environment in admin.
 ENVIRONMENT = 'staging'
 
@@ -93,6 +95,9 @@ SECURE_CONTENT_TYPE_NOSNIFF = True # Sets X-Content-Type-Options: nosniff
 SECURE_BROWSER_XSS_FILTER = True # Sets X-XSS-Protection: 1; mode=block
 
 
+SESSION_LOG_WRITE_BEHIND = True
+SESSION_LOG_QUEUE_URL = 'redis://127.0.0.1:6379/11'
+
 #
 # Library settings
 #
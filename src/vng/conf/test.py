@@ -78,6 +78,8 @@ LOGGING['loggers'].update({
 # Custom settings
 #
 CELERY_BROKER_URL = "redis://127.0.0.1:6379/14"
+# the scheduled server validations are aggregated with chords
+CELERY_RESULT_BACKEND = "redis://127.0.0.1:6379/15"
 # Show active environment in admin.
 ENVIRONMENT = 'test'
 
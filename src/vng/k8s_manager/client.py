@@ -0,0 +1,353 @@
+import atexit
+import base64
+import json
+import logging
+import os
+import tempfile
+import threading
+from contextlib import closing
+
+import requests
+import yaml
+
+from django.conf import settings
+
+from ..utils.commands import run_command, safeget
+
+logger = logging.getLogger(__name__)
+
+SERVICE_ACCOUNT_FOLDER = '/var/run/secrets/kubernetes.io/serviceaccount'
+
+PLURALS = {
+    'Ingress': 'ingresses',
+}
+
+_client = None
+_lock = threading.Lock()
+
+
+class KubernetesError(Exception):
+
+    def __init__(self, status, message):
+        super().__init__('{}: {}'.format(status, message))
+        self.status = status
+        self.message = message
+
+
+class Unauthorized(KubernetesError):
+    '''
+    The credentials were refused, even after the refresh of the access token
+    '''
+
+
+class NotFound(KubernetesError):
+    pass
+
+
+class Conflict(KubernetesError):
+    pass
+
+
+class Gone(KubernetesError):
+    '''
+    The resource version of a watch is too old, the objects have to be listed again
+    '''
+
+
+class DeadlineExceeded(KubernetesError):
+    pass
+
+
+def resource_path(api_version, kind, namespace, name=None):
+    '''
+    Return the path of the REST API of a resource, e.g.
+    ('v1', 'Pod', 'default') -> api/v1/namespaces/default/pods
+    '''
+    prefix = 'api' if '/' not in api_version else 'apis'
+    plural = PLURALS.get(kind, '{}s'.format(kind.lower()))
+    path = '{}/{}/namespaces/{}/{}'.format(prefix, api_version, namespace, plural)
+    if name is not None:
+        path = '{}/{}'.format(path, name)
+    return path
+
+
+def selectors(label_selector=None, field_selector=None):
+    params = {}
+    if label_selector:
+        params['labelSelector'] = label_selector
+    if field_selector:
+        params['fieldSelector'] = field_selector
+    return params
+
+
+def write_temp(content):
+    '''
+    Write the content of a kubeconfig `*-data` entry in a file, as requests
+    only accepts certificates as paths. The file is removed with the client.
+    '''
+    handle, path = tempfile.mkstemp(prefix='k8s-')
+    with os.fdopen(handle, 'wb') as out_file:
+        out_file.write(base64.b64decode(content))
+    return path
+
+
+class KubernetesClient:
+    '''
+    Client of the Kubernetes REST API over a single authenticated session,
+    so the connection to the API server is reused by all the calls.
+    '''
+
+    def __init__(self, server, token=None, verify=True, cert=None, namespace='default', token_refresh=None,
+                 temp_files=()):
+        self.server = server.rstrip('/')
+        self.namespace = namespace
+        self.timeout = settings.K8S_API_TIMEOUT
+        self.token_refresh = token_refresh
+        # certificates and keys written by the client, removed by `close`
+        self.temp_files = list(temp_files)
+        self.session = requests.Session()
+        self.session.verify = verify
+        self.session.cert = cert
+        if token is not None:
+            self.set_token(token)
+
+    @classmethod
+    def from_settings(cls):
+        '''
+        Build the client from the K8S_API_* settings, from the service account
+        when running in a pod, or else from the kubeconfig written by
+        `gcloud container clusters get-credentials`.
+        '''
+        if settings.K8S_API_SERVER:
+            return cls(
+                settings.K8S_API_SERVER,
+                token=settings.K8S_API_TOKEN,
+                verify=settings.K8S_API_CA_CERT or True,
+                namespace=settings.K8S_NAMESPACE
+            )
+        token_file = os.path.join(SERVICE_ACCOUNT_FOLDER, 'token')
+        if os.getenv('KUBERNETES_SERVICE_HOST') and os.path.exists(token_file):
+            with open(token_file) as in_file:
+                token = in_file.read().strip()
+            return cls(
+                'https://{}:{}'.format(os.environ['KUBERNETES_SERVICE_HOST'], os.getenv('KUBERNETES_SERVICE_PORT', '443')),
+                token=token,
+                verify=os.path.join(SERVICE_ACCOUNT_FOLDER, 'ca.crt'),
+                namespace=settings.K8S_NAMESPACE
+            )
+        return cls.from_kubeconfig(os.getenv('KUBECONFIG', os.path.expanduser('~/.kube/config')))
+
+    @classmethod
+    def from_kubeconfig(cls, path):
+        with open(path) as in_file:
+            config = yaml.safe_load(in_file)
+
+        def named(section, name):
+            for entry in config.get(section) or []:
+                if entry['name'] == name:
+                    return entry[section[:-1]]
+            raise KubernetesError(None, '{} {} not found in {}'.format(section[:-1], name, path))
+
+        context = named('contexts', config['current-context'])
+        cluster = named('clusters', context['cluster'])
+        user = named('users', context['user'])
+
+        temp_files = []
+        verify = True
+        if cluster.get('insecure-skip-tls-verify'):
+            verify = False
+        elif cluster.get('certificate-authority-data'):
+            verify = write_temp(cluster['certificate-authority-data'])
+            temp_files.append(verify)
+        elif cluster.get('certificate-authority'):
+            verify = cluster['certificate-authority']
+
+        cert = None
+        if user.get('client-certificate-data'):
+            cert = (write_temp(user['client-certificate-data']), write_temp(user['client-key-data']))
+            temp_files.extend(cert)
+        elif user.get('client-certificate'):
+            cert = (user['client-certificate'], user['client-key'])
+
+        token = user.get('token')
+        token_refresh = None
+        provider = safeget(user, 'auth-provider', 'config') or {}
+        if provider.get('cmd-path'):
+            # gcloud credentials: the access token expires, it is refreshed with its helper command
+            token = provider.get('access-token')
+            token_refresh = [provider['cmd-path'], *provider.get('cmd-args', '').split()]
+
+        return cls(
+            cluster['server'], token=token, verify=verify, cert=cert,
+            namespace=context.get('namespace', settings.K8S_NAMESPACE), token_refresh=token_refresh,
+            temp_files=temp_files
+        )
+
+    def close(self):
+        '''
+        Close the connections and remove the certificates written for the client
+        '''
+        self.session.close()
+        while self.temp_files:
+            try:
+                os.remove(self.temp_files.pop())
+            except OSError:
+                pass
+
+    def set_token(self, token):
+        self.session.headers['Authorization'] = 'Bearer {}'.format(token)
+
+    def refresh_token(self):
+        '''
+        Ask a new access token to the credential helper of the kubeconfig
+        '''
+        if self.token_refresh is None:
+            return False
+        output = json.loads(run_command(self.token_refresh).decode('utf-8'))
+        self.set_token(output['credential']['access_token'])
+        return True
+
+    def request(self, method, path, raw=False, **kwargs):
+        url = '{}/{}'.format(self.server, path)
+        kwargs.setdefault('timeout', self.timeout)
+        response = self.session.request(method, url, **kwargs)
+        if response.status_code == 401 and self.refresh_token():
+            response = self.session.request(method, url, **kwargs)
+        if response.status_code >= 400:
+            try:
+                message = response.json().get('message', response.text)
+            except ValueError:
+                message = response.text
+            error = {401: Unauthorized, 404: NotFound, 409: Conflict, 410: Gone}.get(response.status_code, KubernetesError)
+            raise error(response.status_code, message)
+        if raw:
+            return response
+        return response.json()
+
+    def path(self, api_version, kind, name=None):
+        return resource_path(api_version, kind, self.namespace, name)
+
+    def create(self, manifest):
+        return self.request('POST', self.path(manifest['apiVersion'], manifest['kind']), json=manifest)
+
+    def apply(self, manifest):
+        '''
+        Create the object of the manifest, or update the existing one
+        '''
+        try:
+            return self.create(manifest)
+        except Conflict:
+            return self.request(
+                'PATCH', self.path(manifest['apiVersion'], manifest['kind'], manifest['metadata']['name']),
+                data=json.dumps(manifest), headers={'Content-Type': 'application/strategic-merge-patch+json'}
+            )
+
+    def patch(self, api_version, kind, name, patch):
+        '''
+        Merge the patch into the object
+        '''
+        return self.request(
+            'PATCH', self.path(api_version, kind, name),
+            data=json.dumps(patch), headers={'Content-Type': 'application/merge-patch+json'}
+        )
+
+    def list(self, api_version, kind, label_selector=None, field_selector=None):
+        return self.list_versioned(api_version, kind, label_selector, field_selector)[0]
+
+    def list_versioned(self, api_version, kind, label_selector=None, field_selector=None):
+        '''
+        Return the objects and the resource version of the list, to watch the
+        changes happening after it
+        '''
+        content = self.request('GET', self.path(api_version, kind), params=selectors(label_selector, field_selector))
+        return content.get('items') or [], safeget(content, 'metadata', 'resourceVersion')
+
+    def watch(self, api_version, kind, label_selector=None, field_selector=None, resource_version=None, timeout=60):
+        '''
+        Yield the (type, object) events of the changes of the selected objects,
+        until the server ends the watch after `timeout` seconds
+        '''
+        params = selectors(label_selector, field_selector)
+        params.update(watch='true', timeoutSeconds=max(1, int(timeout)))
+        if resource_version:
+            params['resourceVersion'] = resource_version
+        response = self.request(
+            'GET', self.path(api_version, kind), raw=True, stream=True, params=params,
+            timeout=(self.timeout, timeout + self.timeout)
+        )
+        with closing(response):
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                event = json.loads(line.decode('utf-8'))
+                if event['type'] == 'ERROR':
+                    status = safeget(event, 'object', 'code')
+                    error = Gone if status == 410 else KubernetesError
+                    raise error(status, safeget(event, 'object', 'message'))
+                yield event['type'], event['object']
+
+    def get(self, api_version, kind, name):
+        return self.request('GET', self.path(api_version, kind, name))
+
+    def delete(self, api_version, kind, name):
+        return self.request(
+            'DELETE', self.path(api_version, kind, name),
+            json={'kind': 'DeleteOptions', 'apiVersion': 'v1', 'propagationPolicy': 'Background'}
+        )
+
+    def delete_collection(self, api_version, kind, label_selector=None, field_selector=None):
+        '''
+        Delete all the selected objects in one call, not supported by the services
+        '''
+        return self.request(
+            'DELETE', self.path(api_version, kind), params=selectors(label_selector, field_selector),
+            json={'kind': 'DeleteOptions', 'apiVersion': 'v1', 'propagationPolicy': 'Background'}
+        )
+
+    def log(self, pod_name, container=None):
+        params = {'container': container} if container else {}
+        return self.request('GET', '{}/log'.format(self.path('v1', 'Pod', pod_name)), raw=True, params=params).text
+
+    def follow_log(self, pod_name, container=None, timeout=60):
+        '''
+        Yield the lines of the log of the container as they are written, the
+        stream is dropped when no line comes within `timeout` seconds
+        '''
+        params = {'follow': 'true'}
+        if container:
+            params['container'] = container
+        response = self.request(
+            'GET', '{}/log'.format(self.path('v1', 'Pod', pod_name)), raw=True, stream=True, params=params,
+            timeout=(self.timeout, timeout)
+        )
+        with closing(response):
+            for line in response.iter_lines():
+                yield line.decode('utf-8', 'replace')
+
+
+def get_client():
+    '''
+    Return the client shared by the current process
+    '''
+    global _client
+    if _client is None:
+        with _lock:
+            if _client is None:
+                _client = KubernetesClient.from_settings()
+    return _client
+
+
+def reset_client():
+    '''
+    Drop the client of the current process, the next one is built from the
+    current settings
+    '''
+    global _client
+    with _lock:
+        client, _client = _client, None
+    if client is not None:
+        client.close()
+
+
+# the certificates written in the temporary folder do not outlive the process
+atexit.register(reset_client)
@@ -0,0 +1,75 @@
+import logging
+import threading
+import time
+
+from django.conf import settings
+
+from .client import reset_client
+from ..utils.commands import run_command
+
+logger = logging.getLogger(__name__)
+
+_contexts = {}
+_lock = threading.Lock()
+
+
+class ClusterContext:
+    '''
+    Bootstrap of a cluster shared by the process: the existence of the
+    cluster and the credentials of kubectl are checked once, and reused for
+    `K8S_CLUSTER_CONTEXT_TTL` seconds or until an explicit refresh.
+    '''
+
+    def __init__(self, cluster):
+        self.cluster = cluster
+        self.checked = None
+        self.lock = threading.Lock()
+
+    def gcloud(self, *args):
+        return run_command([
+            'gcloud', 'container', 'clusters', *args, self.cluster,
+            '--zone', settings.K8S_CLUSTER_ZONE, '--project', settings.K8S_CLUSTER_PROJECT,
+        ]) or b''
+
+    def is_fresh(self):
+        return self.checked is not None and time.monotonic() - self.checked < settings.K8S_CLUSTER_CONTEXT_TTL
+
+    def bootstrap(self):
+        # the cluster is only created when it does not exist yet
+        if not self.gcloud('describe', '--format=value(status)').strip():
+            logger.info('Creating the cluster %s', self.cluster)
+            self.gcloud('create', '--num-nodes=1')
+        # the credentials of kubectl and of the client of the API
+        self.gcloud('get-credentials')
+        reset_client()
+
+    def ensure(self):
+        if self.is_fresh():
+            return
+        with self.lock:
+            if not self.is_fresh():
+                self.bootstrap()
+                self.checked = time.monotonic()
+
+    def refresh(self):
+        '''
+        Check the cluster and fetch the credentials again, after an authentication error
+        '''
+        with self.lock:
+            self.checked = None
+        self.ensure()
+
+
+def get_context(cluster):
+    '''
+    Return the context of the cluster shared by the current process
+    '''
+    with _lock:
+        if cluster not in _contexts:
+            _contexts[cluster] = ClusterContext(cluster)
+        return _contexts[cluster]
+
+
+def reset_contexts():
+    with _lock:
+        _contexts.clear()
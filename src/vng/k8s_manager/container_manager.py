@@ -1,17 +1,84 @@
-import json
-import yaml
-import uuid
 import os
+import time
 
+import requests
+
+from django.conf import settings
+
+from .client import DeadlineExceeded, KubernetesError, NotFound, Unauthorized, get_client
+from .cluster import get_context
 from .kubernetes import *
 from ..utils.commands import run_command, safeget
 
+# resource name of kubectl -> api version and kind of the objects
+RESOURCES = {
+    'pods': ('v1', 'Pod'),
+    'services': ('v1', 'Service'),
+    'configmaps': ('v1', 'ConfigMap'),
+    'deployments': ('extensions/v1beta1', 'Deployment'),
+    'ingresses': ('extensions/v1beta1', 'Ingress'),
+}
+
+
+def delete_session_objects(session_names, services=()):
+    '''
+    Delete the deployments and the ConfigMaps of the sessions with one call
+    per batch of sessions, and the given services one by one as they can not
+    be deleted by collection
+    '''
+    client = get_client()
+    names = sorted(session_names)
+    size = settings.K8S_DELETE_BATCH_SIZE
+    for i in range(0, len(names), size):
+        selector = '{} in ({})'.format(SESSION_LABEL, ','.join(names[i:i + size]))
+        for resource in ('deployments', 'configmaps'):
+            client.delete_collection(*RESOURCES[resource], label_selector=selector)
+    for item in services:
+        try:
+            client.delete(*RESOURCES['services'], item['metadata']['name'])
+        except NotFound:
+            pass
+
+
+def legacy_session(name, session_names):
+    '''
+    Return the session of an object deployed before the session label, from
+    its name: the objects of a session are named after it, or after its database
+    '''
+    for session in session_names:
+        for prefix in (session, 'db-{}'.format(session)):
+            if name == prefix or name.startswith(prefix + '-'):
+                return session
+    return None
+
+
+def label_legacy_objects(session_names):
+    '''
+    Add the session label to the objects of the given sessions deployed before
+    the label existed, so they are selected like the others. Return the names
+    of the labelled objects.
+    '''
+    client = get_client()
+    labelled = []
+    for resource in ('deployments', 'services', 'configmaps'):
+        api_version, kind = RESOURCES[resource]
+        for item in client.list(api_version, kind, label_selector='!{}'.format(SESSION_LABEL)):
+            name = item['metadata']['name']
+            session = legacy_session(name, session_names)
+            if session is not None:
+                client.patch(api_version, kind, name, {'metadata': {'labels': {SESSION_LABEL: session}}})
+                labelled.append(name)
+    return labelled
+
 
 class K8S():
 
-    def __init__(self, cluster='test-sessions', app_name=None):
+    def __init__(self, cluster='test-sessions', app_name=None, session_name=None):
         self.initialized = False
         self.cluster = cluster
+        # the objects of the application are selected by their app label, all
+        # the objects of its session by the session label
+        self.session_name = session_name or app_name
         self.db_deployed = False
         self.db_to_deploy = False
         self.app_name = app_name
@@ -26,151 +93,188 @@ class K8S():
             os.remove(gfile)
 
     def initialize(self):
-        if self.initialized:
-            return
-        set_zone = [
-            'gcloud',
-            'config',
-            'set',
-            'compute/zone',
-            'europe-west4-a'
-        ]
-        set_project = [
-            'gcloud',
-            'config',
-            'set',
-            'core/project',
-            'vng-test-platform'
-        ]
-        create_cluster = [
-            'gcloud',
-            'container',
-            'clusters',
-            'create',
-            self.cluster,
-            '--num-nodes=1',
-        ]
-        get_credentials = [
-            'gcloud',
-            'container',
-            'clusters',
-            'get-credentials',
-            self.cluster,
-        ]
-        run_command(set_zone)
-        run_command(set_project)
-        # Create a general cluster (will error if it already exists)
-        run_command(create_cluster)
-        # Get the credentials to use kubectl for the correct cluster
-        run_command(get_credentials)
-
+        get_context(self.cluster).ensure()
         self.initialized = True
 
-    def fetch_resource(self, resource):
-        fetch = [
-            'kubectl',
-            'get',
-            resource,
-            '--output=json'
-        ]
-        res = run_command(fetch).decode('utf-8')
-        return json.loads(res)
+    def refresh(self):
+        '''
+        Fetch the credentials of the cluster again after an authentication error
+        '''
+        get_context(self.cluster).refresh()
 
-    def delete(self):
-        clean_up = [
-            'kubectl',
-            'delete',
-            'deployment'
-        ]
-        deployments = self.fetch_resource('deployments')
-        for item in deployments['items']:
-            if safeget(item, 'metadata', 'name'):
-                name = item['metadata']['name']
-                if self.app_name in name:
-                    # Delete the workload
-                    run_command([*clean_up, name])
+    @property
+    def client(self):
+        return get_client()
+
+    def selector(self):
+        return 'app={}'.format(self.app_name)
+
+    def session_selector(self):
+        return '{}={}'.format(SESSION_LABEL, self.session_name)
 
-        # TODO: remove unused resources, remember that Kubernetes has a Garbage Collector integrated
-        # svc still used
+    def fetch_resource(self, resource, label_selector=None, field_selector=None):
+        api_version, kind = RESOURCES[resource]
+        return {'items': self.client.list(api_version, kind, label_selector, field_selector)}
+
+    def app_items(self, resource, field_selector=None):
+        '''
+        Return the objects of the resource belonging to the application
+        '''
+        return self.fetch_resource(resource, self.selector(), field_selector)['items']
+
+    def not_found(self):
+        return Exception('Application {} not found in the deployed cluster'.format(self.app_name))
+
+    def delete(self):
+        '''
+        Delete the deployments, the services and the ConfigMaps of the session
+        '''
+        services = self.fetch_resource('services', self.session_selector())['items']
+        delete_session_objects([self.session_name], services)
 
     def get_pod_log(self, c_name):
         if not self.pod_name:
             self.make_aware()
-        log_command = [
-            'kubectl',
-            'logs',
-            self.pod_name,
-            '-c',
-            c_name,
-        ]
         try:
-            res = run_command(log_command).decode('utf-8')
-            return res
-        except:
-            raise Exception('Application {} not found in the deployed cluster'.format(self.app_name))
+            return self.client.log(self.pod_name, c_name)
+        except KubernetesError:
+            raise self.not_found()
 
     def get_pod_status(self):
-        status_command = [
-            'kubectl',
-            'get',
-            'pods',
-            '--output=json'
-        ]
-        res1 = run_command(status_command).decode('utf-8')
-        pods = json.loads(res1)
-        items = pods.get('items')
-        for item in items:
-            metadata = item.get('metadata')
-            if metadata and metadata.get('name').startswith(self.app_name):
-                return item
-        raise Exception('Application {} not found in the deployed cluster'.format(self.app_name))
+        for item in self.app_items('pods'):
+            return item
+        raise self.not_found()
 
     def get_pod_status_deployment(self):
-        status_command = [
-            'kubectl',
-            'get',
-            'pods',
-            '-o',
-            'wide',
-            '--output=json'
-        ]
-        res1 = run_command(status_command).decode('utf-8')
-        pods = json.loads(res1)
-        items = pods.get('items')
-        for item in items:
-            metadata = item.get('metadata')
-            if metadata and metadata.get('name').startswith(self.app_name):
+        for item in self.app_items('pods'):
+            if item.get('status').get('phase') == 'Pending':
                 status = item.get('status').get('containerStatuses')[0]
-                if item.get('status').get('phase') == 'Pending':
-                    return False, status.get('state').get('waiting').get('message')
-                elif item.get('status').get('phase') == 'Running':
-                    return True, None
-        raise Exception('Application {} not found in the deployed cluster'.format(self.app_name))
+                return False, status.get('state').get('waiting').get('message')
+            elif item.get('status').get('phase') == 'Running':
+                return True, None
+        raise self.not_found()
 
     def service_status(self):
-        status_command = [
-            'kubectl',
-            'get',
-            'service',
-            '--output=json'
-        ]
-        res1 = run_command(status_command).decode('utf-8')
-        services = json.loads(res1)
-        items = services.get('items')
-        for item in items:
-            metadata = item.get('metadata')
-            if metadata and metadata.get('name').startswith(self.app_name):
-                ip_list = item.get('status').get('loadBalancer').get('ingress')
-                if ip_list:
-                    return ip_list[0].get('ip')
-                return None
-        raise Exception('Application {} not found in the deployed cluster'.format(self.app_name))
+        for item in self.app_items('services'):
+            ip_list = item.get('status').get('loadBalancer').get('ingress')
+            if ip_list:
+                return ip_list[0].get('ip')
+            return None
+        raise self.not_found()
+
+    def wait_for(self, resource, condition, timeout, field_selector=None, stop=None):
+        '''
+        Return the first object of the application satisfying the condition,
+        watching the changes of its objects for at most `timeout` seconds or
+        until the `stop` event is set
+        '''
+        api_version, kind = RESOURCES[resource]
+        deadline = time.monotonic() + timeout
+        while True:
+            self.check_stopped(stop, resource)
+            try:
+                items, version = self.client.list_versioned(api_version, kind, self.selector(), field_selector)
+            except Unauthorized:
+                # the refreshed credentials may still be refused
+                self.refresh()
+                self.pause(deadline, stop)
+                if time.monotonic() >= deadline:
+                    break
+                continue
+            for item in items:
+                if condition(item):
+                    return item
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                for event, item in self.client.watch(
+                        api_version, kind, self.selector(), field_selector, resource_version=version,
+                        timeout=self.wait_interval(remaining, stop)):
+                    if event != 'DELETED' and condition(item):
+                        return item
+                    if time.monotonic() >= deadline:
+                        break
+            except Unauthorized:
+                self.refresh()
+                self.pause(deadline, stop)
+            except (KubernetesError, requests.RequestException):
+                # expired, failed or dropped watch, start again from a new list
+                pass
+            if time.monotonic() >= deadline:
+                break
+        raise DeadlineExceeded(None, '{} of {} not ready after {}s'.format(resource, self.app_name, timeout))
+
+    def wait_pod_running(self, timeout):
+        return self.wait_for(
+            'pods', lambda item: safeget(item, 'status', 'podIP'), timeout, field_selector='status.phase=Running'
+        )
+
+    def wait_service_ip(self, timeout, stop=None):
+        service = self.wait_for(
+            'services', lambda item: safeget(item, 'status', 'loadBalancer', 'ingress'), timeout, stop=stop
+        )
+        return service['status']['loadBalancer']['ingress'][0].get('ip')
+
+    def wait_log(self, c_name, text, timeout, stop=None):
+        '''
+        Follow the log of the container until a line containing the text is
+        written, for at most `timeout` seconds or until the `stop` event is set
+        '''
+        deadline = time.monotonic() + timeout
+        if not self.pod_name:
+            self.make_aware()
+        while True:
+            self.check_stopped(stop, c_name)
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                for line in self.client.follow_log(self.pod_name, c_name, timeout=self.wait_interval(remaining, stop)):
+                    if text in line:
+                        return
+                    if time.monotonic() >= deadline:
+                        break
+            except Unauthorized:
+                self.refresh()
+            except (KubernetesError, requests.RequestException):
+                # the container is not started yet or the stream was dropped
+                pass
+            self.pause(deadline, stop)
+        raise DeadlineExceeded(None, '{} of {} not ready after {}s'.format(c_name, self.app_name, timeout))
+
+    @staticmethod
+    def pause(deadline, stop):
+        '''
+        Wait a second before calling the API again, at most until the deadline
+        or the `stop` event
+        '''
+        delay = min(1, max(0, deadline - time.monotonic()))
+        if stop is not None:
+            stop.wait(delay)
+        else:
+            time.sleep(delay)
+
+    def check_stopped(self, stop, name):
+        if stop is not None and stop.is_set():
+            raise DeadlineExceeded(None, 'wait for {} of {} stopped'.format(name, self.app_name))
+
+    @staticmethod
+    def wait_interval(remaining, stop):
+        '''
+        Duration of a blocking call to the API, shortened when the wait can be
+        stopped so the event is checked regularly
+        '''
+        if stop is None:
+            return remaining
+        return min(remaining, settings.K8S_WAIT_STOP_INTERVAL)
 
     def make_aware(self):
         status = self.get_pod_status()
         self.pod_name = status['metadata']['name']
         self.deployment = status['metadata']['ownerReferences'][0]['name']
 
+    # exec and cp need a streamed connection to the pod, they keep using kubectl
     def exec(self, commands):
         self.make_aware()
         exec_command = [
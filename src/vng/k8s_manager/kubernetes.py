@@ -1,10 +1,10 @@
-import uuid
 import yaml
-import os
 import random
-from django.conf import settings
 
-from ..utils.commands import run_command
+from .client import get_client
+
+# label of all the objects deployed for a session, its value is the name of the session
+SESSION_LABEL = 'session'
 
 
 class AutoAssigner(object):
@@ -16,36 +16,79 @@ class AutoAssigner(object):
 
 class KubernetesObject(AutoAssigner):
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.create_config = [
-            'kubectl',
-            'create',
-            '-f'
-        ]
+    session = None
+
+    def get_labels(self, **labels):
+        if self.session:
+            labels[SESSION_LABEL] = self.session
+        return labels
 
     def requirements(self):
-        pass
+        '''
+        Return the objects to create along with this one
+        '''
+        return []
+
+    def render(self):
+        '''
+        Return the manifests of the object and of its requirements, without calling the API
+        '''
+        manifests = []
+        for requirement in self.requirements():
+            manifests += requirement.render()
+        manifests.append(self.get_content())
+        return manifests
 
     def execute(self):
-        self.requirements()
-        filename = str(uuid.uuid4())
-        self.dump(filename)
-        self.create_config.append(filename)
-        run_command(self.create_config)
-        if not settings.DEBUG:
-            os.remove(filename)
+        Manifest([self]).apply()
         return self
 
     def dump(self, filename):
-        content = self.get_content()
         with open(filename, 'w') as out_file:
-            out_file.write(yaml.dump(content))
+            out_file.write(Manifest([self]).dump())
+
+
+class Manifest:
+    '''
+    Multi-document manifest of objects, rendered in memory and applied in a
+    single pass over the connection of the client
+    '''
+
+    def __init__(self, objects=()):
+        self.objects = list(objects)
+
+    def add(self, obj):
+        self.objects.append(obj)
+        return obj
+
+    def render(self):
+        manifests = []
+        rendered = set()
+        for obj in self.objects:
+            for manifest in obj.render():
+                key = (manifest['kind'], manifest['metadata']['name'])
+                if key not in rendered:
+                    rendered.add(key)
+                    manifests.append(manifest)
+        return manifests
+
+    def dump(self):
+        return yaml.safe_dump_all(self.render(), default_flow_style=False)
+
+    def apply(self, dry_run=False):
+        '''
+        Create or update the objects, with `dry_run` only return their manifests
+        '''
+        manifests = self.render()
+        if dry_run:
+            return manifests
+        client = get_client()
+        return [client.apply(manifest) for manifest in manifests]
 
 
 class Ingress(KubernetesObject):
     '''
-    name, paths
+    name, paths, session (optional)
     paths: [{
         'path': '/api',
         'serviceName': 'serviceName'
@@ -56,25 +99,6 @@ class Ingress(KubernetesObject):
     apiVersion = 'extensions/v1beta1'
     kind = 'Ingress'
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.apply_config = [
-            'kubectl',
-            'apply',
-            '-f'
-        ]
-
-    def execute(self):
-        # TODO: use differnet commands
-        self.requirements()
-        filename = str(uuid.uuid4())
-        self.dump(filename)
-        self.create_config.append(filename)
-        res = run_command(self.create_config)
-        if not settings.DEBUG:
-            os.remove(filename)
-        return self
-
     def get_content(self):
         _paths = []
         for p in self.paths:
@@ -91,6 +115,7 @@ class Ingress(KubernetesObject):
             'kind': self.kind,
             'metadata': {
                 'name': self.name,
+                'labels': self.get_labels(),
             },
             'spec': {
                 'rules': [{
@@ -111,23 +136,31 @@ class Container(AutoAssigner):
         super().__init__(*args, **kwargs)
         self.cpu_limit = '0.1'
 
-    def exec_config(self):
+    def configure(self):
+        '''
+        Return the ConfigMaps of the container, built once so their names stay
+        the same when the deployment is rendered again
+        '''
+        if hasattr(self, 'config_maps'):
+            return self.config_maps
+        self.config_maps = []
         if len(self.variables) != 0:
-            cm = ConfigMap(
+            self.configMap = ConfigMap(
                 name='{}-configmap-{}'.format(self.name, random.randint(0, 1000)),
                 labels=self.name,
+                session=getattr(self, 'session', None),
                 container=self
             )
-            cm.execute()
-            self.configMap = cm
+            self.config_maps.append(self.configMap)
         if hasattr(self, 'data'):
-            data = ConfigMapData(
+            self.configMap_data = ConfigMapData(
                 name='{}-configmap-data-{}'.format(self.name, random.randint(0, 1000)),
                 labels=self.name,
+                session=getattr(self, 'session', None),
                 container=self
             )
-            data.execute()
-            self.configMap_data = data
+            self.config_maps.append(self.configMap_data)
+        return self.config_maps
 
     def get_content(self):
         base = {
@@ -160,8 +193,6 @@ class Container(AutoAssigner):
             }]
         if hasattr(self, 'command'):
             base['command'] = self.command
-        if hasattr(self, 'command'):
-            base['command'] = self.command
         return base
 
     def get_init_content(self):
@@ -176,7 +207,7 @@ class Container(AutoAssigner):
 
 class Service(KubernetesObject):
     '''
-    name, app, containers
+    name, app, containers, session (optional)
     '''
 
     apiVersion = 'v1'
@@ -188,9 +219,7 @@ class Service(KubernetesObject):
             'kind': self.kind,
             'metadata': {
                 'name': self.name,
-                'labels': {
-                    'app': self.app
-                }
+                'labels': self.get_labels(app=self.app)
             },
             'spec': {
                 'selector': {
@@ -262,44 +291,38 @@ class LoadBalancer(Service):
 
 class Deployment(KubernetesObject):
     '''
-    name, labels, containers
+    name, labels, containers, session (optional)
     '''
 
     kind = 'Deployment'
     apiVersion = 'extensions/v1beta1'
 
     def requirements(self):
+        config_maps = []
         for c in self.containers:
-            c.exec_config()
-
-        to_service = [c for c in self.containers if c.public_port and c.private_port]
-
-        if len(to_service) != 0:
-            NodePort(
-                name='{}-nodePort'.format(self.name),
-                app=self.name,
-                containers=to_service
-            )
+            c.session = self.session
+            config_maps += c.configure()
+        return config_maps
 
     def get_content(self):
+        init_containers = [c.get_init_content() for c in self.containers]
         res = {
             'apiVersion': self.apiVersion,
             'kind': self.kind,
             'metadata': {
                 'name': self.name,
+                'labels': self.get_labels(app=self.labels),
             },
             'spec': {
                 'replicas': 1,
                 'template': {
                     'metadata': {
                         'name': self.name,
-                        'labels': {
-                            'app': self.labels
-                        }
+                        'labels': self.get_labels(app=self.labels)
                     },
                     'spec': {
                         'containers': [c.get_content() for c in self.containers],
-                        'initContainers': [c.get_init_content() for c in self.containers if c.get_init_content() is not None]
+                        'initContainers': [c for c in init_containers if c is not None]
                     }
                 }
             }
@@ -311,7 +334,7 @@ class Deployment(KubernetesObject):
 
 class ConfigMap(KubernetesObject):
     '''
-    name, labels, container
+    name, labels, container, session (optional)
     '''
     apiVersion = 'v1'
     kind = 'ConfigMap'
@@ -324,9 +347,7 @@ class ConfigMap(KubernetesObject):
             'kind': self.kind,
             'metadata': {
                 'name': name,
-                'labels': {
-                    'app': self.labels
-                }
+                'labels': self.get_labels(app=self.labels)
             },
         }
         if hasattr(self.container, 'variables') and len(self.container.variables) != 0:
@@ -357,9 +378,7 @@ class ConfigMapData(ConfigMap):
             'kind': self.kind,
             'metadata': {
                 'name': name,
-                'labels': {
-                    'app': self.labels
-                }
+                'labels': self.get_labels(app=self.labels)
             },
         }
         if hasattr(self.container, 'data') and len(self.container.data) != 0:
@@ -1,3 +1,709 @@
-from django.test import TestCase
+import base64
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlparse
 
-# Create your tests here.
+import mock
+import yaml
+
+from django.test import SimpleTestCase, override_settings
+
+from .client import (
+    Conflict, DeadlineExceeded, KubernetesClient, KubernetesError, NotFound, get_client, reset_client
+)
+from .cluster import get_context, reset_contexts
+from .container_manager import K8S, delete_session_objects, label_legacy_objects
+from .kubernetes import Container, Deployment, LoadBalancer, Manifest
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def match_selector(item, selector, getter):
+    # the commas of the values of a set requirement do not separate the requirements
+    for requirement in filter(None, re.split(r',(?![^(]*\))', selector)):
+        if ' in (' in requirement:
+            key, values = requirement[:-1].split(' in (')
+            if getter(item, key) not in values.split(','):
+                return False
+            continue
+        if requirement.startswith('!'):
+            if getter(item, requirement[1:]) is not None:
+                return False
+            continue
+        if '=' not in requirement:
+            if getter(item, requirement) is None:
+                return False
+            continue
+        key, value = requirement.split('=', 1)
+        if getter(item, key) != value:
+            return False
+    return True
+
+
+def get_label(item, key):
+    return (item['metadata'].get('labels') or {}).get(key)
+
+
+def get_field(item, key):
+    value = item
+    for part in key.split('.'):
+        value = (value or {}).get(part)
+    return value
+
+
+def merge(item, patch):
+    for key, value in patch.items():
+        if isinstance(value, dict) and isinstance(item.get(key), dict):
+            merge(item[key], value)
+        else:
+            item[key] = value
+
+
+def match(item, query):
+    return (
+        match_selector(item, query.get('labelSelector', ''), get_label) and
+        match_selector(item, query.get('fieldSelector', ''), get_field)
+    )
+
+
+class FakeApiHandler(BaseHTTPRequestHandler):
+    '''
+    Minimal Kubernetes API: namespaced objects stored in memory by plural and
+    name, with the selectors and the watches of the list calls and the
+    (followed) logs of the pods
+    '''
+    protocol_version = 'HTTP/1.1'
+
+    def parse(self):
+        url = urlparse(self.path)
+        parts = url.path.strip('/').split('/')
+        # api/v1/namespaces/<ns>/<plural>/... or apis/<group>/<version>/namespaces/<ns>/<plural>/...
+        parts = parts[parts.index('namespaces') + 2:]
+        plural = parts[0]
+        name = parts[1] if len(parts) > 1 else None
+        sub = parts[2] if len(parts) > 2 else None
+        return plural, name, sub, {k: v[0] for k, v in parse_qs(url.query).items()}
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return json.loads(self.rfile.read(length).decode('utf-8')) if length else {}
+
+    def reply(self, status, content):
+        body = content if isinstance(content, bytes) else json.dumps(content).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def start_stream(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+    def write_chunk(self, data):
+        self.wfile.write('{:x}\r\n'.format(len(data)).encode('ascii') + data + b'\r\n')
+        self.wfile.flush()
+
+    def stream(self, read, timeout):
+        '''
+        Send the chunks returned by read(position) as they come, until the timeout
+        '''
+        self.start_stream()
+        deadline = time.monotonic() + timeout
+        position = 0
+        with self.server.changed:
+            while time.monotonic() < deadline and not self.server.stopped:
+                position, data = read(position)
+                if data:
+                    self.write_chunk(data)
+                else:
+                    self.server.changed.wait(0.05)
+        self.write_chunk(b'')
+
+    def watch(self, plural, query):
+        version = int(query.get('resourceVersion') or 0)
+
+        def read(position):
+            events = [
+                event for event in self.server.events[max(position, version):]
+                if event[0] == plural and match(event[2], query)
+            ]
+            data = b''.join(
+                json.dumps({'type': event_type, 'object': item}).encode('utf-8') + b'\n'
+                for _plural, event_type, item in events
+            )
+            return len(self.server.events), data
+
+        self.stream(read, int(query['timeoutSeconds']))
+
+    def follow_log(self, name, container):
+        def read(position):
+            log = self.server.logs.get((name, container), '').encode('utf-8')
+            return len(log), log[position:]
+
+        self.stream(read, self.server.follow_timeout)
+
+    def error(self, status, message):
+        self.reply(status, {'kind': 'Status', 'code': status, 'message': message})
+
+    def check_auth(self):
+        self.server.requests.append((self.command, self.path))
+        if self.server.token and self.headers.get('Authorization') != 'Bearer {}'.format(self.server.token):
+            self.error(401, 'Unauthorized')
+            return False
+        return True
+
+    def do_GET(self):
+        if not self.check_auth():
+            return
+        plural, name, sub, query = self.parse()
+        objects = self.server.objects.setdefault(plural, {})
+        if name is None and query.get('watch') == 'true':
+            return self.watch(plural, query)
+        if name is None:
+            items = [item for item in objects.values() if match(item, query)]
+            return self.reply(200, {
+                'kind': 'List',
+                'metadata': {'resourceVersion': str(len(self.server.events))},
+                'items': items
+            })
+        if name not in objects:
+            return self.error(404, '{} "{}" not found'.format(plural, name))
+        if sub == 'log' and query.get('follow') == 'true':
+            return self.follow_log(name, query.get('container'))
+        if sub == 'log':
+            return self.reply(200, self.server.logs.get((name, query.get('container')), '').encode('utf-8'))
+        self.reply(200, objects[name])
+
+    def do_POST(self):
+        if not self.check_auth():
+            return
+        plural, name, sub, query = self.parse()
+        content = self.read_json()
+        objects = self.server.objects.setdefault(plural, {})
+        if content['metadata']['name'] in objects:
+            return self.error(409, '{} "{}" already exists'.format(plural, content['metadata']['name']))
+        self.server.add(plural, content)
+        self.reply(201, content)
+
+    def do_PATCH(self):
+        if not self.check_auth():
+            return
+        plural, name, sub, query = self.parse()
+        item = self.server.objects[plural][name]
+        merge(item, self.read_json())
+        self.server.add(plural, item)
+        self.reply(200, item)
+
+    def do_DELETE(self):
+        if not self.check_auth():
+            return
+        plural, name, sub, query = self.parse()
+        self.read_json()
+        objects = self.server.objects.setdefault(plural, {})
+        if name is None:
+            if plural == 'services':
+                return self.error(405, 'the server does not allow this method on the requested resource')
+            for item in [item for item in objects.values() if match(item, query)]:
+                self.server.remove(plural, item['metadata']['name'])
+            return self.reply(200, {'kind': 'Status', 'status': 'Success'})
+        if name not in objects:
+            return self.error(404, '{} "{}" not found'.format(plural, name))
+        self.server.remove(plural, name)
+        self.reply(200, {'kind': 'Status', 'status': 'Success'})
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeApiServer(ThreadingHTTPServer):
+
+    follow_timeout = 2
+
+    def __init__(self, token='secret'):
+        super().__init__(('127.0.0.1', 0), FakeApiHandler)
+        self.token = token
+        self.objects = {}
+        self.events = []
+        self.logs = {}
+        self.requests = []
+        self.changed = threading.Condition()
+        self.stopped = False
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.server_address[1])
+
+    def add(self, plural, item):
+        with self.changed:
+            objects = self.objects.setdefault(plural, {})
+            event_type = 'MODIFIED' if item['metadata']['name'] in objects else 'ADDED'
+            objects[item['metadata']['name']] = item
+            self.events.append((plural, event_type, json.loads(json.dumps(item))))
+            self.changed.notify_all()
+
+    def remove(self, plural, name):
+        with self.changed:
+            item = self.objects[plural].pop(name)
+            self.events.append((plural, 'DELETED', item))
+            self.changed.notify_all()
+
+    def write_log(self, pod_name, container, line):
+        with self.changed:
+            self.logs[(pod_name, container)] = self.logs.get((pod_name, container), '') + line + '\n'
+            self.changed.notify_all()
+
+    def later(self, delay, func, *args):
+        timer = threading.Timer(delay, func, args)
+        timer.daemon = True
+        timer.start()
+
+    def stop(self):
+        with self.changed:
+            self.stopped = True
+            self.changed.notify_all()
+        self.shutdown()
+        self.server_close()
+
+
+def pod(name, phase='Running', ip='10.0.0.1'):
+    app = name.rsplit('-', 2)[0]
+    return {
+        'metadata': {
+            'name': name,
+            'labels': {'app': app},
+            'ownerReferences': [{'name': app}],
+        },
+        'status': {
+            'phase': phase,
+            'podIP': ip,
+            'containerStatuses': [{'state': {'waiting': {'message': 'Pulling the image'}}}]
+        }
+    }
+
+
+class KubernetesTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.server = FakeApiServer()
+        override = override_settings(K8S_API_SERVER=self.server.url, K8S_API_TOKEN='secret')
+        override.enable()
+        self.addCleanup(override.disable)
+        self.addCleanup(self.server.stop)
+        self.addCleanup(reset_client)
+        reset_client()
+
+
+class TestKubernetesClient(KubernetesTestCase):
+
+    def test_shared_client(self):
+        self.assertIs(get_client(), get_client())
+        self.assertEqual(get_client().server, self.server.url)
+
+    def test_create_list_delete(self):
+        client = get_client()
+        manifest = {'apiVersion': 'v1', 'kind': 'ConfigMap', 'metadata': {'name': 'cm', 'labels': {'app': 'a'}}}
+        client.create(manifest)
+        self.assertRaises(Conflict, client.create, manifest)
+
+        self.assertEqual(len(client.list('v1', 'ConfigMap')), 1)
+        self.assertEqual(len(client.list('v1', 'ConfigMap', label_selector='app=a')), 1)
+        self.assertEqual(client.list('v1', 'ConfigMap', label_selector='app=b'), [])
+        self.assertEqual(len(client.list('v1', 'ConfigMap', field_selector='metadata.name=cm')), 1)
+        self.assertEqual(client.get('v1', 'ConfigMap', 'cm')['metadata']['name'], 'cm')
+
+        client.delete('v1', 'ConfigMap', 'cm')
+        self.assertRaises(NotFound, client.get, 'v1', 'ConfigMap', 'cm')
+
+    def test_apply_existing(self):
+        client = get_client()
+        manifest = {'apiVersion': 'v1', 'kind': 'ConfigMap', 'metadata': {'name': 'cm'}, 'data': {'a': '1'}}
+        client.apply(manifest)
+        manifest['data'] = {'a': '2'}
+        client.apply(manifest)
+        self.assertEqual(self.server.objects['configmaps']['cm']['data'], {'a': '2'})
+
+    def test_paths(self):
+        client = get_client()
+        self.assertEqual(client.path('v1', 'Service'), 'api/v1/namespaces/default/services')
+        self.assertEqual(
+            client.path('extensions/v1beta1', 'Ingress', 'web'),
+            'apis/extensions/v1beta1/namespaces/default/ingresses/web'
+        )
+
+    def test_one_connection(self):
+        client = get_client()
+        for i in range(5):
+            client.list('v1', 'Pod')
+        self.assertEqual(len(self.server.requests), 5)
+        self.assertEqual(len(client.session.adapters['http://'].poolmanager.pools), 1)
+
+    @override_settings(K8S_API_SERVER=None)
+    def test_kubeconfig_files_removed(self):
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        path = os.path.join(folder, 'config')
+        data = base64.b64encode(b'certificate').decode('ascii')
+        with open(path, 'w') as out_file:
+            yaml.safe_dump({
+                'current-context': 'test',
+                'contexts': [{'name': 'test', 'context': {'cluster': 'test', 'user': 'test'}}],
+                'clusters': [{'name': 'test', 'cluster': {'server': self.server.url, 'certificate-authority-data': data}}],
+                'users': [{'name': 'test', 'user': {'client-certificate-data': data, 'client-key-data': data}}],
+            }, out_file)
+        with mock.patch.dict(os.environ, {'KUBECONFIG': path}):
+            client = get_client()
+        files = [client.session.verify, *client.session.cert]
+        self.assertTrue(all(os.path.exists(name) for name in files))
+        reset_client()
+        self.assertFalse(any(os.path.exists(name) for name in files))
+
+    def test_token_refresh(self):
+        client = KubernetesClient(self.server.url, token='expired', token_refresh=['refresh'])
+        refreshed = []
+
+        def refresh_token():
+            refreshed.append(True)
+            client.set_token('secret')
+            return True
+
+        client.refresh_token = refresh_token
+        self.assertEqual(client.list('v1', 'Pod'), [])
+        self.assertEqual(len(refreshed), 1)
+
+
+class TestK8S(KubernetesTestCase):
+
+    def test_execute_deployment(self):
+        container = Container(
+            name='app', image='image', public_port=8080, private_port=8000, variables={'DB_HOST': 'db'}
+        )
+        Deployment(name='session-1', labels='session-1', session='session-1', containers=[container]).execute()
+        LoadBalancer(name='session-1-loadbalancer', app='session-1', session='session-1', containers=[container]).execute()
+
+        self.assertIn('session-1', self.server.objects['deployments'])
+        self.assertIn('session-1-loadbalancer', self.server.objects['services'])
+        self.assertEqual(len(self.server.objects['configmaps']), 1)
+        self.assertEqual(
+            self.server.objects['deployments']['session-1']['spec']['template']['spec']['containers'][0]['envFrom'],
+            [{'configMapRef': {'name': list(self.server.objects['configmaps'])[0]}}]
+        )
+
+    def test_session_labels(self):
+        container = Container(
+            name='app', image='image', public_port=8080, private_port=8000, variables={'DB_HOST': 'db'}
+        )
+        Deployment(name='session-1', labels='session-1', session='session-1', containers=[container]).execute()
+        LoadBalancer(name='session-1-loadbalancer', app='session-1', session='session-1', containers=[container]).execute()
+
+        labels = {'app': 'session-1', 'session': 'session-1'}
+        deployment = self.server.objects['deployments']['session-1']
+        self.assertEqual(deployment['metadata']['labels'], labels)
+        self.assertEqual(deployment['spec']['template']['metadata']['labels'], labels)
+        self.assertEqual(self.server.objects['services']['session-1-loadbalancer']['metadata']['labels'], labels)
+        self.assertEqual(self.server.objects['services']['session-1-loadbalancer']['spec']['selector'], {'app': 'session-1'})
+        for config_map in self.server.objects['configmaps'].values():
+            self.assertEqual(config_map['metadata']['labels']['session'], 'session-1')
+
+    def test_prefix_of_other_app(self):
+        self.server.add('pods', pod('session-10-5d8f-x2k', ip='10.0.0.10'))
+        self.server.add('pods', pod('session-1-5d8f-x2k', ip='10.0.0.1'))
+        self.assertEqual(K8S(app_name='session-1').get_pod_status()['status']['podIP'], '10.0.0.1')
+        self.assertTrue(all('labelSelector=app%3Dsession-1' in path for _, path in self.server.requests))
+
+    def test_pod_status(self):
+        self.server.add('pods', pod('other-5d8f-x2k'))
+        self.server.add('pods', pod('session-1-5d8f-x2k', ip='10.0.0.2'))
+        k8s = K8S(app_name='session-1')
+        self.assertEqual(k8s.get_pod_status()['status']['podIP'], '10.0.0.2')
+        self.assertEqual(k8s.get_pod_status_deployment(), (True, None))
+
+        self.server.add('pods', pod('session-1-5d8f-x2k', phase='Pending'))
+        self.assertEqual(k8s.get_pod_status_deployment(), (False, 'Pulling the image'))
+
+        with self.assertRaises(Exception):
+            K8S(app_name='session-2').get_pod_status()
+
+    def test_service_status(self):
+        service = {
+            'metadata': {'name': 'session-1-loadbalancer', 'labels': {'app': 'session-1'}},
+            'status': {'loadBalancer': {}}
+        }
+        self.server.add('services', service)
+        self.server.add('services', {
+            'metadata': {'name': 'session-10-loadbalancer', 'labels': {'app': 'session-10'}},
+            'status': {'loadBalancer': {'ingress': [{'ip': '1.2.3.10'}]}}
+        })
+        k8s = K8S(app_name='session-1')
+        self.assertIsNone(k8s.service_status())
+        service['status']['loadBalancer']['ingress'] = [{'ip': '1.2.3.4'}]
+        self.assertEqual(k8s.service_status(), '1.2.3.4')
+
+    def test_pod_log(self):
+        self.server.add('pods', pod('session-1-5d8f-x2k'))
+        self.server.logs[('session-1-5d8f-x2k', 'session-1-zrc')] = 'spawned uWSGI worker 1'
+        k8s = K8S(app_name='session-1')
+        self.assertIn('spawned uWSGI', k8s.get_pod_log('session-1-zrc'))
+        self.assertEqual(k8s.deployment, 'session-1')
+
+    def test_delete(self):
+        self.server.add('deployments', {'metadata': {'name': 'session-1', 'labels': {'session': 'session-1'}}})
+        self.server.add('deployments', {'metadata': {'name': 'db-session-1', 'labels': {'session': 'session-1'}}})
+        self.server.add('deployments', {'metadata': {'name': 'session-10', 'labels': {'session': 'session-10'}}})
+        self.server.add('services', {'metadata': {'name': 'session-1-loadbalancer', 'labels': {'session': 'session-1'}}})
+        self.server.add('configmaps', {'metadata': {'name': 'session-1-zrc-configmap-1', 'labels': {'session': 'session-1'}}})
+        K8S(app_name='session-1').delete()
+        self.assertEqual(list(self.server.objects['deployments']), ['session-10'])
+        self.assertEqual(self.server.objects['services'], {})
+        self.assertEqual(self.server.objects['configmaps'], {})
+
+    def test_delete_legacy(self):
+        # deployed before the session label
+        self.server.add('deployments', {'metadata': {'name': 'session-1'}})
+        self.server.add('deployments', {'metadata': {'name': 'db-session-1'}})
+        self.server.add('deployments', {'metadata': {'name': 'session-10'}})
+        self.server.add('services', {'metadata': {'name': 'session-1-loadbalancer', 'labels': {'app': 'session-1'}}})
+        self.server.add('services', {'metadata': {'name': 'kubernetes'}})
+        self.server.add('configmaps', {'metadata': {'name': 'session-1-zrc-configmap-1', 'labels': {'app': 'session-1-zrc'}}})
+        label_legacy_objects(['session-1'])
+        del self.server.requests[:]
+        K8S(app_name='session-1').delete()
+        self.assertEqual(list(self.server.objects['deployments']), ['session-10'])
+        self.assertEqual(list(self.server.objects['services']), ['kubernetes'])
+        self.assertEqual(self.server.objects['configmaps'], {})
+        # only the objects of the session are selected
+        self.assertFalse(any('%21session' in path for _, path in self.server.requests))
+
+    def test_label_legacy_objects(self):
+        self.server.add('deployments', {'metadata': {'name': 'session-1'}})
+        self.server.add('deployments', {'metadata': {'name': 'session-2', 'labels': {'session': 'session-2'}}})
+        self.server.add('services', {'metadata': {'name': 'session-1-loadbalancer', 'labels': {'app': 'session-1'}}})
+        self.server.add('services', {'metadata': {'name': 'kubernetes'}})
+        labelled = label_legacy_objects(['session-1', 'session-2'])
+        self.assertEqual(labelled, ['session-1', 'session-1-loadbalancer'])
+        self.assertEqual(
+            self.server.objects['services']['session-1-loadbalancer']['metadata']['labels'],
+            {'app': 'session-1', 'session': 'session-1'}
+        )
+        self.assertNotIn('labels', self.server.objects['services']['kubernetes']['metadata'])
+        self.assertEqual(label_legacy_objects(['session-1']), [])
+
+    @override_settings(K8S_DELETE_BATCH_SIZE=2)
+    def test_delete_session_objects(self):
+        for i in range(5):
+            name = 'session-{}'.format(i)
+            self.server.add('deployments', {'metadata': {'name': name, 'labels': {'session': name}}})
+            self.server.add('configmaps', {'metadata': {'name': '{}-configmap'.format(name), 'labels': {'session': name}}})
+        delete_session_objects(['session-0', 'session-1', 'session-2', 'session-4'])
+        self.assertEqual(list(self.server.objects['deployments']), ['session-3'])
+        self.assertEqual(list(self.server.objects['configmaps']), ['session-3-configmap'])
+        # two batches of deployments and of ConfigMaps
+        self.assertEqual(len([method for method, path in self.server.requests if method == 'DELETE']), 4)
+
+    def test_fetch_resource(self):
+        self.server.add('services', {'metadata': {'name': 'session-1-loadbalancer', 'labels': {'session': 'session-1'}}})
+        self.server.add('services', {'metadata': {'name': 'kubernetes'}})
+        data = K8S().fetch_resource('services')
+        self.assertEqual(len(data['items']), 2)
+        data = K8S().fetch_resource('services', label_selector='session=session-1')
+        self.assertEqual([item['metadata']['name'] for item in data['items']], ['session-1-loadbalancer'])
+        data = K8S().fetch_resource('services', label_selector='session')
+        self.assertEqual([item['metadata']['name'] for item in data['items']], ['session-1-loadbalancer'])
+
+
+class TestManifest(KubernetesTestCase):
+
+    def session_manifest(self):
+        containers = [
+            Container(name='app', image='image', public_port=8080, private_port=8000, variables={'DB_HOST': 'db'}, migration=True),
+            Container(name='worker', image='image', public_port=None, private_port=None, variables={}),
+            Container(name='db', image='postgis', public_port=None, private_port=None, variables={'A': '1'},
+                      data=['create database ac;'], filename='initdb.sql'),
+        ]
+        return Manifest([
+            Deployment(name='session-1', labels='session-1', session='session-1', containers=containers),
+            LoadBalancer(name='session-1-loadbalancer', app='session-1', session='session-1', containers=containers),
+        ])
+
+    def test_dry_run(self):
+        manifests = self.session_manifest().apply(dry_run=True)
+        self.assertEqual(self.server.requests, [])
+        self.assertEqual(
+            [manifest['kind'] for manifest in manifests], ['ConfigMap', 'ConfigMap', 'ConfigMap', 'Deployment', 'Service']
+        )
+        spec = manifests[3]['spec']['template']['spec']
+        self.assertEqual(spec['initContainers'], [{'name': 'app-init', 'image': 'image', 'command': ['python', 'src/manage.py', 'migrate']}])
+        self.assertEqual(spec['volumes'], [{'name': 'db-volume', 'configMap': {'name': manifests[2]['metadata']['name']}}])
+        self.assertEqual(manifests[2]['data'], {'initdb.sql': 'create database ac;'})
+        for manifest in manifests:
+            self.assertEqual(manifest['metadata']['labels']['session'], 'session-1')
+
+    def test_render_again(self):
+        manifest = self.session_manifest()
+        self.assertEqual(manifest.render(), manifest.render())
+
+    def test_dump(self):
+        manifest = self.session_manifest()
+        self.assertEqual(list(yaml.safe_load_all(manifest.dump())), manifest.render())
+
+    def test_apply(self):
+        manifests = self.session_manifest().apply()
+        self.assertEqual(len(self.server.requests), len(manifests))
+        self.assertEqual(len(self.server.objects['configmaps']), 3)
+        self.assertIn('session-1', self.server.objects['deployments'])
+        self.assertIn('session-1-loadbalancer', self.server.objects['services'])
+
+
+class TestReadiness(KubernetesTestCase):
+
+    def test_wait_pod_running(self):
+        self.server.add('pods', pod('session-1-5d8f-x2k', phase='Pending'))
+        self.server.later(0.2, self.server.add, 'pods', pod('other-5d8f-x2k'))
+        self.server.later(0.4, self.server.add, 'pods', pod('session-1-5d8f-x2k', ip='10.0.0.2'))
+        start = time.monotonic()
+        item = K8S(app_name='session-1').wait_pod_running(10)
+        self.assertEqual(item['status']['podIP'], '10.0.0.2')
+        self.assertLess(time.monotonic() - start, 2)
+        self.assertTrue(any('watch=true' in path and 'labelSelector=app%3Dsession-1' in path for _, path in self.server.requests))
+
+    def test_wait_pod_already_running(self):
+        self.server.add('pods', pod('session-1-5d8f-x2k'))
+        K8S(app_name='session-1').wait_pod_running(10)
+        self.assertFalse(any('watch=true' in path for _, path in self.server.requests))
+
+    def test_wait_service_ip(self):
+        service = {'metadata': {'name': 'session-1-loadbalancer', 'labels': {'app': 'session-1'}}, 'status': {'loadBalancer': {}}}
+        self.server.add('services', service)
+        self.server.later(0.3, self.server.add, 'services', {
+            'metadata': service['metadata'], 'status': {'loadBalancer': {'ingress': [{'ip': '1.2.3.4'}]}}
+        })
+        self.assertEqual(K8S(app_name='session-1').wait_service_ip(10), '1.2.3.4')
+
+    def test_wait_watch_error(self):
+        self.server.add('pods', pod('session-1-5d8f-x2k', phase='Pending'))
+        self.server.later(0.3, self.server.add, 'pods', pod('session-1-5d8f-x2k', ip='10.0.0.2'))
+        client = get_client()
+        watch = client.watch
+        calls = []
+
+        def failing_watch(*args, **kwargs):
+            calls.append(True)
+            if len(calls) == 1:
+                raise KubernetesError(500, 'internal error')
+            return watch(*args, **kwargs)
+
+        with mock.patch.object(client, 'watch', failing_watch):
+            item = K8S(app_name='session-1').wait_pod_running(10)
+        # listed again after the failed watch
+        self.assertEqual(item['status']['podIP'], '10.0.0.2')
+        self.assertGreater(len(calls), 1)
+
+    def test_wait_deadline(self):
+        self.server.add('pods', pod('session-1-5d8f-x2k', phase='Pending'))
+        start = time.monotonic()
+        with self.assertRaises(DeadlineExceeded):
+            K8S(app_name='session-1').wait_pod_running(1)
+        self.assertLess(time.monotonic() - start, 3)
+
+    def test_wait_log(self):
+        self.server.add('pods', pod('session-1-5d8f-x2k'))
+        self.server.write_log('session-1-5d8f-x2k', 'session-1-zrc', 'Operations to perform')
+        self.server.later(0.3, self.server.write_log, 'session-1-5d8f-x2k', 'session-1-zrc', 'spawned uWSGI worker 1')
+        start = time.monotonic()
+        K8S(app_name='session-1').wait_log('session-1-zrc', 'spawned uWSGI', 10)
+        self.assertLess(time.monotonic() - start, 2)
+
+    def test_wait_log_deadline(self):
+        self.server.add('pods', pod('session-1-5d8f-x2k'))
+        self.server.write_log('session-1-5d8f-x2k', 'session-1-zrc', 'Operations to perform')
+        with self.assertRaises(DeadlineExceeded):
+            K8S(app_name='session-1').wait_log('session-1-zrc', 'spawned uWSGI', 1)
+
+    @override_settings(K8S_WAIT_STOP_INTERVAL=0.2)
+    def test_wait_log_stopped(self):
+        self.server.add('pods', pod('session-1-5d8f-x2k'))
+        self.server.write_log('session-1-5d8f-x2k', 'session-1-zrc', 'Operations to perform')
+        stop = threading.Event()
+        self.server.later(0.3, stop.set)
+        start = time.monotonic()
+        with self.assertRaises(DeadlineExceeded):
+            K8S(app_name='session-1').wait_log('session-1-zrc', 'spawned uWSGI', 30, stop=stop)
+        self.assertLess(time.monotonic() - start, 2)
+
+    @override_settings(K8S_WAIT_STOP_INTERVAL=1)
+    def test_wait_stopped(self):
+        self.server.add('pods', pod('session-1-5d8f-x2k', phase='Pending'))
+        stop = threading.Event()
+        self.server.later(0.3, stop.set)
+        start = time.monotonic()
+        with self.assertRaises(DeadlineExceeded):
+            K8S(app_name='session-1').wait_for('pods', lambda item: False, 30, stop=stop)
+        self.assertLess(time.monotonic() - start, 3)
+
+
+@mock.patch('vng.k8s_manager.cluster.run_command')
+class TestClusterContext(KubernetesTestCase):
+
+    def setUp(self):
+        super().setUp()
+        reset_contexts()
+        self.addCleanup(reset_contexts)
+
+    def commands(self, run_command):
+        return [c[0][0][3] for c in run_command.call_args_list]
+
+    def test_initialize_once(self, run_command):
+        run_command.return_value = b'RUNNING\n'
+        K8S(app_name='session-1').initialize()
+        K8S(app_name='db-session-1').initialize()
+        self.assertEqual(self.commands(run_command), ['describe', 'get-credentials'])
+        self.assertIs(get_context('test-sessions'), get_context('test-sessions'))
+
+    def test_create_missing_cluster(self, run_command):
+        run_command.return_value = b''
+        K8S(app_name='session-1').initialize()
+        self.assertEqual(self.commands(run_command), ['describe', 'create', 'get-credentials'])
+
+    @override_settings(K8S_CLUSTER_CONTEXT_TTL=0)
+    def test_expired(self, run_command):
+        run_command.return_value = b'RUNNING\n'
+        K8S(app_name='session-1').initialize()
+        K8S(app_name='session-1').initialize()
+        self.assertEqual(self.commands(run_command), ['describe', 'get-credentials'] * 2)
+
+    def test_refresh_on_unauthorized(self, run_command):
+        def gcloud(command):
+            if command[3] == 'get-credentials':
+                # the new credentials are accepted
+                self.server.token = 'secret'
+            return b'RUNNING\n'
+
+        run_command.side_effect = gcloud
+        k8s = K8S(app_name='session-1')
+        k8s.initialize()
+        self.server.add('pods', pod('session-1-5d8f-x2k'))
+        self.server.token = 'rotated'
+        self.assertEqual(k8s.wait_pod_running(5)['metadata']['name'], 'session-1-5d8f-x2k')
+        self.assertEqual(self.commands(run_command), ['describe', 'get-credentials'] * 2)
+
+    def test_refused_credentials(self, run_command):
+        run_command.return_value = b'RUNNING\n'
+        k8s = K8S(app_name='session-1')
+        k8s.initialize()
+        self.server.token = 'rotated'
+        with self.assertRaises(DeadlineExceeded):
+            k8s.wait_pod_running(2)
+        # the credentials are fetched again about once a second
+        self.assertLessEqual(self.commands(run_command).count('get-credentials'), 4)
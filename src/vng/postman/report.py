@@ -0,0 +1,127 @@
+import json
+
+import ijson
+
+from .utils import get_call_result, normalize_execution
+
+EXECUTION = 'run.executions.item'
+
+
+def decode_body(execution):
+    '''
+    Replace the bytes of the response of an execution with its JSON body
+    '''
+    response = execution.get('response')
+    if not isinstance(response, dict) or 'stream' not in response:
+        return execution
+    stream = response.pop('stream')
+    try:
+        response['body'] = json.loads(bytes(stream['data']).decode('utf-8'))
+    except (ValueError, TypeError, KeyError):
+        pass
+    return execution
+
+
+def call_fields(execution):
+    '''
+    Return the fields of the call of a normalized execution
+    '''
+    assertions = execution.get('assertions', [])
+    failed = sum(1 for assertion in assertions if 'error' in assertion)
+    url = execution['request'].get('url')
+    return {
+        'name': execution['item'].get('name', ''),
+        'method': execution['request'].get('method', ''),
+        'url': url.get('url', '') if isinstance(url, dict) else url or '',
+        'code': execution.get('response', {}).get('code'),
+        'success': get_call_result(execution),
+        'assertions_passed': len(assertions) - failed,
+        'assertions_failed': failed,
+        'execution': json.dumps(execution),
+    }
+
+
+class JsonWriter:
+    '''
+    Write a JSON document from the events of ijson and from values
+    '''
+
+    def __init__(self, out_file):
+        self.out_file = out_file
+        # for each open container, whether it has no element yet
+        self.empty = [True]
+        self.after_key = False
+
+    def separate(self):
+        if self.after_key:
+            self.after_key = False
+        elif self.empty[-1]:
+            self.empty[-1] = False
+        else:
+            self.out_file.write(',')
+
+    def event(self, event, value):
+        if event == 'map_key':
+            self.separate()
+            self.out_file.write(json.dumps(value) + ':')
+            self.after_key = True
+        elif event in ('start_map', 'start_array'):
+            self.separate()
+            self.out_file.write('{' if event == 'start_map' else '[')
+            self.empty.append(True)
+        elif event in ('end_map', 'end_array'):
+            self.empty.pop()
+            self.out_file.write('}' if event == 'end_map' else ']')
+        else:
+            self.value(value)
+
+    def value(self, value):
+        self.separate()
+        json.dump(value, self.out_file)
+
+
+class NewmanReport:
+    '''
+    Newman JSON report read in a single pass, the executions are built one at
+    a time so the whole document is never loaded.
+    '''
+
+    def __init__(self, in_file):
+        # ijson reads bytes, the file is opened in binary mode
+        self.in_file = in_file
+        self.info = None
+
+    def read(self, out_file=None, executions=True):
+        '''
+        Yield the executions normalized as they are read, the report without its
+        executions is in `info` once they are all read. The report with the
+        normalized executions is written in `out_file` if given.
+        '''
+        writer = JsonWriter(out_file) if out_file is not None else None
+        info = ijson.ObjectBuilder()
+        execution = None
+        for prefix, event, value in ijson.parse(self.in_file, use_float=True):
+            if prefix == EXECUTION or prefix.startswith(EXECUTION + '.'):
+                if not executions:
+                    continue
+                if prefix == EXECUTION and event == 'start_map':
+                    execution = ijson.ObjectBuilder()
+                execution.event(event, value)
+                if prefix == EXECUTION and event == 'end_map':
+                    item = normalize_execution(decode_body(execution.value))
+                    if writer is not None:
+                        writer.value(item)
+                    yield item
+                continue
+            info.event(event, value)
+            if writer is not None:
+                writer.event(event, value)
+        self.info = info.value
+
+    def read_info(self):
+        '''
+        Return the report without its executions
+        '''
+        for execution in self.read(executions=False):
+            pass
+        return self.info
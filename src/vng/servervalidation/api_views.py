@@ -22,6 +22,7 @@ from .serializers import ServerRunSerializer, ServerRunPayloadExample, ServerRun
 from .models import ServerRun, PostmanTestResult
 from .task import execute_test
 from ..utils import choices
+from ..utils.badges import badge_response
 
 
 class ServerRunViewSet(
@@ -83,28 +84,29 @@ class ResultServerViewShield(views.APIView):
 
     @swagger_auto_schema(responses={200: ServerRunResultShield})
     def get(self, request, uuid=None):
-        server = get_object_or_404(ServerRun, uuid=uuid)
-        res = server.get_execution_result()
-        is_error = True
-        if res is None:
-            message = 'No results'
-            color = 'inactive'
-        elif res:
-            message = 'Success'
-            color = 'green'
-            is_error = False
-        else:
-            message = 'Failed'
-            color = 'red'
-        result = {
-            'schemaVersion': 1,
-            'label': 'API Test Platform',
-            'message': message,
-            'color': color,
-            'isError': is_error,
-        }
-
-        return JsonResponse(result)
+        def build():
+            server = get_object_or_404(ServerRun, uuid=uuid)
+            res = server.get_execution_result()
+            is_error = True
+            if res is None:
+                message = 'No results'
+                color = 'inactive'
+            elif res:
+                message = 'Success'
+                color = 'green'
+                is_error = False
+            else:
+                message = 'Failed'
+                color = 'red'
+            return {
+                'schemaVersion': 1,
+                'label': 'API Test Platform',
+                'message': message,
+                'color': color,
+                'isError': is_error,
+            }
+
+        return badge_response(request, 'server_run', uuid, build)
 
 
 class ResultServerView(views.APIView):
@@ -14,5 +14,6 @@ class ServervalidationConfig(AppConfig):
             os.makedirs(folder)
 
     def ready(self):
+        from . import signals  # noqa
         print(NewmanManager.REPORT_FOLDER)
         self.create_folder(NewmanManager.REPORT_FOLDER)
@@ -0,0 +1,20 @@
+import os
+
+from django.core.management.base import BaseCommand
+
+from ...models import PostmanTestResult
+
+
+class Command(BaseCommand):
+    help = 'Store the calls of the Newman reports saved before the calls were stored separately'
+
+    def handle(self, *args, **options):
+        results = PostmanTestResult.objects.exclude(log_json='').exclude(log_json=None).filter(postmantestcall=None)
+        count = 0
+        for ptr in results.iterator():
+            if not os.path.exists(ptr.log_json.path):
+                continue
+            with open(ptr.log_json.path, 'rb') as in_file:
+                ptr.save_calls(in_file)
+            count += 1
+        self.stdout.write('Calls stored for {} reports'.format(count))
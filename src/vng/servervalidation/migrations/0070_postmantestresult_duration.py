@@ -0,0 +1,18 @@
+# Generated by Django 2.2.3 on 2019-07-29 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('servervalidation', '0069_auto_20190717_1229'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='postmantestresult',
+            name='duration',
+            field=models.FloatField(blank=True, default=None, help_text='Seconds taken by the run of the collection', null=True),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 2.2.3 on 2019-08-02 10:21
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('servervalidation', '0070_postmantestresult_duration'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PostmanTestCall',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('order', models.PositiveIntegerField()),
+                ('name', models.TextField(blank=True)),
+                ('method', models.CharField(blank=True, max_length=20)),
+                ('url', models.TextField(blank=True)),
+                ('code', models.PositiveSmallIntegerField(blank=True, default=None, null=True)),
+                ('success', models.BooleanField()),
+                ('assertions_passed', models.PositiveIntegerField(default=0)),
+                ('assertions_failed', models.PositiveIntegerField(default=0)),
+                ('execution', models.TextField(help_text='Execution of the call in the report, as JSON')),
+                ('result', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='servervalidation.PostmanTestResult')),
+            ],
+            options={
+                'ordering': ['order'],
+            },
+        ),
+    ]
@@ -1,6 +1,6 @@
 import json
-import array
 import itertools
+import tempfile
 import uuid
 
 from datetime import datetime
@@ -13,11 +13,11 @@ from django.conf import settings
 from django.utils.translation import ugettext_lazy as _
 
 from ordered_model.models import OrderedModel
-from django.core.files.base import ContentFile
+from django.core.files import File
 from filer.fields.file import FilerFileField
 
 from vng.accounts.models import User
-import vng.postman.utils as postman
+from vng.postman.report import NewmanReport, call_fields
 from vng.postman.choices import ResultChoices
 
 from ..utils import choices
@@ -102,17 +102,14 @@ class ServerRun(models.Model):
         return self.status == choices.StatusChoices.error_deploy
 
     def get_execution_result(self):
-        ptr_set = self.postmantestresult_set.all()
-        if len(ptr_set) == 0:
-            success = None
-        else:
-            success = True
-            for ptr in ptr_set:
-                if ptr.is_success() == 0:
-                    success = None
-                elif ptr.is_success() == -1 and success is not None:
-                    success = False
-        return success
+        '''
+        Return None when there is no result or one is still unknown,
+        otherwise whether all the results are successful
+        '''
+        outcomes = {ptr.is_success() for ptr in self.postmantestresult_set.all()}
+        if not outcomes or 0 in outcomes:
+            return None
+        return -1 not in outcomes
 
 
 class ServerHeader(models.Model):
@@ -129,6 +126,9 @@ class PostmanTestResult(models.Model):
     log_json = models.FileField(settings.MEDIA_FOLDER_FILES['servervalidation_log'], blank=True, null=True, default=None)
     server_run = models.ForeignKey(ServerRun, on_delete=models.CASCADE)
     status = models.CharField(max_length=10, choices=ResultChoices.choices, default=None, null=True)
+    duration = models.FloatField(
+        blank=True, null=True, default=None, help_text='Seconds taken by the run of the collection'
+    )
 
     def __str__(self):
         if self.status is None:
@@ -158,10 +158,9 @@ class PostmanTestResult(models.Model):
         if hasattr(self, 'status_saved'):
             return self.status_saved
 
-        with open(self.log_json.path) as jfile:
-            f = json.load(jfile)
+        with open(self.log_json.path, 'rb') as jfile:
+            f = NewmanReport(jfile).read_info()
             del f['run']['executions']
-            a = int(f['run']['timings']['started'])
             f['run']['timings']['started'] = (datetime.utcfromtimestamp(int(f['run']['timings']['started']) / 1000)
                                               .strftime('%I:%M %p'))
 
@@ -169,18 +168,39 @@ class PostmanTestResult(models.Model):
             return f
 
     def get_json_obj(self):
-        return postman.get_json_obj_file(self.log_json.path)
+        return [json.loads(execution) for execution in self.postmantestcall_set.values_list('execution', flat=True)]
 
     def save_json(self, filename, file):
-        content = json.load(file)
-        for execution in content['run']['executions']:
-            try:
-                buffer = execution['response']['stream']['data']
-                del execution['response']['stream']
-                execution['response']['body'] = json.loads(array.array('B', buffer).tostring())
-            except:
-                pass
-        self.log_json.save(filename, ContentFile(json.dumps(content)))
+        '''
+        Read the report once: its calls are stored as they are read, the report
+        with the decoded responses is stored and the outcome of the run is set.
+        '''
+        with open(file.name, 'rb') as in_file, tempfile.NamedTemporaryFile('w+', suffix='.json') as out_file:
+            report, success = self.save_calls(in_file, out_file)
+            if report.info['run']['failures'] or not success:
+                self.status = ResultChoices.failed
+            else:
+                self.status = ResultChoices.success
+            self.log_json.save(filename, File(out_file))
+
+    def save_calls(self, in_file, out_file=None):
+        '''
+        Store the calls of the report as they are read, in batches. Return the
+        report and whether all its calls succeeded.
+        '''
+        self.postmantestcall_set.all().delete()
+        success = True
+        calls = []
+        report = NewmanReport(in_file)
+        for order, execution in enumerate(report.read(out_file)):
+            call = PostmanTestCall(result=self, order=order, **call_fields(execution))
+            success = success and call.success
+            calls.append(call)
+            if len(calls) == settings.POSTMAN_CALL_BATCH_SIZE:
+                PostmanTestCall.objects.bulk_create(calls)
+                calls = []
+        PostmanTestCall.objects.bulk_create(calls)
+        return report, success
 
     def get_outcome_html(self):
         with open(self.log.path) as f:
@@ -191,32 +211,26 @@ class PostmanTestResult(models.Model):
         return ResultChoices.failed
 
     def get_outcome_json(self):
-        with open(self.log_json.path) as jfile:
-            return postman.get_outcome_json(jfile, file=True)
+        if self.get_json_obj_info()['run']['failures'] or self.postmantestcall_set.filter(success=False).exists():
+            return ResultChoices.failed
+        return ResultChoices.success
 
     def get_call_results(self):
-        positive, negative = 0, 0
-        for call in self.get_json_obj():
-            if postman.get_call_result(call):
-                positive += 1
-            else:
-                negative += 1
-        return positive, negative
+        results = self.postmantestcall_set.aggregate(
+            positive=models.Count('pk', filter=models.Q(success=True)),
+            negative=models.Count('pk', filter=models.Q(success=False)),
+        )
+        return results['positive'], results['negative']
 
     def get_aggregate_results(self):
-        passed, error = 0, 0
-        positive, negative = 0, 0
-        for call in self.get_json_obj():
-            if postman.get_call_result(call):
-                positive += 1
-            else:
-                negative += 1
-            if 'assertions' in call:
-                for assertion in call['assertions']:
-                    if 'error' in assertion:
-                        error += 1
-                    else:
-                        passed += 1
+        results = self.postmantestcall_set.aggregate(
+            positive=models.Count('pk', filter=models.Q(success=True)),
+            negative=models.Count('pk', filter=models.Q(success=False)),
+            passed=models.Sum('assertions_passed'),
+            error=models.Sum('assertions_failed'),
+        )
+        passed, error = results['passed'] or 0, results['error'] or 0
+        positive, negative = results['positive'], results['negative']
         return {
             'assertions': {
                 'passed': passed,
@@ -231,15 +245,11 @@ class PostmanTestResult(models.Model):
         }
 
     def get_assertions_details(self):
-        passed, error = 0, 0
-        for call in self.get_json_obj():
-            if 'assertions' in call:
-                for assertion in call['assertions']:
-                    if 'error' in assertion:
-                        error += 1
-                    else:
-                        passed += 1
-        return passed, error
+        results = self.postmantestcall_set.aggregate(
+            passed=models.Sum('assertions_passed'),
+            error=models.Sum('assertions_failed'),
+        )
+        return results['passed'] or 0, results['error'] or 0
 
     def positive_call_result(self):
         return self.get_call_results()[0]
@@ -248,7 +258,30 @@ class PostmanTestResult(models.Model):
         return self.get_call_results()[1]
 
     def get_call_results_list(self):
-        return [postman.get_call_result(call) for call in self.get_json_obj()]
+        return list(self.postmantestcall_set.values_list('success', flat=True))
+
+
+class PostmanTestCall(models.Model):
+    '''
+    Call of a collection, as read from the JSON report of its run
+    '''
+
+    result = models.ForeignKey(PostmanTestResult, on_delete=models.CASCADE)
+    order = models.PositiveIntegerField()
+    name = models.TextField(blank=True)
+    method = models.CharField(max_length=20, blank=True)
+    url = models.TextField(blank=True)
+    code = models.PositiveSmallIntegerField(blank=True, null=True, default=None)
+    success = models.BooleanField()
+    assertions_passed = models.PositiveIntegerField(default=0)
+    assertions_failed = models.PositiveIntegerField(default=0)
+    execution = models.TextField(help_text='Execution of the call in the report, as JSON')
+
+    class Meta:
+        ordering = ['order']
+
+    def __str__(self):
+        return '{} - {}'.format(self.result_id, self.name)
 
 
 class Endpoint(models.Model):
@@ -0,0 +1,15 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from ..utils.badges import invalidate_badges
+from .models import ServerRun, PostmanTestResult
+
+
+@receiver([post_save, post_delete], sender=PostmanTestResult)
+def result_changed(sender, instance, **kwargs):
+    invalidate_badges('server_run', ServerRun.objects.filter(pk=instance.server_run_id).values_list('uuid', flat=True))
+
+
+@receiver(post_delete, sender=ServerRun)
+def server_run_deleted(sender, instance, **kwargs):
+    invalidate_badges('server_run', [instance.uuid])
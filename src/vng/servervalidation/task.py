@@ -1,11 +1,16 @@
+import time
 import uuid
-from zds_client import ClientAuth
 import traceback
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
 
+from django.core.cache import cache
 from django.core.files import File
 from django.utils import timezone
 from django.core.mail import send_mail
 from django.template.loader import render_to_string
+from celery import chord
 from celery.utils.log import get_task_logger
 from django.utils.translation import ugettext_lazy as _
 from django.conf import settings
@@ -15,43 +20,103 @@ from vng.postman.choices import ResultChoices
 from ..celery.celery import app
 from .models import PostmanTest, PostmanTestResult, Endpoint, ServerRun, ServerHeader
 from ..utils import choices
+from ..utils.auth import get_jwt
 from ..utils.newman import NewmanManager
 
 
 logger = get_task_logger(__name__)
 
 
-def get_jwt(server_run):
-
-    return ClientAuth(
-        client_id=server_run.client_id,
-        secret=server_run.secret,
-        scopes=['zds.scopes.zaken.lezen',
-                'zds.scopes.zaaktypes.lezen',
-                'zds.scopes.zaken.aanmaken',
-                'zds.scopes.statussen.toevoegen',
-                'zds.scopes.zaken.bijwerken'],
-        zaaktypes=['*']
+@app.task
+def execute_test_scheduled():
+    '''
+    Run the scheduled server validations with one task each, every user is
+    notified once all of their runs are completed
+    '''
+    server_runs = ServerRun.objects.filter(
+        scheduled=True, status=choices.StatusWithScheduledChoices.scheduled
+    ).order_by('user', 'pk')
+    runs = OrderedDict()
+    for pk, user in server_runs.values_list('pk', 'user'):
+        runs.setdefault(user, []).append(pk)
+    ServerRun.objects.filter(pk__in=[pk for pks in runs.values() for pk in pks]).update(
+        status=choices.StatusWithScheduledChoices.running
     )
+    for pks in runs.values():
+        chord(execute_scheduled_run.s(pk) for pk in pks)(notify_scheduled_runs.s())
+
+
+def run_hosts(server_run_pk):
+    '''
+    Return the hosts targeted by the endpoints of the run
+    '''
+    urls = Endpoint.objects.filter(server_run=server_run_pk).values_list('url', flat=True)
+    return sorted({urlparse(url).netloc for url in urls} - {''})
+
+
+def acquire_host_slots(hosts):
+    '''
+    Take a slot of each host among the SERVER_RUN_HOST_CONCURRENCY ones shared
+    by the workers, return the keys of the slots or None if a host is busy.
+    When the cache does not work the hosts are not limited.
+    '''
+    slots = []
+    for host in hosts:
+        for i in range(settings.SERVER_RUN_HOST_CONCURRENCY):
+            key = 'server-run-host:{}:{}'.format(host, i)
+            # the slot expires if its worker dies before releasing it
+            if cache.add(key, True, settings.SERVER_RUN_HOST_SLOT_TIMEOUT):
+                slots.append(key)
+                break
+            # a taken slot holds a value, the errors of the cache are ignored
+            # and a failed add of an empty slot means the cache is unavailable
+            if cache.get(key) is None:
+                logger.warning('Cache unavailable, the run on %s is not limited', host)
+                break
+        else:
+            release_host_slots(slots)
+            return None
+    return slots
+
+
+def release_host_slots(slots):
+    cache.delete_many(slots)
+
+
+@app.task(bind=True, max_retries=settings.SERVER_RUN_HOST_MAX_RETRIES)
+def execute_scheduled_run(self, server_run_pk):
+    slots = acquire_host_slots(run_hosts(server_run_pk))
+    if slots is None:
+        if self.request.retries < self.max_retries:
+            raise self.retry(countdown=settings.SERVER_RUN_HOST_RETRY_DELAY)
+        # the run is not dropped, the notification of the chord waits for it
+        logger.warning('Hosts of server run %s still busy after %s retries', server_run_pk, self.max_retries)
+        slots = []
+    try:
+        return server_run_pk, execute_test(server_run_pk, scheduled=True)
+    finally:
+        release_host_slots(slots)
 
 
 @app.task
-def execute_test_scheduled():
-    server_run = ServerRun.objects.filter(scheduled=True).filter(status=choices.StatusWithScheduledChoices.scheduled).order_by('user')
-    s_list = []
-    failed = False
-    for i, sr in enumerate(server_run):
-        sr.status = choices.StatusWithScheduledChoices.running
-        sr.save()
-        result = execute_test(sr.pk, scheduled=True)
-        failed = failed or result
-        s_list.append((sr, result))
-        if i == len(server_run) - 1 or sr.user != server_run[i + 1].user and s_list != []:
-            # Send email only if there is at least one failure
-            if result:
-                send_email_failure(s_list)
-            s_list = []
-            failed = False
+def notify_scheduled_runs(results):
+    '''
+    Send a single email to the user of the runs if at least one of them failed
+    '''
+    failures = dict(results)
+    if not any(failures.values()):
+        return
+    server_runs = ServerRun.objects.filter(pk__in=failures).select_related('user').order_by('pk')
+    send_email_failure([(sr, failures[sr.pk]) for sr in server_runs])
+
+
+def timed_reports(nm):
+    '''
+    Run the collection of the manager, return its reports and the duration of the run
+    '''
+    start = time.monotonic()
+    html_report, json_report = nm.execute_reports()
+    return html_report, json_report, round(time.monotonic() - start, 3)
 
 
 @app.task
@@ -61,47 +126,55 @@ def execute_test(server_run_pk, scheduled=False, email=False):
     endpoints = Endpoint.objects.filter(server_run=server_run)
 
     file_name = str(uuid.uuid4())
-    postman_tests = PostmanTest.objects.filter(test_scenario=server_run.test_scenario).order_by('order')
+    postman_tests = list(PostmanTest.objects.filter(test_scenario=server_run.test_scenario).order_by('order'))
     # remove previous results
     PostmanTestResult.objects.filter(server_run=server_run).delete()
     failure = False
     try:
-        for counter, postman_test in enumerate(postman_tests):
-            auth_choice = postman_test.test_scenario.authorization
-            if auth_choice == choices.AuthenticationChoices.jwt:
-                jwt_auth = get_jwt(server_run).credentials()
-            server_run.status_exec = 'Running the test {}'.format(postman_test.validation_file)
-            server_run.percentage_exec = int(((counter + 1) / (len(postman_tests) + 1)) * 100)
-            server_run.save()
-            nm = NewmanManager(postman_test.validation_file)
-
-            if auth_choice == choices.AuthenticationChoices.jwt:
-                nm.replace_parameters({
-                    'BEARER_TOKEN': list(jwt_auth.values())[0].split()[1]
+        # the parameters of the collections, all of the same scenario
+        auth_choice = server_run.test_scenario.authorization
+        parameters = []
+        if auth_choice == choices.AuthenticationChoices.jwt:
+            jwt_auth = get_jwt(server_run).credentials()
+            parameters.append({
+                'BEARER_TOKEN': list(jwt_auth.values())[0].split()[1]
+            })
+        elif auth_choice == choices.AuthenticationChoices.header:
+            for header in ServerHeader.objects.filter(server_run=server_run):
+                parameters.append({
+                    'Authentication': header.header_value
                 })
-            elif auth_choice == choices.AuthenticationChoices.header:
-                se = ServerHeader.objects.filter(server_run=server_run)
-                for header in se:
-                    nm.replace_parameters({
-                        'Authentication': header.header_value
-                    })
-            elif auth_choice == choices.AuthenticationChoices.no_auth:
-                pass
-            param = {}
-            for ep in endpoints:
-                param[ep.test_scenario_url.name] = ep.url
-            nm.replace_parameters(param)
-            file = nm.execute_test()
-            file_json = nm.execute_test_json()
-            ptr = PostmanTestResult(
-                postman_test=postman_test,
-                server_run=server_run
-            )
-            ptr.log.save(file_name, File(file))
-            ptr.save_json(file_name, File(file_json))
-            ptr.status = ptr.get_outcome_json()
-            ptr.save()
-            failure = failure or (ptr.status == ResultChoices.failed)
+        parameters.append({ep.test_scenario_url.name: ep.url for ep in endpoints})
+
+        managers = []
+        for postman_test in postman_tests:
+            nm = NewmanManager(postman_test.validation_file)
+            for param in parameters:
+                nm.replace_parameters(param)
+            managers.append(nm)
+
+        # the collections run in parallel, their results are stored in order
+        with ThreadPoolExecutor(max_workers=settings.NEWMAN_WORKERS) as executor:
+            runs = [executor.submit(timed_reports, nm) for nm in managers]
+            for counter, (postman_test, run) in enumerate(zip(postman_tests, runs)):
+                server_run.status_exec = 'Running the test {}'.format(postman_test.validation_file)
+                server_run.percentage_exec = int(((counter + 1) / (len(postman_tests) + 1)) * 100)
+                server_run.save()
+                try:
+                    file, file_json, duration = run.result()
+                except Exception:
+                    # the run is failed, the collections not started yet are dropped
+                    for pending in runs:
+                        pending.cancel()
+                    raise
+                ptr = PostmanTestResult(
+                    postman_test=postman_test,
+                    server_run=server_run,
+                    duration=duration
+                )
+                ptr.log.save(file_name, File(file))
+                ptr.save_json(file_name, File(file_json))
+                failure = failure or (ptr.status == ResultChoices.failed)
 
         server_run.status_exec = 'Completed'
     except Exception as e:
@@ -1,16 +1,34 @@
 import collections
 import json
+import os
+import sys
+import tempfile
+import time
+from io import StringIO
 
+import mock
+
+from django.core import mail
+from django.core.files import File
+from django.core.management import call_command
+from django.core.cache import cache
 from django.utils import timezone
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from django_webtest import WebTest
 from django.urls import reverse
 
 from vng.accounts.models import User
 
-from ..models import PostmanTestResult
+from vng.postman.choices import ResultChoices
+
+from ..models import Endpoint, PostmanTestResult, ServerRun
+from ..task import (
+    acquire_host_slots, execute_scheduled_run, execute_test, execute_test_scheduled, release_host_slots
+)
 from .factories import ServerRunFactory, TestScenarioFactory, TestScenarioUrlFactory, PostmanTestFactory, PostmanTestNoAssertionFactory
+from ...utils import choices
 from ...utils.factories import UserFactory
+from ...utils.newman import DidNotRunException, NewmanManager, NewmanRunner
 
 
 def get_object(r):
@@ -127,3 +145,277 @@ class TestNoAssertion(WebTest):
         }), headers=self.get_user_key())
         call = call.json
         self.assertEqual(call['status'], 'stopped')
+
+
+class TestShield(WebTest):
+
+    def setUp(self):
+        self.server_run = ServerRunFactory()
+        self.postman_test = PostmanTestFactory(test_scenario=self.server_run.test_scenario)
+        self.url = reverse('apiv1server:api_server-run-shield', kwargs={'uuid': self.server_run.uuid})
+
+    def test_conditional_get(self):
+        call = self.app.get(self.url)
+        self.assertEqual(call.json['message'], 'No results')
+        etag = call.headers['ETag']
+        call = self.app.get(self.url, headers={'If-None-Match': etag}, status=304)
+        self.assertEqual(call.headers['ETag'], etag)
+
+    def test_invalidation(self):
+        etag = self.app.get(self.url).headers['ETag']
+        ptr = PostmanTestResult.objects.create(
+            postman_test=self.postman_test, server_run=self.server_run, status=ResultChoices.failed
+        )
+        call = self.app.get(self.url, headers={'If-None-Match': etag})
+        self.assertEqual(call.json['message'], 'Failed')
+        ptr.status = ResultChoices.success
+        ptr.save()
+        self.assertEqual(self.app.get(self.url).json['message'], 'Success')
+
+
+class TestParallelRun(WebTest):
+
+    def setUp(self):
+        self.server_run = ServerRunFactory()
+        self.server_run.test_scenario.authorization = choices.AuthenticationChoices.no_auth
+        self.server_run.test_scenario.save()
+        self.postman_tests = [PostmanTestFactory(test_scenario=self.server_run.test_scenario) for i in range(3)]
+        # the first collection is the slowest
+        self.delays = {pt.validation_file.pk: 0.3 - i * 0.1 for i, pt in enumerate(self.postman_tests)}
+
+    def execute_reports(self, nm):
+        time.sleep(self.delays[nm.file.pk])
+        reports = []
+        for content in ['<html></html>', json.dumps({'run': {'failures': [], 'executions': []}})]:
+            report = tempfile.NamedTemporaryFile(mode='w+')
+            report.write(content)
+            report.seek(0)
+            reports.append(report)
+        return reports
+
+    @override_settings(NEWMAN_WORKERS=3)
+    def test_parallel_collections(self):
+        with mock.patch.object(NewmanManager, 'execute_reports', autospec=True, side_effect=self.execute_reports) as run:
+            start = time.monotonic()
+            self.assertFalse(execute_test(self.server_run.pk))
+            elapsed = time.monotonic() - start
+
+        # one run of Newman per collection, at the same time
+        self.assertEqual(run.call_count, 3)
+        self.assertLess(elapsed, sum(self.delays.values()))
+        results = list(PostmanTestResult.objects.filter(server_run=self.server_run).order_by('pk'))
+        self.assertEqual([ptr.postman_test for ptr in results], self.postman_tests)
+        for ptr in results:
+            self.assertEqual(ptr.status, ResultChoices.success)
+            self.assertGreaterEqual(ptr.duration, self.delays[ptr.postman_test.validation_file.pk])
+
+
+# body of the response of a call, as written by the json reporter of Newman
+def stream(content):
+    return {'type': 'Buffer', 'data': list(json.dumps(content).encode('utf-8'))}
+
+
+class TestJsonReport(WebTest):
+
+    def setUp(self):
+        server_run = ServerRunFactory()
+        self.ptr = PostmanTestResult.objects.create(
+            postman_test=PostmanTestFactory(test_scenario=server_run.test_scenario), server_run=server_run
+        )
+        self.report = {
+            'collection': {'info': {'name': 'collection'}},
+            'run': {
+                'timings': {'started': 1564740000000},
+                'executions': [
+                    {
+                        'item': {'name': 'list'},
+                        'request': {'method': 'GET', 'url': {'protocol': 'https', 'host': ['example', 'com'], 'path': ['zaken']}},
+                        'response': {'code': 200, 'stream': stream({'count': 0})},
+                        'assertions': [{'assertion': 'status'}, {'assertion': 'body'}],
+                    },
+                    {
+                        'item': {'name': 'create'},
+                        'request': {'method': 'POST', 'url': {'protocol': 'https', 'host': ['example', 'com'], 'path': ['zaken']}},
+                        'response': {'code': 201, 'stream': stream({'url': 'https://example.com/zaken/1'})},
+                        'assertions': [{'assertion': 'status'}, {'assertion': 'body', 'error': {'message': 'invalid'}}],
+                    },
+                ],
+                'failures': [],
+            },
+        }
+
+    def save_json(self, report):
+        with tempfile.NamedTemporaryFile('w+', suffix='.json') as report_file:
+            json.dump(report, report_file)
+            report_file.flush()
+            self.ptr.save_json('report', File(report_file))
+
+    @override_settings(POSTMAN_CALL_BATCH_SIZE=1)
+    def test_calls(self):
+        self.save_json(self.report)
+
+        self.assertEqual(self.ptr.status, ResultChoices.failed)
+        self.assertEqual(self.ptr.get_outcome_json(), ResultChoices.failed)
+        self.assertEqual(self.ptr.get_call_results_list(), [True, False])
+        self.assertEqual(self.ptr.get_aggregate_results(), {
+            'assertions': {'passed': 3, 'failed': 1, 'total': 4},
+            'calls': {'success': 1, 'failed': 1, 'total': 2},
+        })
+        calls = self.ptr.get_json_obj()
+        self.assertEqual(calls[0]['request']['url']['url'], 'https://example.com/zaken')
+        self.assertEqual(calls[1]['response']['body'], {'url': 'https://example.com/zaken/1'})
+        self.assertTrue(calls[1]['item']['error_test'])
+        # the stored report holds the decoded responses
+        with open(self.ptr.log_json.path) as in_file:
+            self.assertEqual(json.load(in_file)['run']['executions'], calls)
+        self.assertEqual(self.ptr.get_json_obj_info()['collection'], self.report['collection'])
+
+    def test_backfill_calls(self):
+        self.save_json(self.report)
+        # a report stored before its calls
+        self.ptr.postmantestcall_set.all().delete()
+        call_command('backfill_postman_calls', stdout=StringIO())
+        self.assertEqual(self.ptr.get_call_results_list(), [True, False])
+        self.assertEqual(self.ptr.get_json_obj()[1]['response']['body'], {'url': 'https://example.com/zaken/1'})
+        # the reports with calls are left alone
+        call_command('backfill_postman_calls', stdout=StringIO())
+        self.assertEqual(self.ptr.postmantestcall_set.count(), 2)
+
+    def test_failures(self):
+        for execution in self.report['run']['executions']:
+            execution['assertions'] = [{'assertion': 'status'}]
+        self.save_json(self.report)
+        self.assertEqual(self.ptr.status, ResultChoices.success)
+
+        self.report['run']['failures'] = [{'error': {'message': 'script error'}}]
+        self.save_json(self.report)
+        self.assertEqual(self.ptr.status, ResultChoices.failed)
+        # the calls of the previous report are replaced
+        self.assertEqual(self.ptr.postmantestcall_set.count(), 2)
+
+
+class TestScheduledRuns(WebTest):
+
+    def setUp(self):
+        self.users = [UserFactory(), UserFactory()]
+        self.server_runs = []
+        for user in self.users:
+            for host in ['a.example.com', 'b.example.com']:
+                server_run = ServerRunFactory(
+                    user=user, scheduled=True, status=choices.StatusWithScheduledChoices.scheduled
+                )
+                Endpoint.objects.create(
+                    server_run=server_run, url='https://{}/api/v1'.format(host),
+                    test_scenario_url=TestScenarioUrlFactory(test_scenario=server_run.test_scenario)
+                )
+                self.server_runs.append(server_run)
+        # only the last run of the second user fails
+        self.failures = {sr.pk: sr == self.server_runs[-1] for sr in self.server_runs}
+        self.addCleanup(cache.clear)
+
+    def execute_test(self, server_run_pk, scheduled=False):
+        self.assertTrue(scheduled)
+        self.assertEqual(ServerRun.objects.get(pk=server_run_pk).status, choices.StatusWithScheduledChoices.running)
+        return self.failures[server_run_pk]
+
+    def test_fan_out(self):
+        with mock.patch('vng.servervalidation.task.execute_test', side_effect=self.execute_test) as run:
+            execute_test_scheduled()
+
+        self.assertEqual(sorted(call[0][0] for call in run.call_args_list), sorted(self.failures))
+        # a single email, to the user with a failed run
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, [self.users[1].email])
+
+    @override_settings(SERVER_RUN_HOST_CONCURRENCY=2)
+    def test_host_slots(self):
+        first = acquire_host_slots(['a.example.com', 'b.example.com'])
+        second = acquire_host_slots(['a.example.com'])
+        self.assertEqual(len(first), 2)
+        # both slots of the host are taken
+        self.assertIsNone(acquire_host_slots(['b.example.com', 'a.example.com']))
+        # the slot of the other host was given back
+        self.assertIsNotNone(acquire_host_slots(['b.example.com']))
+        release_host_slots(second)
+        self.assertIsNotNone(acquire_host_slots(['a.example.com']))
+
+    def test_cache_unavailable(self):
+        # the cache ignoring its errors neither stores nor returns anything
+        with mock.patch('vng.servervalidation.task.cache') as mock_cache:
+            mock_cache.add.return_value = None
+            mock_cache.get.return_value = None
+            self.assertEqual(acquire_host_slots(['a.example.com', 'b.example.com']), [])
+
+    def test_busy_hosts(self):
+        with mock.patch('vng.servervalidation.task.acquire_host_slots', return_value=None) as acquire, \
+                mock.patch('vng.servervalidation.task.execute_test', return_value=False) as run, \
+                mock.patch.object(execute_scheduled_run, 'max_retries', 2):
+            execute_scheduled_run.delay(self.server_runs[0].pk)
+        # started anyway once the retries are exhausted
+        self.assertEqual(acquire.call_count, 3)
+        run.assert_called_once_with(self.server_runs[0].pk, scheduled=True)
+
+
+# speaks the protocol of bin/newman_runner.js, the reports hold the globals of the run
+FAKE_RUNNER = """
+import json, sys, time
+for line in sys.stdin:
+    run = json.loads(line)
+    print('log of a reporter')
+    if run['collection'] == 'slow':
+        time.sleep(0.5)
+    if run['collection'] == 'missing':
+        print(json.dumps({'id': run['id'], 'error': 'collection not found'}), flush=True)
+        continue
+    for path in (run['html'], run['json']):
+        with open(path, 'w') as out_file:
+            json.dump(run['globals'], out_file)
+    print(json.dumps({'id': run['id'], 'error': None}), flush=True)
+"""
+
+
+class TestNewmanRunner(WebTest):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        script = os.path.join(self.folder, 'runner.py')
+        with open(script, 'w') as out_file:
+            out_file.write(FAKE_RUNNER)
+        override = override_settings(NEWMAN_NODE=sys.executable, NEWMAN_RUNNER_SCRIPT=script, NEWMAN_RUN_TIMEOUT=10)
+        override.enable()
+        self.addCleanup(override.disable)
+        self.runner = NewmanRunner()
+        self.addCleanup(self.runner.stop)
+
+    def run_collection(self, collection, global_vars):
+        html, json_export = os.path.join(self.folder, 'report.html'), os.path.join(self.folder, 'report.json')
+        self.runner.run(collection, global_vars, html, json_export)
+        with open(json_export) as in_file:
+            return json.load(in_file)
+
+    def test_run(self):
+        global_vars = {'TOKEN': 'Bearer "a b"', 'url': 'https://example.com/api?x=1&y=2'}
+        self.assertEqual(self.run_collection('collection.json', global_vars), global_vars)
+        process = self.runner.process
+        self.run_collection('collection.json', {})
+        # the process is reused
+        self.assertIs(self.runner.process, process)
+
+    def test_error(self):
+        with self.assertRaises(DidNotRunException):
+            self.run_collection('missing', {})
+        self.assertEqual(self.run_collection('collection.json', {'a': '1'}), {'a': '1'})
+
+    def test_timeout(self):
+        with override_settings(NEWMAN_RUN_TIMEOUT=0.1):
+            with self.assertRaises(DidNotRunException):
+                self.run_collection('slow', {})
+        self.assertEqual(self.runner.pending, {})
+        # the outcome of the timed out run is ignored
+        self.assertEqual(self.run_collection('collection.json', {'a': '1'}), {'a': '1'})
+
+    def test_restart(self):
+        self.run_collection('collection.json', {})
+        self.runner.process.kill()
+        self.runner.process.wait()
+        self.assertEqual(self.run_collection('collection.json', {'a': '1'}), {'a': '1'})
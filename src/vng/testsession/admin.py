@@ -51,7 +51,8 @@ class SessionTypeAdmin(admin.ModelAdmin):
         'version',
         'header',
         'db_data',
-        'active'
+        'active',
+        'warm_pool_size',
     ]
     list_filter = ['name']
     search_fields = ['name']
@@ -79,6 +80,23 @@ class SessionAdmin(admin.ModelAdmin):
     inlines = [ExposedUrlInline]
 
 
+@admin.register(model.WarmEnvironment)
+class WarmEnvironmentAdmin(admin.ModelAdmin):
+    list_display = [
+        'name',
+        'session_type',
+        'status',
+        'docker_url',
+        'created',
+        'ready',
+        'claimed',
+        'session',
+        'deploy_status',
+    ]
+    list_filter = ['session_type', 'status']
+    search_fields = ['name', 'session__name']
+
+
 @admin.register(model.SessionLog)
 class SessionLogAdmin(admin.ModelAdmin):
     date_hierarchy = 'date'
@@ -124,6 +142,7 @@ class VNGEndpointAdmin(admin.ModelAdmin):
         'session_type',
         'port',
         'test_file',
+        'streaming',
     ]
     inlines = [ScenarioCaseInline]
 
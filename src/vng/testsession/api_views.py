@@ -1,18 +1,15 @@
+import codecs
+import hashlib
 import json
-import re
 import logging
-import requests
 
-from urllib import parse
-from zds_client import ClientAuth
-from subdomains.utils import reverse as reverse_sub
 from django.shortcuts import get_object_or_404
 from django.views import View
 from django.utils import timezone
-from django.db.models import Count
 from django.core.exceptions import PermissionDenied
+from django.conf import settings
 from django.http import (
-    Http404, HttpResponse, HttpResponseForbidden, JsonResponse
+    Http404, HttpResponse, HttpResponseForbidden, JsonResponse, StreamingHttpResponse
 )
 
 from rest_framework import generics, permissions, viewsets, views, mixins
@@ -20,38 +17,30 @@ from rest_framework.authentication import (
     SessionAuthentication, TokenAuthentication
 )
 from .models import (
-    ScenarioCase, Session, SessionLog, SessionType, ExposedUrl, Report,
-    QueryParamsScenario, InjectHeader
+    ScenarioCase, Session, SessionLog, SessionType, ExposedUrl, Report
 )
 
-from ..utils import choices
+from ..utils import choices, http_pool
+from ..utils.auth import get_jwt
+from ..utils.badges import badge_response
 from ..utils.views import CSRFExemptMixin
 
+from . import log_pipeline
 from .permission import IsOwner
 from .serializers import (
     SessionSerializer, SessionTypesSerializer, ExposedUrlSerializer, ScenarioCaseSerializer,
     SessionStatusSerializer
 )
+from .matcher import get_matcher
+from .results import SessionResult
+from .rewriter import UrlRewriter, get_rewriter, url_pair
+from .routing import get_routing
 from .views import bootstrap_session
 from .task import run_tests, stop_session
 
 logger = logging.getLogger(__name__)
 
 
-def get_jwt(session):
-
-    return ClientAuth(
-        client_id=session.client_id,
-        secret=session.secret,
-        scopes=['zds.scopes.zaken.lezen',
-                'zds.scopes.zaaktypes.lezen',
-                'zds.scopes.zaken.aanmaken',
-                'zds.scopes.statussen.toevoegen',
-                'zds.scopes.zaken.bijwerken'],
-        zaaktypes=['*']
-    )
-
-
 class SessionViewStatusSet(
         mixins.RetrieveModelMixin,
         viewsets.GenericViewSet):
@@ -119,7 +108,7 @@ class StopSessionView(generics.ListAPIView):
             return
         stop_session.delay(session.pk)
         session.status = choices.StatusChoices.shutting_down
-        session.save()
+        session.save(update_fields=['status'])
         run_tests.delay(session.pk)
 
     def get_queryset(self):
@@ -141,45 +130,16 @@ class ResultSessionView(views.APIView):
     permission_classes = (permissions.IsAuthenticated,)
 
     def get(self, request, pk, *args, **kwargs):
-        res = None
         session = self.get_object()
         if session.user != request.user:
             raise PermissionDenied
-        scenario_cases = ScenarioCase.objects.filter(vng_endpoint__session_type=session.session_type)
-        report = list(Report.objects.filter(session_log__session=session))
-
-        def check(scenario_cases, report):
-            if len(report) == 0:
-                return {'result': 'Geen oproep uitgevoerd'}
-            for rp in report:
-                if rp.result == choices.HTTPCallChoices.failed:
-                    return {'result': 'mislukt'}
-            if len(report) < len(scenario_cases):
-                return {'result': 'Gedeeltelijk succesvol'}
-            else:
-                return {'result': 'Succesvol'}
-
-        if len(scenario_cases) == 0:
-            res = {'result': 'No scenario cases available'}
-        else:
-            res = check(scenario_cases, report)
-
-        res['report'] = []
-        for case in scenario_cases:
-            is_in = False
-            for rp in report:
-                if rp.scenario_case == case:
-                    is_in = True
-                    break
-            if not is_in:
-                report.append(Report(scenario_case=case))
-
-        for rp in report:
-            call = {
-                'scenario_case': ScenarioCaseSerializer(rp.scenario_case).data
-            }
-            call['result'] = rp.result
-            res['report'].append(call)
+        result = SessionResult(session)
+        res = {'result': result.outcome(), 'report': []}
+        for rp in result.all_reports():
+            res['report'].append({
+                'scenario_case': ScenarioCaseSerializer(rp.scenario_case).data,
+                'result': rp.result
+            })
 
         res['test_session_url'] = session.get_absolute_request_url(request)
         response = HttpResponse(json.dumps(res))
@@ -224,44 +184,24 @@ class ExposedUrlView(mixins.ListModelMixin, viewsets.GenericViewSet):
 
 class RunTest(CSRFExemptMixin, View):
     """ Proxy-view between clients and servers """
-    error_codes = [(400, 599)]  # boundaries considered as errors
+    error_codes = log_pipeline.ERROR_CODES
+    textual_content_types = ['json', 'text', 'xml', 'javascript']
+    streaming_headers = ['Content-type', 'location', 'Content-Disposition']
 
-    def get_queryset(self):
-        return get_object_or_404(ExposedUrl, subdomain=self.request.subdomain).session
+    def get_routing(self):
+        if not hasattr(self, 'routing'):
+            self.routing = get_routing(self.request.subdomain)
+        return self.routing
 
-    def match_url(self, url, compare, query_params):
-        '''
-        Return True if the url matches the compare url.
-        The compare url contains the parameter matching group {param}
-        '''
-        # casting of the reference url into a regex
-        param_pattern = '{[^/]+}'
-        any_c = '[^/]+'
-        parsed_url = '( |/)*' + re.sub(param_pattern, any_c, compare)
-        if len(query_params) == 0:
-            parsed_url += '$'
-        else:
-            parsed_url += '?'
-        check_url = url.replace('/api/v1//', '/api/v1/')
-        logger.info("Parsed: %s", parsed_url)
-        logger.info("URL: %s", check_url)
-        if re.search(parsed_url, check_url) is not None:
-            if self.request.method == 'POST':
-                params = self.request.POST
-            else:
-                params = self.request.GET
-            for qp in query_params:
-                par = params.get(qp.name)
-                if par is None or (qp.expected_value != '*' and qp.expected_value != par):
-                    return False
-            return True
+    def get_queryset(self):
+        return self.get_routing().session
 
     def get_http_header(self, request, endpoint, session):
         '''
         Extracts the http header from the request and add the authorization header for
         gemma platform
         '''
-        whitelist = ['host', 'cookie', 'content-length']
+        whitelist = ['host', 'cookie', 'content-length', 'connection', 'keep-alive']
         request_headers = {}
         for header, value in request.headers.items():
             if header.lower() not in whitelist:
@@ -276,44 +216,27 @@ class RunTest(CSRFExemptMixin, View):
             request_headers['authorization'] = session.session_type.header
 
         # inject the eventual headers
-        to_inject = InjectHeader.objects.filter(session_type=session.session_type)
-        for header in to_inject:
-            request_headers[header.key] = header.value
+        for key, value in self.get_routing().inject_headers:
+            request_headers[key] = value
 
         return request_headers
 
     def save_call(self, request, request_method_name, url, relative_url, session, status_code, session_log):
         '''
         Find the matching scenario case with the same url and method, if one match is found,
-        the result of the call is overrided
+        the result of the call is overrided.
+        The log and the report are written asynchronously by the log pipeline.
         '''
         logger.info("Saving call")
         logger.info(request_method_name)
         logger.info(url)
         logger.info(relative_url)
-        scenario_cases = ScenarioCase.objects.filter(vng_endpoint__session_type=session.session_type).annotate(count=Count('queryparamsscenario')).order_by('-count')
-        for case in scenario_cases:
-            logger.info(case)
-            if case.http_method.lower() == request_method_name.lower():
-                if self.match_url(request.build_absolute_uri(), case.url, QueryParamsScenario.objects.filter(scenario_case=case)):
-                    pre_exist = Report.objects.filter(scenario_case=case).filter(session_log__session=session)
-                    if len(pre_exist) == 0:
-                        report = Report(scenario_case=case, session_log=session_log)
-                    else:
-                        report = pre_exist[0]
-                    is_failed = False
-                    for a, b in self.error_codes:
-                        if status_code >= a and status_code <= b:
-                            report.result = choices.HTTPCallChoices.failed
-                            report.session_log = session_log
-                            is_failed = True
-                            break
-                    if not is_failed and not report.is_failed() or (session.sandbox and not is_failed):
-                        report.session_log = session_log
-                        report.result = choices.HTTPCallChoices.success
-                    logger.info("Saving report: %s", report.result)
-                    report.save()
-                    break
+        if request.method == 'POST':
+            params = request.POST
+        else:
+            params = request.GET
+        case = get_matcher(session.session_type_id).match(request_method_name, request.build_absolute_uri(), params)
+        log_pipeline.enqueue(session_log, case, status_code, session.sandbox)
 
     def sub_url_response(self, content, host, endpoint):
         '''
@@ -327,25 +250,7 @@ class RunTest(CSRFExemptMixin, View):
         Returns:
             Str -- The body after the rewrite
         '''
-
-        sub = host
-        if endpoint.vng_endpoint.url is not None:
-            if not endpoint.vng_endpoint.url.endswith('/'):
-                if sub.endswith('/'):
-                    sub = sub[:-1]
-            else:
-                if not sub.endswith('/'):
-                    sub = sub + '/'
-            return re.sub(endpoint.vng_endpoint.url, sub, content)
-        else:
-            query = parse.urlparse(sub)
-            if not sub.endswith('/'):
-                sub = sub + '/'
-            return re.sub(
-                '{}://{}:{}/'.format(query.scheme, endpoint.docker_url, endpoint.port),
-                sub,
-                content
-            )
+        return UrlRewriter([url_pair(host, endpoint)]).rewrite(content)
 
     def sub_url_request(self, content, host, endpoint):
         '''
@@ -359,24 +264,8 @@ class RunTest(CSRFExemptMixin, View):
         Returns:
             Str -- The body after the rewrite
         '''
-        sub = host
-        if endpoint.vng_endpoint.url is not None:
-            if not endpoint.vng_endpoint.url.endswith('/'):
-                if sub.endswith('/'):
-                    sub = sub[:-1]
-            else:
-                if not sub.endswith('/'):
-                    sub = sub + '/'
-            return re.sub(sub, endpoint.vng_endpoint.url, content)
-        else:
-            query = parse.urlparse(sub)
-            if not sub.endswith('/'):
-                sub = sub + '/'
-            return re.sub(
-                sub,
-                '{}://{}:{}/'.format(query.scheme, endpoint.docker_url, endpoint.port),
-                content
-            )
+        source, target = url_pair(host, endpoint)
+        return UrlRewriter([(target, source)]).rewrite(content)
 
     def parse_response(self, response, request, base_url, endpoints):
         """
@@ -385,22 +274,12 @@ class RunTest(CSRFExemptMixin, View):
         ->
         https://testplatform/runtest/XXXX/api/v1/zaken/123
         """
-        parsed = response.text
-        for ep in endpoints:
-            host = reverse_sub('run_test', ep.subdomain, kwargs={
-                'relative_url': ''
-            })
-            parsed = self.sub_url_response(parsed, host, ep)
-            logger.info("Rewriting response body: {}".format(parsed))
+        parsed = get_rewriter(endpoints).rewrite_response(response.text)
+        logger.info("Rewriting response body: %s", parsed)
         return parsed
 
     def parse_response_text(self, text, endpoints):
-        for ep in endpoints:
-            host = reverse_sub('run_test', ep.subdomain, kwargs={
-                'relative_url': ''
-            })
-            parsed = self.sub_url_response(text, host, ep)
-        return parsed
+        return get_rewriter(endpoints).rewrite_response(text)
 
     def rewrite_request_body(self, request, exposed):
         """
@@ -409,13 +288,8 @@ class RunTest(CSRFExemptMixin, View):
         ->
         https://ref.tst.vng.cloud/zrc/api/v1/zaken/123
         """
-        parsed = request.body.decode('utf-8')
-        for eu in exposed:
-            host = reverse_sub('run_test', eu.subdomain, kwargs={
-                'relative_url': ''
-            })
-            parsed = self.sub_url_request(parsed, host, eu)
-        logger.info("Rewriting request body:{}".format(parsed))
+        parsed = get_rewriter(exposed).rewrite_request(request.body.decode('utf-8'))
+        logger.info("Rewriting request body:%s", parsed)
         return parsed
 
     def build_url(self, eu, arguments):
@@ -429,26 +303,29 @@ class RunTest(CSRFExemptMixin, View):
         return request_url
 
     def build_method(self, request_method_name, request, body=False):
-        self.session = self.get_queryset()
-        eu = get_object_or_404(ExposedUrl, session=self.session, subdomain=request.subdomain)
+        routing = self.get_routing()
+        self.session = routing.session
+        eu = routing.exposed_url
         request_header = self.get_http_header(request, eu.vng_endpoint, self.session)
         session_log, session = self.build_session_log(request, request_header)
         if session.is_stopped():
             raise Http404()
-        endpoints = ExposedUrl.objects.filter(session=session)
+        endpoints = routing.endpoints
         arguments = request.META['QUERY_STRING']
 
         request_url = self.build_url(eu, arguments)
         logger.info('Requesting the url:{}'.format(request_url))
-        method = getattr(requests, request_method_name)
+        stream = eu.vng_endpoint.streaming
 
         def make_call():
             if body:
                 rewritten_body = self.rewrite_request_body(request, endpoints)
                 logger.info("Request body after rewrite: %s", rewritten_body)
-                response = method(request_url, data=rewritten_body, headers=request_header, allow_redirects=False)
+                response = http_pool.request(request_method_name, request_url, data=rewritten_body,
+                                             headers=request_header, allow_redirects=False, stream=stream)
             else:
-                response = method(request_url, headers=request_header, allow_redirects=False)
+                response = http_pool.request(request_method_name, request_url, headers=request_header,
+                                             allow_redirects=False, stream=stream)
             return response
         try:
             response = make_call()
@@ -460,25 +337,83 @@ class RunTest(CSRFExemptMixin, View):
                 logger.exception(e)
                 raise Http404()
 
+        if stream:
+            return self.build_streaming_reply(response, session_log, request_url, request,
+                                              request_method_name, session, endpoints)
+
         self.add_response(response, session_log, request_url, request)
 
         self.save_call(request, request_method_name, request.subdomain,
                        self.kwargs['relative_url'], session, response.status_code, session_log)
         reply = HttpResponse(self.parse_response(response, request, eu.vng_endpoint.url, endpoints), status=response.status_code)
-        white_headers = ['Content-type', 'location']
+        return self.copy_headers(response, reply, ['Content-type', 'location'], endpoints)
+
+    def copy_headers(self, response, reply, white_headers, endpoints):
+        '''
+        Copy the whitelisted headers of the upstream response to the reply, rewriting their urls
+        '''
         for h in white_headers:
             if h in response.headers:
                 reply[h] = self.parse_response_text(response.headers[h], endpoints)
-
         return reply
 
+    def build_streaming_reply(self, response, session_log, request_url, request, request_method_name, session, endpoints):
+        '''
+        Forward the upstream response chunk by chunk. Textual bodies are rewritten
+        on the fly, the others are passed through untouched.
+        Only a bounded prefix and the digest of the body are logged, once the
+        whole body has been forwarded.
+        '''
+        content_type = response.headers.get('Content-Type', '')
+        rewrite = any(t in content_type for t in self.textual_content_types)
+        encoding = response.encoding or 'utf-8'
+        rewriter = get_rewriter(endpoints)
+        digest = hashlib.sha256()
+        prefix = bytearray()
+        size = 0
+
+        def upstream_chunks():
+            nonlocal size
+            for chunk in response.iter_content(chunk_size=settings.PROXY_STREAM_CHUNK_SIZE):
+                digest.update(chunk)
+                size += len(chunk)
+                if len(prefix) < settings.PROXY_STREAM_LOG_PREFIX:
+                    prefix.extend(chunk[:settings.PROXY_STREAM_LOG_PREFIX - len(prefix)])
+                yield chunk
+
+        def body():
+            try:
+                if rewrite:
+                    decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+                    text_chunks = (decoder.decode(chunk) for chunk in upstream_chunks())
+                    for text in rewriter.rewrite_response_stream(text_chunks):
+                        yield text.encode(encoding)
+                    tail = decoder.decode(b'', final=True)
+                    if tail:
+                        yield rewriter.rewrite_response(tail).encode(encoding)
+                else:
+                    yield from upstream_chunks()
+            finally:
+                response.close()
+                self.add_response(response, session_log, request_url, request,
+                                  body=bytes(prefix).decode(encoding, errors='replace'),
+                                  body_size=size, body_sha256=digest.hexdigest())
+                self.save_call(request, request_method_name, request.subdomain,
+                               self.kwargs['relative_url'], session, response.status_code, session_log)
+
+        reply = StreamingHttpResponse(body(), status=response.status_code)
+        return self.copy_headers(response, reply, self.streaming_headers, endpoints)
+
     def build_method_handler(self, request_method_name, request, body=False):
         try:
             return self.build_method(request_method_name, request, body)
         except Http404:
-            return JsonResponse({
-                'info': 'The requested resource has been already turned off.'
-            })
+            return self.stopped_response()
+
+    def stopped_response(self):
+        return JsonResponse({
+            'info': 'The requested resource has been already turned off.'
+        })
 
     def get(self, request, *args, **kwargs):
         return self.build_method_handler('get', request)
@@ -513,61 +448,35 @@ class RunTest(CSRFExemptMixin, View):
 
         return session_log, session
 
-    def add_response(self, response, session_log, request_url, request):
+    def add_response(self, response, session_log, request_url, request, body=None, **body_info):
+        '''
+        Store the response in the session log. When the body is streamed,
+        `body` is the logged prefix and `body_info` its size and digest.
+        '''
         response_dict = {
             "response": {
                 "status_code": response.status_code,
-                "body": response.text,
+                "body": response.text if body is None else body,
                 "path": "{} {}".format(request.method, request_url),
+                **body_info
             }
         }
         session_log.response_status = response.status_code
         session_log.response = json.dumps(response_dict)
-        session_log.save()
 
 
 class ResultTestsessionViewShield(views.APIView):
 
     def get(self, request, uuid=None):
-        session = get_object_or_404(Session, uuid=uuid)
-        scenario_case = ScenarioCase.objects.filter(vng_endpoint__session_type=session.session_type)
-        report = list(Report.objects.filter(session_log__session=session))
-        report_ordered = []
-        is_error = False
-        not_full = False
-
-        for case in scenario_case:
-            missing = False
-            for rp in report:
-                if rp.result == choices.HTTPCallChoices.failed:
-                    is_error = True
-                if rp.scenario_case == case and rp.result != choices.HTTPCallChoices.not_called:
-                    report_ordered.append(rp)
-                    missing = True
-                    break
-            if not missing:
-                not_full = True
-
-        if not scenario_case:
-            message = 'No results'
-            color = 'inactive'
-        elif is_error:
-            message = 'Failed'
-            color = 'red'
-        elif not_full:
-            message = 'Not completed'
-            color = 'orange'
-        else:
-            message = 'Success'
-            color = 'green'
-            is_error = False
-
-        result = {
-            'schemaVersion': 1,
-            'label': 'API Test Platform',
-            'message': message,
-            'color': color,
-            'isError': is_error,
-        }
+        def build():
+            session = get_object_or_404(Session, uuid=uuid)
+            message, color, is_error = SessionResult(session).shield()
+            return {
+                'schemaVersion': 1,
+                'label': 'API Test Platform',
+                'message': message,
+                'color': color,
+                'isError': is_error,
+            }
 
-        return JsonResponse(result)
+        return badge_response(request, 'session', uuid, build)
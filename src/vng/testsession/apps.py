@@ -5,4 +5,4 @@ class TestsessionConfig(AppConfig):
     name = 'vng.testsession'
 
     def ready(self):
-        pass
+        from . import signals  # noqa
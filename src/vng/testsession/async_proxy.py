@@ -0,0 +1,381 @@
+import asyncio
+import codecs
+import hashlib
+import logging
+from io import BytesIO
+
+import aiohttp
+from asgiref.sync import sync_to_async
+
+from django.conf import settings
+from django.core.exceptions import DisallowedHost
+from django.core.handlers.wsgi import WSGIRequest
+from django.db import close_old_connections
+from django.http import Http404, HttpResponse
+from django.urls import Resolver404, resolve
+from django.utils.module_loading import import_string
+
+from .api_views import RunTest
+from .rewriter import StreamRewriter, get_rewriter
+
+logger = logging.getLogger(__name__)
+
+SUBDOMAIN_MIDDLEWARE = 'subdomains.middleware.SubdomainURLRoutingMiddleware'
+# Middleware of the application also applied to the proxied calls, for the
+# redirection to HTTPS and the security headers of the replies. The others
+# are skipped: the sessions, the authentication, the messages and CSRF are
+# not used by the proxy-view, the replies are those of the services so the
+# language is not activated (LocaleMiddleware), the urls are already resolved
+# (CommonMiddleware) and the calls are not traced by Elastic APM.
+PROXY_MIDDLEWARE = [
+    'django.middleware.security.SecurityMiddleware',
+    'django.middleware.clickjacking.XFrameOptionsMiddleware',
+]
+UPSTREAM_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError)
+
+_client = None
+_client_loop = None
+_subdomain_middleware = None
+_proxy_middleware = None
+
+
+def run_sync(func):
+    '''
+    Return a coroutine function running `func` in a worker thread, with the
+    database connections handled as in a request cycle.
+    '''
+    def wrapper(*args, **kwargs):
+        close_old_connections()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            close_old_connections()
+    return sync_to_async(wrapper)
+
+
+def get_client():
+    '''
+    Return the HTTP client of the running event loop. Its connector keeps the
+    connections to the upstream services alive between the calls.
+    '''
+    global _client, _client_loop
+    loop = asyncio.get_event_loop()
+    if _client is None or _client.closed or _client_loop is not loop:
+        connector = aiohttp.TCPConnector(
+            limit=0,
+            limit_per_host=settings.PROXY_POOL_MAXSIZE if settings.PROXY_POOL_BLOCK else 0
+        )
+        timeout = aiohttp.ClientTimeout(
+            sock_connect=settings.PROXY_CONNECT_TIMEOUT,
+            sock_read=settings.PROXY_READ_TIMEOUT
+        )
+        _client = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        _client_loop = loop
+    return _client
+
+
+async def close_client():
+    global _client
+    if _client is not None and not _client.closed:
+        await _client.close()
+    _client = None
+
+
+def build_environ(scope, body=None):
+    '''
+    Return the WSGI environ of an ASGI http scope, without a body when it is
+    not read yet
+    '''
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': scope['path'],
+        'QUERY_STRING': scope['query_string'].decode('ascii'),
+        'SERVER_PROTOCOL': 'HTTP/{}'.format(scope['http_version']),
+        'SERVER_NAME': scope['server'][0] if scope.get('server') else 'localhost',
+        'SERVER_PORT': str(scope['server'][1]) if scope.get('server') else '80',
+        'REMOTE_ADDR': scope['client'][0] if scope.get('client') else '',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': BytesIO(body or b''),
+        'wsgi.errors': BytesIO(),
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin1')
+        if name == 'content-length':
+            key = 'CONTENT_LENGTH'
+        elif name == 'content-type':
+            key = 'CONTENT_TYPE'
+        else:
+            key = 'HTTP_{}'.format(name.upper().replace('-', '_'))
+        value = value.decode('latin1')
+        if key in environ:
+            value = environ[key] + ',' + value
+        environ[key] = value
+    if body is not None:
+        # the body has been read completely, also when it was sent chunked
+        environ['CONTENT_LENGTH'] = str(len(body))
+    return environ
+
+
+def get_proxy_middleware():
+    global _proxy_middleware
+    if _proxy_middleware is None:
+        _proxy_middleware = [import_string(path)(lambda request: HttpResponse()) for path in PROXY_MIDDLEWARE]
+    return _proxy_middleware
+
+
+def get_proxy_request(environ):
+    '''
+    Return the request and the url match of a call to an exposed url,
+    None when the request has to be served by the Django application.
+    The subdomain is resolved by the same middleware as in the application.
+    '''
+    global _subdomain_middleware
+    if _subdomain_middleware is None:
+        _subdomain_middleware = import_string(SUBDOMAIN_MIDDLEWARE)(lambda request: HttpResponse())
+    request = WSGIRequest(environ)
+    try:
+        _subdomain_middleware(request)
+    except DisallowedHost:
+        return None
+    try:
+        match = resolve(request.path_info, urlconf=getattr(request, 'urlconf', None))
+    except Resolver404:
+        return None
+    if getattr(match.func, 'view_class', None) is not RunTest:
+        return None
+    if request.method.lower() not in AsyncRunTest.proxied_methods:
+        return None
+    for middleware in get_proxy_middleware():
+        if hasattr(middleware, 'process_request') and middleware.process_request(request) is not None:
+            # e.g. redirected to HTTPS, the application gives the same response
+            return None
+    return request, match
+
+
+def response_headers(reply):
+    return [(key.encode('latin1'), value.encode('latin1')) for key, value in reply.items()]
+
+
+async def send_response(send, reply):
+    if not reply.has_header('Content-Length'):
+        reply['Content-Length'] = str(len(reply.content))
+    await send({
+        'type': 'http.response.start',
+        'status': reply.status_code,
+        'headers': response_headers(reply),
+    })
+    await send({'type': 'http.response.body', 'body': reply.content})
+
+
+class UpstreamResponse:
+    '''
+    Response of the upstream service with the interface of a response of
+    requests used by the helpers of RunTest
+    '''
+
+    def __init__(self, status_code, headers, content=b'', encoding=None):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.encoding = encoding
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding or 'utf-8', errors='replace')
+
+
+class AsyncRunTest(RunTest):
+    '''
+    Asynchronous variant of the proxy-view: the call to the service is awaited
+    on the event loop, while the database work (routing, logging, matching of
+    the scenario cases) runs in a worker thread.
+    '''
+    proxied_methods = ['get', 'post', 'put', 'delete', 'patch']
+    body_methods = ['post', 'put', 'patch']
+
+    def __init__(self, request, match):
+        super().__init__()
+        self.request = request
+        self.args = match.args
+        self.kwargs = match.kwargs
+        self.method_name = request.method.lower()
+
+    def prepare(self):
+        '''
+        Build the call to the service, as the first half of RunTest.build_method
+        '''
+        request = self.request
+        routing = self.get_routing()
+        self.session = routing.session
+        self.exposed_url = routing.exposed_url
+        self.request_header = self.get_http_header(request, self.exposed_url.vng_endpoint, self.session)
+        self.session_log, session = self.build_session_log(request, self.request_header)
+        if session.is_stopped():
+            raise Http404()
+        self.endpoints = routing.endpoints
+        self.request_url = self.build_url(self.exposed_url, request.META['QUERY_STRING'])
+        logger.info('Requesting the url:{}'.format(self.request_url))
+        self.data = None
+        if self.method_name in self.body_methods:
+            rewritten_body = self.rewrite_request_body(request, self.endpoints)
+            logger.info("Request body after rewrite: %s", rewritten_body)
+            self.data = rewritten_body.encode('utf-8')
+        self.stream = self.exposed_url.vng_endpoint.streaming
+
+    def finish(self, response):
+        '''
+        Log the call and build the reply, as the second half of RunTest.build_method
+        '''
+        self.add_response(response, self.session_log, self.request_url, self.request)
+        self.save_call(self.request, self.method_name, self.request.subdomain,
+                       self.kwargs['relative_url'], self.session, response.status_code, self.session_log)
+        reply = HttpResponse(self.parse_response(response, self.request, None, self.endpoints),
+                             status=response.status_code)
+        return self.copy_headers(response, reply, ['Content-type', 'location'], self.endpoints)
+
+    def process_reply(self, reply):
+        '''
+        Apply the middleware of the proxied calls to the reply, as the application would
+        '''
+        for middleware in reversed(get_proxy_middleware()):
+            reply = middleware.process_response(self.request, reply)
+        return reply
+
+    def finish_stream(self, response, prefix, size, sha256):
+        self.add_response(response, self.session_log, self.request_url, self.request,
+                          body=prefix, body_size=size, body_sha256=sha256)
+        self.save_call(self.request, self.method_name, self.request.subdomain,
+                       self.kwargs['relative_url'], self.session, response.status_code, self.session_log)
+
+    async def fetch(self):
+        '''
+        Perform the call to the service. The body is read at once, unless
+        the endpoint is streamed: then the open response is returned.
+        '''
+        response = await get_client().request(
+            self.method_name, self.request_url, data=self.data, headers=self.request_header,
+            allow_redirects=False, skip_auto_headers=['Content-Type']
+        )
+        if self.stream:
+            return response
+        try:
+            content = await response.read()
+            return UpstreamResponse(response.status, response.headers, content, response.get_encoding())
+        finally:
+            response.release()
+
+    async def call(self):
+        try:
+            return await self.fetch()
+        except UPSTREAM_ERRORS:
+            try:
+                self.request_header['Host'] = '{}:{}'.format(self.exposed_url.docker_url, self.exposed_url.port)
+                return await self.fetch()
+            except UPSTREAM_ERRORS as e:
+                logger.exception(e)
+                raise Http404()
+
+    async def handle(self, send):
+        try:
+            await run_sync(self.prepare)()
+            response = await self.call()
+        except Http404:
+            return await send_response(send, self.process_reply(self.stopped_response()))
+        if self.stream:
+            return await self.stream_reply(response, send)
+        reply = await run_sync(self.finish)(response)
+        await send_response(send, self.process_reply(reply))
+
+    async def stream_reply(self, response, send):
+        '''
+        Forward the response of the service chunk by chunk, as RunTest.build_streaming_reply
+        '''
+        content_type = response.headers.get('Content-Type', '')
+        rewrite = any(t in content_type for t in self.textual_content_types)
+        encoding = response.charset or 'utf-8'
+        decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+        rewriter = StreamRewriter(get_rewriter(self.endpoints).response)
+        digest = hashlib.sha256()
+        prefix = bytearray()
+        size = 0
+
+        reply = self.process_reply(self.copy_headers(
+            response, HttpResponse(status=response.status), self.streaming_headers, self.endpoints
+        ))
+        try:
+            await send({
+                'type': 'http.response.start',
+                'status': reply.status_code,
+                'headers': response_headers(reply),
+            })
+            async for chunk in response.content.iter_chunked(settings.PROXY_STREAM_CHUNK_SIZE):
+                digest.update(chunk)
+                size += len(chunk)
+                if len(prefix) < settings.PROXY_STREAM_LOG_PREFIX:
+                    prefix.extend(chunk[:settings.PROXY_STREAM_LOG_PREFIX - len(prefix)])
+                if rewrite:
+                    chunk = rewriter.feed(decoder.decode(chunk)).encode(encoding)
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            tail = b''
+            if rewrite:
+                tail = (rewriter.feed(decoder.decode(b'', final=True)) + rewriter.close()).encode(encoding)
+            await send({'type': 'http.response.body', 'body': tail})
+        finally:
+            response.release()
+            await run_sync(self.finish_stream)(
+                UpstreamResponse(response.status, response.headers),
+                bytes(prefix).decode(encoding, errors='replace'), size, digest.hexdigest()
+            )
+
+
+async def read_body(receive):
+    body = []
+    more_body = True
+    while more_body:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+        body.append(message.get('body', b''))
+        more_body = message.get('more_body', False)
+    return b''.join(body)
+
+
+class ProxyRouter:
+    '''
+    ASGI application serving natively the calls to the exposed urls of the
+    sessions and passing all the other requests to `application`
+    (e.g. the Django WSGI application wrapped by asgiref).
+    '''
+
+    def __init__(self, application):
+        self.application = application
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] != 'http':
+            return await self.application(scope, receive, send)
+
+        # routed on its headers, the body is only read for the calls to the
+        # exposed urls: the other requests (e.g. uploads) stream it to the application
+        if await run_sync(get_proxy_request)(build_environ(scope)) is None:
+            return await self.application(scope, receive, send)
+        body = await read_body(receive)
+        proxy = await run_sync(get_proxy_request)(build_environ(scope, body))
+        await AsyncRunTest(*proxy).handle(send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await close_client()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
@@ -0,0 +1,110 @@
+import os
+import re
+from collections import OrderedDict
+from functools import lru_cache
+
+DUMP_PATH = os.path.join(os.path.dirname(__file__), 'kubernetes/data/dump.sql')
+SNAPSHOT_FILENAME = 'snapshot.sql'
+# written by the entrypoint of the postgres image once the initdb scripts are loaded
+SEEDED_LOG = 'PostgreSQL init process complete'
+# value of the host of the preconfigured models, bound to the IP address of the session
+HOST_PLACEHOLDER = 'BASE_IP'
+
+# statements of the cluster dump failing on the role created by the postgres image
+ROLE_STATEMENTS = ('CREATE ROLE postgres;', 'ALTER ROLE postgres ')
+
+CONNECT_RE = re.compile(r'^\\connect (\S+)$')
+CREATE_TABLE_RE = re.compile(r'^CREATE TABLE (\S+) \($')
+COLUMN_RE = re.compile(r'^    (\S+) (.+?)(?: NOT NULL)?(?: DEFAULT .*)?,?$')
+COPY_RE = re.compile(r'^COPY (\S+) \((.*)\) FROM stdin;$')
+
+
+@lru_cache()
+def read_dump():
+    with open(DUMP_PATH) as in_file:
+        return in_file.read()
+
+
+@lru_cache()
+def snapshot_sql():
+    '''
+    Return the dump of the preconfigured models, loaded by the database
+    container at its initialization. The hosts keep their placeholder.
+    '''
+    return ''.join(
+        line for line in read_dump().splitlines(True)
+        if not line.startswith(ROLE_STATEMENTS)
+    )
+
+
+@lru_cache()
+def host_columns():
+    '''
+    Return the columns of the dump holding the placeholder of the host, as
+    {database: [(table, column, type)]}
+    '''
+    columns = OrderedDict()
+    database = table = None
+    types = {}
+    copied = None
+    for line in read_dump().splitlines():
+        if copied is not None:
+            if line == '\\.':
+                copied = None
+            elif HOST_PLACEHOLDER in line:
+                for name, value in zip(copied, line.split('\t')):
+                    entry = (table, name, types[table, name])
+                    if HOST_PLACEHOLDER in value and entry not in columns[database]:
+                        columns[database].append(entry)
+            continue
+        match = CONNECT_RE.match(line)
+        if match:
+            database = match.group(1)
+            columns.setdefault(database, [])
+            continue
+        match = CREATE_TABLE_RE.match(line)
+        if match:
+            table = match.group(1)
+            continue
+        if table and line == ');':
+            table = None
+            continue
+        match = COLUMN_RE.match(line)
+        if table and match:
+            types[table, match.group(1)] = match.group(2)
+            continue
+        match = COPY_RE.match(line)
+        if match:
+            table = match.group(1)
+            copied = match.group(2).split(', ')
+    return OrderedDict((database, entries) for database, entries in columns.items() if entries)
+
+
+def quote(value):
+    return "'{}'".format(value.replace("'", "''"))
+
+
+def rebind_statements(ip):
+    '''
+    Return the psql commands binding the preconfigured models of a seeded
+    database to the IP address of the session
+    '''
+    commands = []
+    for database, entries in host_columns().items():
+        commands.append('\\connect {}'.format(database))
+        for table, column, column_type in entries:
+            commands.append(
+                'UPDATE {table} SET {column} = replace({column}::text, {placeholder}, {ip})::{type} '
+                'WHERE {column}::text LIKE {pattern};'.format(
+                    table=table, column=column, type=column_type, ip=quote(ip),
+                    placeholder=quote(HOST_PLACEHOLDER), pattern=quote('%{}%'.format(HOST_PLACEHOLDER))
+                )
+            )
+    return commands
+
+
+def rebind_command(ip):
+    command = ['psql', '-U', 'postgres', '-v', 'ON_ERROR_STOP=1']
+    for statement in rebind_statements(ip):
+        command += ['-c', statement]
+    return command
@@ -0,0 +1,87 @@
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class DeployPipeline:
+    '''
+    Run the steps of the deployment of a session, the independent ones
+    concurrently in a thread pool.
+    The progress of the session follows the completed steps and the duration
+    of each step is stored in `Session.deploy_timings`.
+    The steps submitted to the pool must not use the database, the session is
+    only updated by the thread running the pipeline.
+    When the pipeline ends, the steps not started are cancelled and `cancelled`
+    is set, the waiting steps given the event stop instead of running until
+    their deadline.
+    '''
+
+    def __init__(self, session, steps, update_status):
+        self.session = session
+        self.steps = steps
+        self.completed = 0
+        self.update_status = update_status
+        self.timings = OrderedDict()
+        self.start = time.monotonic()
+        self.executor = ThreadPoolExecutor(max_workers=settings.K8S_DEPLOY_WORKERS)
+        self.futures = []
+        self.cancelled = threading.Event()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        # on success all the steps are collected, after an error the remaining ones are abandoned
+        self.cancelled.set()
+        for future in self.futures:
+            future.cancel()
+        self.executor.shutdown(wait=False)
+        self.save_timings()
+
+    def timed(self, name, func, *args, **kwargs):
+        start = time.monotonic()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.timings[name] = round(time.monotonic() - start, 3)
+
+    def submit(self, name, func, *args, **kwargs):
+        '''
+        Start the step in the pool, its result is collected with `result`
+        '''
+        future = self.executor.submit(self.timed, name, func, *args, **kwargs)
+        self.futures.append(future)
+        return future
+
+    def result(self, future, message):
+        '''
+        Wait for the submitted step and report its completion
+        '''
+        result = future.result()
+        self.done(message)
+        return result
+
+    def run(self, name, message, func, *args, **kwargs):
+        '''
+        Run the step in the current thread
+        '''
+        result = self.timed(name, func, *args, **kwargs)
+        self.done(message)
+        return result
+
+    def done(self, message):
+        self.completed += 1
+        self.update_status(self.session, message, int(self.completed * 99 / self.steps))
+
+    def save_timings(self):
+        self.timings['total'] = round(time.monotonic() - self.start, 3)
+        logger.info('Deployment of session %s: %s', self.session.name, dict(self.timings))
+        self.session.deploy_timings = json.dumps(self.timings)
+        self.session.save(update_fields=['deploy_timings'])
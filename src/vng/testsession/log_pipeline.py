@@ -0,0 +1,238 @@
+import json
+import logging
+import os
+import threading
+import uuid
+from collections import namedtuple
+
+import redis
+
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from django.utils.dateparse import parse_datetime
+
+from ..utils import choices
+from ..utils.badges import invalidate_badges
+from .models import Report, Session, SessionLog, report_counter_deltas
+
+logger = logging.getLogger(__name__)
+
+ERROR_CODES = [(400, 599)]  # boundaries considered as errors
+
+# Redis list of the calls waiting to be written, and lock of the process writing them
+QUEUE_KEY = 'session-log:queue'
+LOCK_KEY = 'session-log:flush'
+
+LogRecord = namedtuple('LogRecord', [
+    'uuid', 'session_id', 'date', 'request', 'response', 'response_status',
+    'status_code', 'scenario_case_id', 'sandbox'
+])
+
+
+def dump_record(record):
+    fields = record._asdict()
+    fields['uuid'] = str(record.uuid)
+    fields['date'] = record.date.isoformat()
+    return json.dumps(fields)
+
+
+def load_record(data):
+    fields = json.loads(data.decode('utf-8') if isinstance(data, bytes) else data)
+    fields['uuid'] = uuid.UUID(fields['uuid'])
+    fields['date'] = parse_datetime(fields['date'])
+    return LogRecord(**fields)
+
+
+def is_error(status_code):
+    for a, b in ERROR_CODES:
+        if status_code >= a and status_code <= b:
+            return True
+    return False
+
+
+def apply_call_result(report, session_log, status_code, sandbox):
+    '''
+    Override the result of the report with the outcome of the call.
+    A failed report stays failed, unless the session is in sandbox mode.
+    '''
+    if is_error(status_code):
+        report.result = choices.HTTPCallChoices.failed
+        report.session_log = session_log
+    elif not report.is_failed() or sandbox:
+        report.session_log = session_log
+        report.result = choices.HTTPCallChoices.success
+
+
+def persist(records):
+    '''
+    Write a batch of records: the session logs are bulk inserted and the
+    reports are created or updated applying the calls in their original order.
+    The calls already written, by a flush interrupted before the batch left
+    the queue, are skipped.
+    '''
+    written = set(SessionLog.objects.filter(uuid__in=[r.uuid for r in records]).values_list('uuid', flat=True))
+    records = [r for r in records if r.uuid not in written]
+    if not records:
+        return
+    logs = [
+        SessionLog(
+            uuid=r.uuid,
+            session_id=r.session_id,
+            date=r.date,
+            request=r.request,
+            response=r.response,
+            response_status=r.response_status
+        ) for r in records
+    ]
+    with transaction.atomic():
+        if connection.features.can_return_ids_from_bulk_insert:
+            SessionLog.objects.bulk_create(logs)
+        else:
+            for log in logs:
+                log.save()
+
+        matched = [(r, log) for r, log in zip(records, logs) if r.scenario_case_id is not None]
+        if not matched:
+            return
+        reports = {}
+        existing = (
+            Report.objects
+            .filter(session_log__session_id__in={r.session_id for r, _ in matched})
+            .filter(scenario_case_id__in={r.scenario_case_id for r, _ in matched})
+            .select_related('session_log')
+            .order_by('pk')
+        )
+        for report in existing:
+            reports.setdefault((report.session_log.session_id, report.scenario_case_id), report)
+
+        created, updated = [], {}
+        for record, log in matched:
+            key = (record.session_id, record.scenario_case_id)
+            report = reports.get(key)
+            if report is None:
+                report = reports[key] = Report(scenario_case_id=record.scenario_case_id, session_log=log)
+                created.append(report)
+            elif report.pk is not None:
+                updated[report.pk] = report
+            apply_call_result(report, log, record.status_code, record.sandbox)
+            logger.info("Saving report: %s", report.result)
+
+        Report.objects.bulk_create(created)
+        Report.objects.bulk_update(updated.values(), ['result', 'session_log'])
+        Session.update_report_counters(report_counter_deltas(
+            (session_id, report) for (session_id, _), report in reports.items()
+        ))
+        invalidate_badges('session', Session.objects.filter(
+            pk__in={r.session_id for r, _ in matched}
+        ).values_list('uuid', flat=True))
+
+
+class LogPipeline:
+    '''
+    Write-behind queue of the proxied calls, shared by the processes in a
+    Redis list. The calls are pushed by the processes serving the proxy and
+    written in batches by a background thread of each of them, every
+    SESSION_LOG_FLUSH_INTERVAL seconds or as soon as SESSION_LOG_BATCH_SIZE
+    calls are waiting. A single process writes at a time, holding a lock in
+    Redis, so the batches are written in the order of the calls. A batch only
+    leaves the list once written, a failed batch is written by the next flush.
+    '''
+
+    def __init__(self):
+        self.connection = None
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.pid = None
+
+    def get_connection(self):
+        if self.connection is None:
+            self.connection = redis.StrictRedis.from_url(settings.SESSION_LOG_QUEUE_URL)
+        return self.connection
+
+    def ensure_consumer(self):
+        if self.thread is not None and self.thread.is_alive() and self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive() and self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.thread = threading.Thread(target=self.consume, name='session-log-pipeline', daemon=True)
+            self.thread.start()
+
+    def enqueue(self, record):
+        if not settings.SESSION_LOG_WRITE_BEHIND:
+            persist([record])
+            return
+        try:
+            waiting = self.get_connection().rpush(QUEUE_KEY, dump_record(record))
+        except redis.RedisError as e:
+            # the call is not lost when the queue is not reachable
+            logger.warning('Session log queue unavailable: %s', e)
+            persist([record])
+            return
+        self.ensure_consumer()
+        if waiting >= settings.SESSION_LOG_BATCH_SIZE:
+            self.wakeup.set()
+
+    def consume(self):
+        while True:
+            self.wakeup.wait(settings.SESSION_LOG_FLUSH_INTERVAL)
+            self.wakeup.clear()
+            close_old_connections()
+            try:
+                self.flush(blocking=False)
+            except Exception as e:
+                logger.exception(e)
+
+    def flush(self, blocking=True):
+        '''
+        Write the calls waiting in the queue, pushed by any process. Without
+        `blocking` nothing is done while another process is writing them.
+        Return whether the queue was emptied.
+        '''
+        if not settings.SESSION_LOG_WRITE_BEHIND:
+            return True
+        connection = self.get_connection()
+        lock = connection.lock(
+            LOCK_KEY, timeout=settings.SESSION_LOG_LOCK_TIMEOUT, blocking_timeout=settings.SESSION_LOG_LOCK_TIMEOUT
+        )
+        if not lock.acquire(blocking=blocking):
+            return False
+        try:
+            while True:
+                batch = connection.lrange(QUEUE_KEY, 0, settings.SESSION_LOG_BATCH_SIZE - 1)
+                if not batch:
+                    return True
+                persist([load_record(data) for data in batch])
+                connection.ltrim(QUEUE_KEY, len(batch), -1)
+        finally:
+            try:
+                lock.release()
+            except redis.exceptions.LockError:
+                # expired while writing, another process may hold it now
+                pass
+
+
+pipeline = LogPipeline()
+
+
+def enqueue(session_log, scenario_case, status_code, sandbox):
+    pipeline.enqueue(LogRecord(
+        uuid=session_log.uuid,
+        session_id=session_log.session_id,
+        date=session_log.date,
+        request=session_log.request,
+        response=session_log.response,
+        response_status=session_log.response_status,
+        status_code=status_code,
+        scenario_case_id=scenario_case.pk if scenario_case is not None else None,
+        sandbox=sandbox
+    ))
+
+
+def flush():
+    '''
+    Persist the calls waiting in the queue, whichever process received them
+    '''
+    return pipeline.flush()
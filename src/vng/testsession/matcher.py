@@ -0,0 +1,101 @@
+import logging
+import re
+from collections import defaultdict
+
+from django.db.models import Count
+
+from ..utils.cache import VersionedLocalCache
+from .models import ScenarioCase, QueryParamsScenario
+
+logger = logging.getLogger(__name__)
+
+PARAM_PATTERN = re.compile('{[^/]+}')
+ANY_C = '[^/]+'
+REGEX_CHARS = set('.^$*+?()[]{}|\\')
+
+_matchers = VersionedLocalCache('scenario-matcher')
+
+
+class CompiledCase:
+    '''
+    Scenario case with its url pattern already turned into a regex
+    and its query parameters kept in memory
+    '''
+
+    def __init__(self, case, query_params):
+        self.case = case
+        self.query_params = query_params
+        parsed_url = '( |/)*' + PARAM_PATTERN.sub(ANY_C, case.url)
+        if len(query_params) == 0:
+            parsed_url += '$'
+        else:
+            parsed_url += '?'
+        self.regex = re.compile(parsed_url)
+        self.literal = self.get_literal(case.url, bool(query_params))
+
+    @staticmethod
+    def get_literal(url, optional_end):
+        '''
+        Return the longest fragment of the url that has to be present in the
+        matched url, used to discard the case before running the regex
+        '''
+        fragments = PARAM_PATTERN.split(url)
+        if optional_end and fragments:
+            # the last character is made optional by the trailing '?'
+            fragments[-1] = fragments[-1][:-1]
+        fragments = [f for f in fragments if not REGEX_CHARS.intersection(f)]
+        return max(fragments, key=len, default='')
+
+    def match(self, url, params):
+        if self.literal not in url or self.regex.search(url) is None:
+            return False
+        for name, expected_value in self.query_params:
+            par = params.get(name)
+            if par is None or (expected_value != '*' and expected_value != par):
+                return False
+        return True
+
+
+class ScenarioMatcher:
+    '''
+    All the scenario cases of a session type indexed by HTTP method.
+    Within the same method, the cases with more query parameters are tried first.
+    '''
+
+    def __init__(self, cases):
+        self.index = defaultdict(list)
+        for case in cases:
+            self.index[case.case.http_method.lower()].append(case)
+
+    @classmethod
+    def build(cls, session_type_id):
+        scenario_cases = list(
+            ScenarioCase.objects
+            .filter(vng_endpoint__session_type=session_type_id)
+            .annotate(count=Count('queryparamsscenario'))
+            .order_by('-count', 'order')
+        )
+        query_params = defaultdict(list)
+        for qp in QueryParamsScenario.objects.filter(scenario_case__in=scenario_cases):
+            query_params[qp.scenario_case_id].append((qp.name, qp.expected_value))
+        return cls([CompiledCase(case, query_params[case.pk]) for case in scenario_cases])
+
+    def match(self, method, url, params):
+        '''
+        Return the first scenario case matching the method, the url and the
+        query parameters of the call, None if there is no match
+        '''
+        check_url = url.replace('/api/v1//', '/api/v1/')
+        for case in self.index.get(method.lower(), []):
+            if case.match(check_url, params):
+                logger.info("Matched %s with %s", check_url, case.case)
+                return case.case
+        return None
+
+
+def get_matcher(session_type_id):
+    return _matchers.get(session_type_id, lambda: ScenarioMatcher.build(session_type_id))
+
+
+def invalidate_matcher(session_type_id):
+    _matchers.invalidate(session_type_id)
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.3 on 2019-07-22 10:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('testsession', '0084_sessiontype_active'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='vngendpoint',
+            name='streaming',
+            field=models.BooleanField(default=False, help_text='Forward the responses in chunks instead of loading them in memory. Only a prefix and a                             digest of the body are logged. Recommended for large documents.'),
+        ),
+    ]
@@ -0,0 +1,57 @@
+# Generated by Django 2.2.3 on 2019-07-24 09:31
+
+from collections import defaultdict
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+# values of HTTPCallChoices
+COUNTERS = {
+    'Succesvol': 'success_count',
+    'Niet succesvol': 'failed_count',
+    'Niet uitgevoerd': 'not_called_count',
+}
+
+
+def count_reports(apps, schema_editor):
+    Session = apps.get_model('testsession', 'Session')
+    Report = apps.get_model('testsession', 'Report')
+    counters = defaultdict(dict)
+    results = (
+        Report.objects
+        .filter(session_log__session__isnull=False)
+        .values_list('session_log__session', 'result')
+        .annotate(n=Count('id'))
+    )
+    for session_id, result, n in results:
+        if result in COUNTERS:
+            counters[session_id][COUNTERS[result]] = n
+    for session_id, values in counters.items():
+        Session.objects.filter(pk=session_id).update(**values)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('testsession', '0085_vngendpoint_streaming'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='session',
+            name='failed_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='session',
+            name='not_called_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='session',
+            name='success_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(count_reports, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.3 on 2019-07-25 10:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('testsession', '0086_session_report_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='session',
+            name='deploy_timings',
+            field=models.TextField(blank=True, default=None, null=True),
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 2.2.3 on 2019-07-26 08:47
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('testsession', '0087_session_deploy_timings'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sessiontype',
+            name='warm_pool_max_idle',
+            field=models.PositiveIntegerField(default=1440, help_text='Minutes after which an unused environment of the warm pool is removed'),
+        ),
+        migrations.AddField(
+            model_name='sessiontype',
+            name='warm_pool_size',
+            field=models.PositiveIntegerField(default=0, help_text='Number of environments deployed in advance for the sessions of this type'),
+        ),
+        migrations.CreateModel(
+            name='WarmEnvironment',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=30, unique=True, verbose_name='Name')),
+                ('status', models.CharField(choices=[('starting', 'starting'), ('running', 'running'), ('shutting down', 'shutting down'), ('stopped', 'stopped'), ('Error deployment', 'error deploy')], default='starting', max_length=20)),
+                ('docker_url', models.CharField(blank=True, default=None, max_length=200, null=True)),
+                ('deploy_status', models.TextField(blank=True, default=None, null=True)),
+                ('deploy_percentage', models.IntegerField(blank=True, default=None, null=True)),
+                ('deploy_timings', models.TextField(blank=True, default=None, null=True)),
+                ('created', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Created at')),
+                ('ready', models.DateTimeField(blank=True, null=True, verbose_name='Ready at')),
+                ('claimed', models.DateTimeField(blank=True, null=True, verbose_name='Claimed at')),
+                ('session', models.OneToOneField(blank=True, default=None, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='warm_environment', to='testsession.Session')),
+                ('session_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='testsession.SessionType')),
+            ],
+            options={
+                'verbose_name': 'Warm environment',
+                'verbose_name_plural': 'Warm environments',
+            },
+        ),
+    ]
@@ -2,6 +2,7 @@ import json
 import uuid
 import re
 import time
+from collections import Counter, defaultdict
 
 from tinymce.models import HTMLField
 
@@ -9,6 +10,8 @@ from django.conf import settings
 from django.core.validators import RegexValidator
 from django.core.files import File
 from django.db import models
+from django.db.models import F
+from django.db.models.functions import Greatest
 from django.utils import timezone
 from django.urls import reverse
 from django.utils.translation import ugettext_lazy as _
@@ -41,6 +44,12 @@ class SessionType(models.Model):
     db_data = models.TextField(default=None, null=True, blank=True)
     ZGW_images = models.BooleanField(default=False, blank=True)
     active = models.BooleanField(blank=True, default=True)
+    warm_pool_size = models.PositiveIntegerField(
+        default=0, help_text='Number of environments deployed in advance for the sessions of this type'
+    )
+    warm_pool_max_idle = models.PositiveIntegerField(
+        default=24 * 60, help_text='Minutes after which an unused environment of the warm pool is removed'
+    )
 
     class Meta:
         verbose_name = _('Session Type')
@@ -147,6 +156,11 @@ class VNGEndpoint(models.Model):
     docker_image = models.CharField(max_length=200, blank=True, null=True, default=None)
     session_type = models.ForeignKey(SessionType, on_delete=models.PROTECT)
     test_file = FilerFileField(null=True, blank=True, default=None, on_delete=models.SET_NULL)
+    streaming = models.BooleanField(
+        default=False,
+        help_text=_('Forward the responses in chunks instead of loading them in memory. Only a prefix and a \
+                            digest of the body are logged. Recommended for large documents.')
+    )
 
     def __str__(self):
         # To show the session type when adding a scenario case
@@ -208,15 +222,40 @@ class Session(models.Model):
     error_message = models.TextField(blank=True, null=True, default=None)
     deploy_status = models.TextField(blank=True, null=True, default=None)
     deploy_percentage = models.IntegerField(default=None, null=True, blank=True)
+    # JSON object with the duration of each step of the deployment (seconds)
+    deploy_timings = models.TextField(blank=True, null=True, default=None)
     sandbox = models.BooleanField(default=False)
     supplier_name = models.CharField(max_length=100, blank=True, null=True)
     software_product = models.CharField(max_length=100, blank=True, null=True)
     product_role = models.CharField(max_length=100, blank=True, null=True)
+    success_count = models.PositiveIntegerField(default=0, editable=False)
+    failed_count = models.PositiveIntegerField(default=0, editable=False)
+    not_called_count = models.PositiveIntegerField(default=0, editable=False)
 
     class Meta:
         verbose_name = _('Session')
         verbose_name_plural = _('Sessions')
 
+    @classmethod
+    def update_report_counters(cls, deltas):
+        '''
+        Apply the changes of the results of the reports.
+        `deltas` maps the id of the session to a Counter of the results.
+        The counters of the instances already loaded are stale, they are
+        reloaded with `refresh_report_counters` before a full save, or the
+        changed fields are saved with `update_fields`.
+        '''
+        for session_id, delta in deltas.items():
+            changes = {
+                REPORT_COUNTERS[result]: Greatest(F(REPORT_COUNTERS[result]) + n, 0)
+                for result, n in delta.items() if n
+            }
+            if session_id is not None and changes:
+                cls.objects.filter(pk=session_id).update(**changes)
+
+    def refresh_report_counters(self):
+        self.refresh_from_db(fields=list(REPORT_COUNTERS.values()))
+
     @staticmethod
     def assign_name(id):
         return "s{}{}".format(str(id), str(time.time()).replace('.', '-'))
@@ -244,17 +283,54 @@ class Session(models.Model):
     def is_shutting_down(self):
         return self.status == choices.StatusChoices.shutting_down
 
-    def get_report_stats(self):
-        success, failed, not_called = 0, 0, 0
-        reports = Report.objects.filter(session_log__in=self.sessionlog_set.all())
-        for report in reports:
-            if report.is_success():
-                success += 1
-            elif report.is_failed():
-                failed += 1
-            elif report.is_not_called():
-                not_called += 1
-        return success, failed, not_called + (ScenarioCase.objects.filter(vng_endpoint__session_type=self.session_type).count() - reports.count())
+    def get_deploy_timings(self):
+        return json.loads(self.deploy_timings) if self.deploy_timings else {}
+
+    def get_report_stats(self, case_count=None):
+        '''
+        Return the number of successful, failed and not called scenario cases.
+        The cases without a report are not called, `case_count` spares
+        the query counting the cases of the session type.
+        '''
+        if case_count is None:
+            case_count = ScenarioCase.objects.filter(vng_endpoint__session_type=self.session_type_id).count()
+        reports = self.success_count + self.failed_count + self.not_called_count
+        return self.success_count, self.failed_count, self.not_called_count + max(case_count - reports, 0)
+
+
+class WarmEnvironment(models.Model):
+    '''
+    Environment of a session type deployed in advance, the next session of
+    the type claims it instead of deploying its own
+    '''
+
+    name = models.CharField(_('Name'), max_length=30, unique=True)
+    session_type = models.ForeignKey(SessionType, on_delete=models.CASCADE)
+    session = models.OneToOneField(
+        Session, on_delete=models.SET_NULL, null=True, blank=True, default=None, related_name='warm_environment'
+    )
+    status = models.CharField(max_length=20, choices=choices.StatusChoices.choices, default=choices.StatusChoices.starting)
+    docker_url = models.CharField(max_length=200, blank=True, null=True, default=None)
+    deploy_status = models.TextField(blank=True, null=True, default=None)
+    deploy_percentage = models.IntegerField(default=None, null=True, blank=True)
+    deploy_timings = models.TextField(blank=True, null=True, default=None)
+    created = models.DateTimeField(_('Created at'), default=timezone.now)
+    ready = models.DateTimeField(_('Ready at'), null=True, blank=True)
+    claimed = models.DateTimeField(_('Claimed at'), null=True, blank=True)
+
+    class Meta:
+        verbose_name = _('Warm environment')
+        verbose_name_plural = _('Warm environments')
+
+    @staticmethod
+    def assign_name():
+        return "w{}".format(uuid.uuid4().hex[:16])
+
+    def __str__(self):
+        return "{} - {}".format(self.session_type, self.name)
+
+    def is_available(self):
+        return self.status == choices.StatusChoices.running and self.claimed is None
 
 
 class ExposedUrl(models.Model):
@@ -311,6 +387,22 @@ class Report(models.Model):
     session_log = models.ForeignKey(SessionLog, on_delete=models.CASCADE)
     result = models.CharField(max_length=20, choices=choices.HTTPCallChoices.choices, default=choices.HTTPCallChoices.not_called)
 
+    # result accounted in the counters of the session, none until the report is saved
+    counted_result = None
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        report = super().from_db(db, field_names, values)
+        report.counted_result = report.result
+        return report
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        session_log = self.session_log
+        Session.update_report_counters(report_counter_deltas([(session_log.session_id, self)]))
+        if SessionLog.session.is_cached(session_log):
+            session_log.session.refresh_report_counters()
+
     def is_success(self):
         return self.result == choices.HTTPCallChoices.success
 
@@ -322,3 +414,26 @@ class Report(models.Model):
 
     def __str__(self):
         return 'Case: {} - Log: {} - Result: {}'.format(self.scenario_case, self.session_log, self.result)
+
+
+REPORT_COUNTERS = {
+    choices.HTTPCallChoices.success: 'success_count',
+    choices.HTTPCallChoices.failed: 'failed_count',
+    choices.HTTPCallChoices.not_called: 'not_called_count',
+}
+
+
+def report_counter_deltas(reports):
+    '''
+    Return the changes of the session counters for the (session id, report)
+    pairs whose result changed since it was last counted, and mark them counted.
+    '''
+    deltas = defaultdict(Counter)
+    for session_id, report in reports:
+        if report.counted_result == report.result:
+            continue
+        if report.counted_result is not None:
+            deltas[session_id][report.counted_result] -= 1
+        deltas[session_id][report.result] += 1
+        report.counted_result = report.result
+    return deltas
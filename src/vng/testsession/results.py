@@ -0,0 +1,94 @@
+from collections import OrderedDict
+
+from ..utils import choices
+from .models import Report, ScenarioCase
+
+
+class SessionResult:
+    '''
+    Results of a session: the scenario cases of its session type joined with
+    the reports of its calls. Everything is loaded with a constant number of
+    queries, the join is done in memory on the id of the scenario case.
+    '''
+
+    def __init__(self, session):
+        self.session = session
+        self.cases = list(
+            ScenarioCase.objects
+            .filter(vng_endpoint__session_type=session.session_type_id)
+            .prefetch_related('queryparamsscenario_set')
+        )
+        cases = {case.pk: case for case in self.cases}
+        self.reports = list(
+            Report.objects
+            .filter(session_log__session=session)
+            .select_related('session_log')
+            .order_by('pk')
+        )
+        foreign = {r.scenario_case_id for r in self.reports} - set(cases)
+        if foreign:
+            # reports of cases moved to another session type
+            cases.update((case.pk, case) for case in ScenarioCase.objects.filter(pk__in=foreign))
+        self.reports_by_case = OrderedDict()
+        for report in self.reports:
+            report.scenario_case = cases[report.scenario_case_id]
+            self.reports_by_case.setdefault(report.scenario_case_id, []).append(report)
+
+    def has_cases(self):
+        return bool(self.cases)
+
+    def missing_cases(self):
+        return [case for case in self.cases if case.pk not in self.reports_by_case]
+
+    def is_failed(self):
+        return any(report.is_failed() for report in self.reports)
+
+    def is_complete(self):
+        '''
+        Every scenario case has been called at least once
+        '''
+        return all(
+            any(not report.is_not_called() for report in self.reports_by_case.get(case.pk, []))
+            for case in self.cases
+        )
+
+    def ordered_reports(self):
+        '''
+        One report for each scenario case, in the order of the cases.
+        The cases never called get an unsaved report.
+        '''
+        return [
+            self.reports_by_case[case.pk][0] if case.pk in self.reports_by_case else
+            Report(scenario_case=case, result=choices.HTTPCallChoices.not_called)
+            for case in self.cases
+        ]
+
+    def all_reports(self):
+        '''
+        All the reports of the session, followed by an unsaved report for
+        each scenario case never called
+        '''
+        return self.reports + [Report(scenario_case=case) for case in self.missing_cases()]
+
+    def outcome(self):
+        if not self.cases:
+            return 'No scenario cases available'
+        if not self.reports:
+            return 'Geen oproep uitgevoerd'
+        if self.is_failed():
+            return 'mislukt'
+        if len(self.reports) < len(self.cases):
+            return 'Gedeeltelijk succesvol'
+        return 'Succesvol'
+
+    def shield(self):
+        '''
+        Return the message, the color and the error flag of the badge of the session
+        '''
+        if not self.cases:
+            return 'No results', 'inactive', False
+        if self.is_failed():
+            return 'Failed', 'red', True
+        if not self.is_complete():
+            return 'Not completed', 'orange', False
+        return 'Success', 'green', False
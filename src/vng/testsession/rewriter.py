@@ -0,0 +1,193 @@
+import re
+import threading
+from collections import OrderedDict
+from urllib import parse
+
+from subdomains.utils import reverse as reverse_sub
+
+_rewriters = OrderedDict()
+_lock = threading.Lock()
+MAX_REWRITERS = 500
+
+
+def get_host(endpoint):
+    return reverse_sub('run_test', endpoint.subdomain, kwargs={
+        'relative_url': ''
+    })
+
+
+def url_pair(host, endpoint):
+    '''
+    Return the tuple (url of the service, url of the test platform) of the endpoint
+
+    Arguments:
+        host Str -- Host of the webservice
+        endpoint ExposedUrl -- ExposedUrl corresponding the call
+    '''
+    sub = host
+    if endpoint.vng_endpoint.url is not None:
+        if not endpoint.vng_endpoint.url.endswith('/'):
+            if sub.endswith('/'):
+                sub = sub[:-1]
+        else:
+            if not sub.endswith('/'):
+                sub = sub + '/'
+        return endpoint.vng_endpoint.url, sub
+    else:
+        query = parse.urlparse(sub)
+        if not sub.endswith('/'):
+            sub = sub + '/'
+        return '{}://{}:{}/'.format(query.scheme, endpoint.docker_url, endpoint.port), sub
+
+
+def trie_pattern(words):
+    '''
+    Return a regex matching literally any of the words, built from their
+    prefix tree so that the common prefix (usually the scheme and the host)
+    is a plain literal the regex engine can search for quickly.
+    Where a word is a prefix of another one, the longest is preferred.
+    '''
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = True
+
+    def build(node):
+        if list(node) == ['']:
+            return ''
+        alternatives = [re.escape(char) + build(node[char]) for char in sorted(k for k in node if k)]
+        optional = '' in node
+        if len(alternatives) == 1 and not optional:
+            return alternatives[0]
+        pattern = '(?:{})'.format('|'.join(alternatives))
+        return pattern + '?' if optional else pattern
+
+    return build(trie)
+
+
+class UrlRewriter:
+    '''
+    Replace in a single pass all the occurrences of a set of urls.
+    The urls are matched literally, the longest one first.
+    '''
+
+    def __init__(self, pairs):
+        self.replacements = {}
+        for source, target in pairs:
+            if source and source not in self.replacements:
+                self.replacements[source] = target
+        self.max_length = max((len(s) for s in self.replacements), default=0)
+        if self.replacements:
+            self.regex = re.compile(trie_pattern(self.replacements))
+        else:
+            self.regex = None
+
+    def _replace(self, match):
+        return self.replacements[match.group(0)]
+
+    def rewrite(self, content):
+        if self.regex is None or not content:
+            return content
+        return self.regex.sub(self._replace, content)
+
+    def rewrite_stream(self, chunks):
+        '''
+        Rewrite an iterable of text chunks, also the urls split between two chunks.
+        '''
+        stream = StreamRewriter(self)
+        for chunk in chunks:
+            text = stream.feed(chunk)
+            if text:
+                yield text
+        tail = stream.close()
+        if tail:
+            yield tail
+
+
+class StreamRewriter:
+    '''
+    Incremental rewriting of a text received in chunks.
+    The last max_length - 1 characters of the text received so far are
+    held back until the next chunk, since they can be the start of an url.
+    '''
+
+    def __init__(self, rewriter):
+        self.rewriter = rewriter
+        self.keep = rewriter.max_length - 1
+        self.pending = ''
+
+    def feed(self, chunk):
+        if self.rewriter.regex is None:
+            return chunk
+        pending = self.pending + chunk
+        safe = len(pending) - self.keep
+        if safe <= 0:
+            self.pending = pending
+            return ''
+        out = []
+        pos = 0
+        for match in self.rewriter.regex.finditer(pending):
+            # every url starting before the safe point is completely in pending
+            if match.start() >= safe:
+                break
+            out.append(pending[pos:match.start()])
+            out.append(self.rewriter.replacements[match.group(0)])
+            pos = match.end()
+        cut = max(pos, safe)
+        out.append(pending[pos:cut])
+        self.pending = pending[cut:]
+        return ''.join(out)
+
+    def close(self):
+        pending, self.pending = self.pending, ''
+        return self.rewriter.rewrite(pending)
+
+
+class SessionRewriter:
+    '''
+    Pair of rewriters for all the exposed urls of a session:
+    the responses get the urls of the test platform, the requests the urls
+    of the services.
+    '''
+
+    def __init__(self, endpoints):
+        pairs = [url_pair(get_host(ep), ep) for ep in endpoints]
+        self.response = UrlRewriter(pairs)
+        self.request = UrlRewriter([(target, source) for source, target in pairs])
+
+    def rewrite_response(self, content):
+        return self.response.rewrite(content)
+
+    def rewrite_request(self, content):
+        return self.request.rewrite(content)
+
+    def rewrite_response_stream(self, chunks):
+        return self.response.rewrite_stream(chunks)
+
+    def response_stream(self):
+        return StreamRewriter(self.response)
+
+
+def get_rewriter(endpoints):
+    '''
+    Return the cached rewriter of the given exposed urls.
+    All the values used to build the rewriter are part of the key, so an
+    ExposedUrl that changes (e.g. its docker_url is assigned) gets a new one.
+    '''
+    key = tuple(
+        (ep.pk, ep.subdomain, ep.docker_url, ep.port, ep.vng_endpoint.url)
+        for ep in endpoints
+    )
+    with _lock:
+        rewriter = _rewriters.get(key)
+        if rewriter is not None:
+            _rewriters.move_to_end(key)
+            return rewriter
+    rewriter = SessionRewriter(endpoints)
+    with _lock:
+        _rewriters[key] = rewriter
+        if len(_rewriters) > MAX_REWRITERS:
+            _rewriters.popitem(last=False)
+    return rewriter
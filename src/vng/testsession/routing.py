@@ -0,0 +1,78 @@
+from django.http import Http404
+
+from ..utils import choices
+from ..utils.cache import VersionedLocalCache
+from .models import ExposedUrl, InjectHeader
+
+_routes = VersionedLocalCache('routing')
+
+
+class RoutingContext:
+    '''
+    Everything the proxy needs to forward a call made to a subdomain:
+    the exposed url, its session and session type, all the exposed urls
+    of the session (for the rewriting) and the headers to inject.
+    '''
+
+    def __init__(self, exposed_url, endpoints, inject_headers):
+        self.exposed_url = exposed_url
+        self.session = exposed_url.session
+        self.session_type = self.session.session_type
+        self.endpoints = endpoints
+        self.inject_headers = inject_headers
+
+    @classmethod
+    def build(cls, subdomain):
+        try:
+            exposed_url = (
+                ExposedUrl.objects
+                .select_related('session__session_type', 'vng_endpoint')
+                .get(subdomain=subdomain)
+            )
+        except ExposedUrl.DoesNotExist:
+            raise Http404()
+        endpoints = list(
+            ExposedUrl.objects
+            .filter(session=exposed_url.session)
+            .select_related('vng_endpoint')
+            .order_by('pk')
+        )
+        inject_headers = [
+            (header.key, header.value)
+            for header in InjectHeader.objects.filter(session_type=exposed_url.session.session_type)
+        ]
+        return cls(exposed_url, endpoints, inject_headers)
+
+
+def get_routing(subdomain):
+    '''
+    Return the RoutingContext of the subdomain, raise Http404 if it does not exist
+    '''
+    return _routes.get(subdomain, lambda: RoutingContext.build(subdomain))
+
+
+def invalidate_subdomain(subdomain):
+    _routes.invalidate(subdomain)
+
+
+def invalidate_session(session_id):
+    invalidate_sessions([session_id])
+
+
+def invalidate_sessions(session_ids):
+    '''
+    Invalidate the routes of the sessions, needed after a bulk update of the
+    sessions since it does not send their post_save
+    '''
+    _routes.invalidate_many(
+        ExposedUrl.objects.filter(session__in=session_ids).values_list('subdomain', flat=True)
+    )
+
+
+def invalidate_session_type(session_type_id):
+    _routes.invalidate_many(
+        ExposedUrl.objects
+        .filter(session__session_type=session_type_id)
+        .exclude(session__status=choices.StatusChoices.stopped)
+        .values_list('subdomain', flat=True)
+    )
@@ -0,0 +1,72 @@
+from collections import Counter
+
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from ..utils.badges import invalidate_badges
+from .matcher import invalidate_matcher
+from .models import (
+    ScenarioCase, QueryParamsScenario, VNGEndpoint, Session, ExposedUrl,
+    InjectHeader, SessionType, SessionLog, Report
+)
+from .routing import invalidate_session, invalidate_session_type, invalidate_subdomain
+
+
+@receiver([post_save, post_delete], sender=ScenarioCase)
+def scenario_case_changed(sender, instance, **kwargs):
+    session_type_id = instance.vng_endpoint.session_type_id
+    invalidate_matcher(session_type_id)
+    invalidate_badges('session', Session.objects.filter(session_type=session_type_id).values_list('uuid', flat=True))
+
+
+@receiver([post_save, post_delete], sender=QueryParamsScenario)
+def query_params_changed(sender, instance, **kwargs):
+    invalidate_matcher(instance.scenario_case.vng_endpoint.session_type_id)
+
+
+@receiver([post_save, post_delete], sender=VNGEndpoint)
+def vng_endpoint_changed(sender, instance, **kwargs):
+    invalidate_matcher(instance.session_type_id)
+    invalidate_session_type(instance.session_type_id)
+
+
+@receiver(post_save, sender=Session)
+def session_changed(sender, instance, **kwargs):
+    invalidate_session(instance.pk)
+    invalidate_badges('session', [instance.uuid])
+
+
+@receiver(post_delete, sender=Session)
+def session_deleted(sender, instance, **kwargs):
+    invalidate_badges('session', [instance.uuid])
+
+
+@receiver([post_save, post_delete], sender=ExposedUrl)
+def exposed_url_changed(sender, instance, **kwargs):
+    invalidate_session(instance.session_id)
+    if kwargs.get('signal') is post_delete:
+        # the deleted url is not returned by the query anymore
+        invalidate_subdomain(instance.subdomain)
+
+
+@receiver([post_save, post_delete], sender=InjectHeader)
+def inject_header_changed(sender, instance, **kwargs):
+    invalidate_session_type(instance.session_type_id)
+
+
+@receiver(post_save, sender=SessionType)
+def session_type_changed(sender, instance, **kwargs):
+    invalidate_session_type(instance.pk)
+
+
+@receiver(post_delete, sender=Report)
+def report_deleted(sender, instance, **kwargs):
+    if instance.counted_result is None:
+        return
+    session_id = SessionLog.objects.filter(pk=instance.session_log_id).values_list('session_id', flat=True).first()
+    Session.update_report_counters({session_id: Counter({instance.counted_result: -1})})
+
+
+@receiver([post_save, post_delete], sender=Report)
+def report_changed(sender, instance, **kwargs):
+    invalidate_badges('session', Session.objects.filter(sessionlog=instance.session_log_id).values_list('uuid', flat=True))
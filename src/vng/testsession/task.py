@@ -1,41 +1,68 @@
 import time
 import random
 import copy
-import os
-import uuid
 
 from datetime import timedelta, datetime
 from celery.utils.log import get_task_logger
 
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
 from django.db.models import Q
+from django.utils import timezone
 from django.utils.timezone import make_aware
 from django.utils.translation import ugettext_lazy as _
 
+from vng.k8s_manager.client import DeadlineExceeded, get_client
 from vng.k8s_manager.kubernetes import *
-from vng.k8s_manager.container_manager import K8S
+from vng.k8s_manager.container_manager import K8S, RESOURCES, delete_session_objects, label_legacy_objects
 
 from ..celery.celery import app
-from .models import ExposedUrl, Session, TestSession, VNGEndpoint
+from . import db_snapshot, log_pipeline
+from .deploy_pipeline import DeployPipeline
+from .models import ExposedUrl, Session, SessionType, TestSession, VNGEndpoint, WarmEnvironment
+from .routing import invalidate_sessions
 from ..utils import choices
+from ..utils.badges import invalidate_badges
 from ..utils.newman import NewmanManager
 from .gemma_containers import *
 
 logger = get_task_logger(__name__)
 
 
-@app.task
-def stop_session(session_pk):
+@app.task(bind=True, max_retries=settings.SESSION_LOG_STOP_RETRIES)
+def stop_session(self, session_pk):
+    # the calls queued by the processes of the proxy are written before the session is scored
+    try:
+        flushed = log_pipeline.flush()
+    except Exception as e:
+        logger.exception(e)
+        flushed = True
+    if not flushed:
+        # another process held the queue for SESSION_LOG_LOCK_TIMEOUT
+        if not self.request.called_directly and self.request.retries < self.max_retries:
+            raise self.retry(countdown=settings.SESSION_LOG_LOCK_TIMEOUT)
+        logger.warning('Calls of session %s may still be queued, it is scored without them', session_pk)
     session = Session.objects.get(pk=session_pk)
     if session.status == choices.StatusChoices.stopped:
         return
     run_tests(session.pk)
-    eu = ExposedUrl.objects.filter(session=session)
-    for e_url in eu:
-        if e_url.vng_endpoint.url is None:
-            kuber = K8S(app_name=session.name)
-            kuber.delete()
+    # a session running in a warm environment uses the objects of the environment
+    environment = WarmEnvironment.objects.filter(session=session).first()
+    if ExposedUrl.objects.filter(session=session, vng_endpoint__url__isnull=True).exists():
+        K8S(app_name=environment.name if environment else session.name).delete()
+    if environment:
+        environment.status = choices.StatusChoices.stopped
+        environment.save()
     session.status = choices.StatusChoices.stopped
-    session.save()
+    # the counters of the reports are changed by the calls written meanwhile
+    session.save(update_fields=['status'])
+
+
+class EnvironmentRemoved(Exception):
+    '''
+    The warm environment was removed from its pool while it was deployed
+    '''
 
 
 def update_session_status(session, message, percentage=None):
@@ -44,23 +71,97 @@ def update_session_status(session, message, percentage=None):
         if percentage >= 100:
             percentage = 100
         session.deploy_percentage = percentage
+    if isinstance(session, WarmEnvironment):
+        # only the progress is saved, the pool may have changed the status of the environment
+        if not WarmEnvironment.objects.filter(pk=session.pk, status=choices.StatusChoices.starting).update(
+            deploy_status=session.deploy_status, deploy_percentage=session.deploy_percentage
+        ):
+            raise EnvironmentRemoved(session.name)
+        return
     session.save()
 
 
-def align_sessions_data():
-    data = K8S().fetch_resource('services')
-    for session in Session.objects.all():
-        for item in data.get('items'):
-            metadata = item.get('metadata')
-            if metadata and metadata.get('name') and session.name in metadata.get('name'):
-                continue
-        session.status = choices.StatusChoices.stopped
-        session.save()
+def session_of(item):
+    return item['metadata']['labels'][SESSION_LABEL]
+
+
+def align_sessions_data(deployed):
+    '''
+    Stop the running sessions and warm environments deployed in the cluster
+    whose deployment is gone, `deployed` are the names of the sessions with
+    a deployment. Return the number of stopped sessions and environments.
+    '''
+    # the objects of a session running in a warm environment have the name of the environment
+    orphaned = [
+        pk for pk, name, environment in Session.objects
+        .filter(status=choices.StatusChoices.running)
+        .filter(Q(exposedurl__vng_endpoint__docker_image__isnull=False) | Q(session_type__ZGW_images=True))
+        .values_list('pk', 'name', 'warm_environment__name')
+        .distinct()
+        if (environment or name) not in deployed
+    ]
+    environments = WarmEnvironment.objects \
+        .filter(status=choices.StatusChoices.running) \
+        .exclude(name__in=deployed)
+    # the sessions of the environments are orphaned as well
+    changed = set(orphaned) | set(environments.exclude(session=None).values_list('session', flat=True))
+    sessions = Session.objects.filter(pk__in=orphaned).update(status=choices.StatusChoices.stopped)
+    environments = environments.update(status=choices.StatusChoices.stopped)
+    # the bulk updates do not send post_save, the routes and the badges of the sessions are invalidated here
+    invalidate_sessions(changed)
+    invalidate_badges('session', Session.objects.filter(pk__in=changed).values_list('uuid', flat=True))
+    return sessions, environments
+
+
+LEGACY_LABELLED_KEY = 'k8s-legacy-labelled'
+
+
+@app.task
+def reconcile_sessions():
+    '''
+    Reconcile the sessions with the objects of the cluster: the sessions whose
+    deployment is gone are stopped, the objects of the sessions and of the warm
+    environments no longer active are deleted. Return what was reclaimed.
+    '''
+    client = get_client()
+    # a shutting down session is still tested by stop_session against its pods
+    active = [choices.StatusChoices.starting, choices.StatusChoices.running, choices.StatusChoices.shutting_down]
+    # the objects of the live sessions deployed before the session label must
+    # not look leaked, they are labelled until a pass finds none of them as all
+    # the objects deployed since have the label
+    if not cache.get(LEGACY_LABELLED_KEY):
+        if not label_legacy_objects(
+            list(Session.objects.filter(status__in=active).values_list('name', flat=True)) +
+            list(WarmEnvironment.objects.filter(status__in=active).values_list('name', flat=True))
+        ):
+            cache.set(LEGACY_LABELLED_KEY, True, None)
+    # listed before reading the sessions, the session of every object is in the database
+    objects = {
+        resource: client.list(*RESOURCES[resource], label_selector=SESSION_LABEL)
+        for resource in ('deployments', 'services', 'configmaps')
+    }
+    sessions, environments = align_sessions_data({session_of(item) for item in objects['deployments']})
+
+    live = set(Session.objects.filter(status__in=active).values_list('name', flat=True))
+    live.update(WarmEnvironment.objects.filter(status__in=active).values_list('name', flat=True))
+    leaked = {
+        resource: [item for item in items if session_of(item) not in live]
+        for resource, items in objects.items()
+    }
+    delete_session_objects(
+        {session_of(item) for items in leaked.values() for item in items}, leaked['services']
+    )
+
+    report = {'sessions': sessions, 'environments': environments}
+    for resource, items in leaked.items():
+        report[resource] = sorted(item['metadata']['name'] for item in items)
+    logger.info('Reconciliation of the sessions: %s', report)
+    return report
 
 
 @app.task
 def purge_sessions():
-    align_sessions_data()
+    reconcile_sessions()
     purged = False
     for session in \
             Session.objects.filter(started__lte=make_aware(datetime.now()) - timedelta(days=1)) \
@@ -71,38 +172,56 @@ def purge_sessions():
     return purged
 
 
-def deploy_db(session, data=[]):
-
-    db_k8s = K8S(app_name='db-{}'.format(session.name))
+def deploy_db(session, data=[], filename=None, seeded=False):
+    '''
+    Deploy the database of the session, initialized with the SQL of `data`.
+    With `seeded` it is only returned once the SQL is loaded.
+    '''
+    db_k8s = K8S(app_name='db-{}'.format(session.name), session_name=session.name)
     db_k8s.initialize()
     db = copy.deepcopy(postgis)
     db.name = 'db-{}'.format(session.name)
     db.data = data
+    if filename:
+        db.filename = filename
     d_db = Deployment(
         name='db-{}'.format(session.name),
         labels='db-{}'.format(session.name),
+        session=session.name,
         containers=[db]
     ).execute()
 
-    for i in range(10):
-        time.sleep(3)
-        # Visualize the new pod can be not immediate, pooling is the way :(
-        try:
-            db_IP_address = db_k8s.get_pod_status()['status']['podIP']
-            return db_IP_address, db_k8s
-        except:
-            pass
+    try:
+        db_IP_address = db_k8s.wait_pod_running(settings.K8S_POD_READY_TIMEOUT)['status']['podIP']
+        if seeded:
+            db_k8s.wait_log(db.name, db_snapshot.SEEDED_LOG, settings.K8S_DB_SEED_TIMEOUT)
+    except DeadlineExceeded:
+        logger.exception('Database of session %s not deployed', session.name)
+        return None, db_k8s
+    return db_IP_address, db_k8s
 
 
-def ZGW_deploy(session):
-    update_session_status(session, _('Connecting to Kubernetes'), 1)
+def bind_snapshot(k8s_db, ip):
+    '''
+    Bind the preconfigured models of the seeded database to the IP address of the session
+    '''
+    k8s_db.exec(db_snapshot.rebind_command(ip))
 
-    k8s = K8S(app_name=session.name)
-    k8s.initialize()
 
-    # create deployment DB
-    db_IP_address, k8s_db = deploy_db(session, postgis.data)
+def deploy_error(session, message):
+    update_session_status(session, message)
+    session.status = choices.StatusChoices.error_deploy
+    if isinstance(session, WarmEnvironment):
+        WarmEnvironment.objects.filter(pk=session.pk, status=choices.StatusChoices.starting).update(status=session.status)
+        return
+    session.save()
+
 
+def zgw_containers(session_type, name):
+    '''
+    Return the containers of a ZGW environment, and the containers bound to
+    the endpoints of the session type with their endpoint
+    '''
     # group all the other containers in the same pod
     containers = [
         copy.deepcopy(ZRC),
@@ -114,167 +233,246 @@ def ZGW_deploy(session):
         copy.deepcopy(NRC_CELERY),
         copy.deepcopy(rabbitMQ),
     ]
-    uwsgi_containers = containers[:-2]
-    exposed_urls = []
+    bindings = []
     for c in containers:
-        vng_endpoint = VNGEndpoint.objects.filter(session_type=session.session_type).filter(name__icontains=c.name)
+        vng_endpoint = VNGEndpoint.objects.filter(session_type=session_type).filter(name__icontains=c.name)
         if len(vng_endpoint) != 0:
-            bind_url = ExposedUrl.objects.create(
-                session=session,
-                vng_endpoint=vng_endpoint[0],
-                subdomain='{}'.format(int(time.time()) * 100 + random.randint(0, 99)),
-                port=c.public_port
-            )
-            exposed_urls.append(bind_url)
-            c.name = '{}-{}'.format(session.name, c.name)
-            c.variables['DB_HOST'] = db_IP_address
+            bindings.append((c, vng_endpoint[0]))
+            c.name = '{}-{}'.format(name, c.name)
+    return containers, bindings
 
-    Deployment(
-        name=session.name,
-        labels=session.name,
-        containers=containers
-    ).execute()
 
-    update_session_status(session, _('Deployment of the pod'), 5)
+def bind_zgw(session, bindings, ip=None):
+    return [
+        ExposedUrl.objects.create(
+            session=session,
+            vng_endpoint=vng_endpoint,
+            subdomain='{}'.format(int(time.time()) * 100 + random.randint(0, 99)),
+            port=c.public_port,
+            docker_url=ip
+        ) for c, vng_endpoint in bindings
+    ]
 
-    # Crete the service forwarding the right ports
-    LoadBalancer(
-        name='{}-loadbalancer'.format(session.name),
-        app=session.name,
-        containers=containers
-    ).execute()
-    ip = external_ip_pooling(k8s, session, n_trial=30, max_percentage=40)
+
+def ZGW_deploy(session):
+    update_session_status(session, _('Connecting to Kubernetes'), 1)
+
+    containers, bindings = zgw_containers(session.session_type, session.name)
+    exposed_urls = bind_zgw(session, bindings)
+    ip = deploy_zgw_environment(session, containers, [c for c, vng_endpoint in bindings])
     if ip is None:
-        update_session_status(session, _('Impossible to deploy successfully, IP address not allocated'))
-        session.status = choices.StatusChoices.error_deploy
-        session.save()
         return
     for ex in exposed_urls:
         ex.docker_url = ip
         ex.save()
 
-    # check migrations status
-    while len(uwsgi_containers) != 0:
-        uwsgi_containers = [c for c in uwsgi_containers if 'spawned uWSGI' not in k8s.get_pod_log(c.name)]
-        update_session_status(session, _('Check migration status'), int(40 + (6 - len(uwsgi_containers)) * 45 / 6))
-        time.sleep(5)
-
-    update_session_status(session, _('Loading preconfigured models', 85))
-    filename = str(uuid.uuid4())
-    file_location = os.path.join(os.path.dirname(__file__), 'kubernetes/data/dump.sql')
-    new_file = os.path.join(os.path.dirname(__file__), 'kubernetes/data/{}'.format(filename))
-    with open(file_location) as in_file:
-        content = in_file.read()
-        content = content.replace('BASE_IP', ip)
-    with open(new_file, 'w') as out_file:
-        out_file.write(content)
-
-    # running the eventual migrations
-    k8s_db.copy_to(new_file, 'dump.sql')
-    os.remove(new_file)
-    k8s_db.exec([
-        'psql',
-        '-f',
-        'dump.sql',
-        '-U',
-        'postgres'
-    ])
     update_session_status(session, _('Installation succesful'), 100)
     session.status = choices.StatusChoices.running
     session.save()
 
 
-def external_ip_pooling(k8s, session, n_trial=15, purge=True, percentage=36, max_percentage=99):
-    for i in range(n_trial):
-        time.sleep(10)
-        res, message = k8s.get_pod_status_deployment()
-        if res:
-            break
-    if not res:
-        if purge and purge_sessions():
-            update_session_status(session, _('Impossible to deploy successfully, trying to remove old sessions'))
-            external_ip_pooling(k8s, session, purge=False)
-        else:
-            update_session_status(session, _('Impossible to deploy successfully, all the resources are being used'))
+def deploy_zgw_environment(session, containers, bound_containers, purge=True):
+    '''
+    Deploy the ZGW environment of the session (or of the warm environment),
+    return its IP address or None when the deployment failed. With `purge`
+    the old sessions are stopped when the cluster has no resources left.
+    '''
+    k8s = K8S(app_name=session.name)
+    uwsgi_containers = containers[:-2]
+
+    # steps: initialization, database, load balancer, deployment, pod, IP
+    # address, migrations and the binding of the preconfigured models
+    steps = 7 + len(uwsgi_containers)
+    with DeployPipeline(session, steps, update_session_status) as pipeline:
+        pipeline.run('initialize', _('Connecting to Kubernetes'), k8s.initialize)
+
+        # create deployment DB, seeded with the preconfigured models, and the
+        # service forwarding the right ports
+        database = pipeline.submit(
+            'database', deploy_db, session, [db_snapshot.snapshot_sql()], db_snapshot.SNAPSHOT_FILENAME, True
+        )
+        load_balancer = pipeline.submit('load balancer', LoadBalancer(
+            name='{}-loadbalancer'.format(session.name),
+            app=session.name,
+            session=session.name,
+            containers=containers
+        ).execute)
+
+        db_IP_address, k8s_db = pipeline.result(database, _('Deployment of the database'))
+        if db_IP_address is None:
+            deploy_error(session, _('Impossible to deploy successfully, the database is not available'))
             return None
-    for i in range(n_trial):
-        time.sleep(10)
-        update_session_status(session, _('Installatione progress ') + '{}'.format(i + 1), min(percentage + i * 6, max_percentage))
-        ip = k8s.service_status()
-        if ip is not None:
-            return ip
-    return None
+        for c in bound_containers:
+            c.variables['DB_HOST'] = db_IP_address
+        pipeline.result(load_balancer, _('Creation of the load balancer'))
 
+        # the config maps of the containers and the deployment in one manifest
+        pipeline.run('deployment', _('Deployment of the pod'), Manifest([Deployment(
+            name=session.name,
+            labels=session.name,
+            session=session.name,
+            containers=containers
+        )]).apply)
+        if not pipeline.run('pod', _('Waiting for the IP address'), wait_pod, k8s, session, purge):
+            deploy_error(session, _('Impossible to deploy successfully, IP address not allocated'))
+            return None
 
-@app.task
-def bootstrap_session(session_pk, purged=False):
+        # the migrations run while the IP address is allocated, on the seeded
+        # databases they have nothing left to apply
+        k8s.make_aware()
+        ip_address = pipeline.submit(
+            'IP address', k8s.wait_service_ip, settings.K8S_SERVICE_READY_TIMEOUT, stop=pipeline.cancelled
+        )
+        migrations = [
+            pipeline.submit(
+                'migrations {}'.format(c.name), k8s.wait_log, c.name, 'spawned uWSGI', settings.K8S_MIGRATION_TIMEOUT,
+                stop=pipeline.cancelled
+            ) for c in uwsgi_containers
+        ]
+        try:
+            ip = pipeline.result(ip_address, _('Check migration status'))
+        except DeadlineExceeded:
+            deploy_error(session, _('Impossible to deploy successfully, IP address not allocated'))
+            return None
+
+        try:
+            for migration in migrations:
+                pipeline.result(migration, _('Check migration status'))
+        except DeadlineExceeded:
+            deploy_error(session, _('Impossible to deploy successfully, the migrations did not complete'))
+            return None
+
+        pipeline.run('preconfigured models', _('Loading preconfigured models'), bind_snapshot, k8s_db, ip)
+    return ip
+
+
+def wait_pod(k8s, session, purge=True):
     '''
-    Create all the necessary endpoint and exposes it so they can be used as proxy
-    In case there is one or multiple docker images linked, it starts all of them
+    Wait for the pod of the session, the old sessions are removed when there
+    are no resources left for it
     '''
-    session = Session.objects.get(pk=session_pk)
-    if session.session_type.ZGW_images:
-        ZGW_deploy(session)
-        return
-    update_session_status(session, _('Connecting to Kubernetes'), 1)
-    endpoint = VNGEndpoint.objects.filter(session_type=session.session_type)
-
-    k8s = K8S(app_name=session.name)
-    # Init of the procedure
-    containers = []
-    exposed_urls = []
+    try:
+        k8s.wait_pod_running(settings.K8S_POD_READY_TIMEOUT)
+        return True
+    except DeadlineExceeded:
+        if purge and purge_sessions():
+            update_session_status(session, _('Impossible to deploy successfully, trying to remove old sessions'))
+            return wait_pod(k8s, session, purge=False)
+        update_session_status(session, _('Impossible to deploy successfully, all the resources are being used'))
+        return False
 
-    db_IP_address = None
-    if session.session_type.database:
-        data = session.session_type.db_data or []
 
-        db_IP_address, _ = deploy_db(session, data)
-        if not db_IP_address:
-            update_session_status(session, _('An error within the image prevented from a correct deployment'))
-            return
+def external_ip_pooling(k8s, session, purge=True, percentage=36):
+    if not wait_pod(k8s, session, purge):
+        return None
+    update_session_status(session, _('Waiting for the IP address'), percentage)
+    try:
+        return k8s.wait_service_ip(settings.K8S_SERVICE_READY_TIMEOUT)
+    except DeadlineExceeded:
+        return None
 
-    # collecting all the containers
-    subdomains = list(range(100, 200))
-    random.shuffle(subdomains)
-    for ep in endpoint:
-        bind_url = ExposedUrl.objects.create(
-            session=session,
-            vng_endpoint=ep,
-            subdomain='{}{}'.format(int(time.time()), subdomains.pop()),
-            port=ep.port
-        )
-        exposed_urls.append(bind_url)
 
+def docker_containers(session_type, name, db_IP_address=None):
+    containers = []
+    for ep in VNGEndpoint.objects.filter(session_type=session_type):
         if ep.docker_image:
-            k8s.initialize()
-            env_var = bind_url.vng_endpoint.environmentalvariables_set.all()
+            env_var = ep.environmentalvariables_set.all()
             variables = {v.key: v.value for v in env_var}
 
             if db_IP_address:
                 variables['DB_HOST'] = db_IP_address
             container = Container(
-                name=session.name,
+                name=name,
                 image=ep.docker_image,
                 public_port=ep.port,
                 private_port=ep.port,
                 variables=variables
             )
             containers.append(container)
-    if len(containers) != 0:
-        update_session_status(session, _('Docker image installation on Kubernetes'), 10)
-        deployment = Deployment(
+    return containers
+
+
+def bind_endpoints(session, endpoints, ip=None):
+    subdomains = list(range(100, 200))
+    random.shuffle(subdomains)
+    return [
+        ExposedUrl.objects.create(
+            session=session,
+            vng_endpoint=ep,
+            subdomain='{}{}'.format(int(time.time()), subdomains.pop()),
+            port=ep.port,
+            docker_url=ip
+        ) for ep in endpoints
+    ]
+
+
+def deploy_docker_environment(session, purge=True):
+    '''
+    Deploy the docker images of the endpoints of the session (or of the warm
+    environment) with their database, return the IP address or None when the
+    deployment failed. With `purge` the old sessions are stopped when the
+    cluster has no resources left.
+    '''
+    k8s = K8S(app_name=session.name)
+    k8s.initialize()
+
+    db_IP_address = None
+    if session.session_type.database:
+        data = session.session_type.db_data or []
+
+        db_IP_address, k8s_db = deploy_db(session, data)
+        if not db_IP_address:
+            update_session_status(session, _('An error within the image prevented from a correct deployment'))
+            return None
+
+    containers = docker_containers(session.session_type, session.name, db_IP_address)
+    update_session_status(session, _('Docker image installation on Kubernetes'), 10)
+    Manifest([
+        Deployment(
             name=session.name,
             labels=session.name,
+            session=session.name,
             containers=containers
-        ).execute()
-        lb = LoadBalancer(
+        ),
+        LoadBalancer(
             name='{}-loadbalancer'.format(session.name),
             app=session.name,
+            session=session.name,
             containers=containers
-        ).execute()
-        ip = external_ip_pooling(k8s, session)
+        ),
+    ]).apply()
+    ip = external_ip_pooling(k8s, session, purge)
+    if not ip:
+        update_session_status(session, _('An error within the image prevented from a correct deployment'))
+    return ip
+
+
+def needs_environment(session_type):
+    return session_type.ZGW_images or VNGEndpoint.objects.filter(
+        session_type=session_type, docker_image__isnull=False
+    ).exclude(docker_image='').exists()
+
+
+@app.task
+def bootstrap_session(session_pk, purged=False):
+    '''
+    Create all the necessary endpoint and exposes it so they can be used as proxy
+    In case there is one or multiple docker images linked, it starts all of them,
+    or it takes a ready environment from the warm pool of the session type
+    '''
+    session = Session.objects.get(pk=session_pk)
+    if claim_environment(session):
+        return
+    if session.session_type.ZGW_images:
+        ZGW_deploy(session)
+        return
+    update_session_status(session, _('Connecting to Kubernetes'), 1)
+    endpoint = VNGEndpoint.objects.filter(session_type=session.session_type)
+    exposed_urls = bind_endpoints(session, endpoint)
+
+    if any(ep.docker_image for ep in endpoint):
+        ip = deploy_docker_environment(session)
         if not ip:
-            update_session_status(session, _('An error within the image prevented from a correct deployment'))
             return
         for ex in exposed_urls:
             ex.docker_url = ip
@@ -286,6 +484,132 @@ def bootstrap_session(session_pk, purged=False):
     session.save()
 
 
+def claim_environment(session):
+    '''
+    Bind the oldest ready environment of the warm pool of the session type to
+    the session, return whether there was one
+    '''
+    session_type = session.session_type
+    if not session_type.warm_pool_size:
+        return False
+    with transaction.atomic():
+        environment = (
+            WarmEnvironment.objects
+            .select_for_update(skip_locked=True)
+            .filter(session_type=session_type, status=choices.StatusChoices.running, claimed__isnull=True)
+            .order_by('ready')
+            .first()
+        )
+        if environment is None:
+            logger.info('Warm pool of %s is empty, deploying session %s', session_type, session.name)
+            return False
+        environment.session = session
+        environment.claimed = timezone.now()
+        environment.save()
+        if session_type.ZGW_images:
+            containers, bindings = zgw_containers(session_type, environment.name)
+            bind_zgw(session, bindings, environment.docker_url)
+        else:
+            bind_endpoints(session, VNGEndpoint.objects.filter(session_type=session_type), environment.docker_url)
+        session.status = choices.StatusChoices.running
+        update_session_status(session, _('Installation performed successfully'), 100)
+    logger.info(
+        'Session %s claimed the warm environment %s, ready since %s', session.name, environment.name, environment.ready
+    )
+    refill_warm_pools.delay()
+    return True
+
+
+@app.task
+def provision_environment(environment_pk):
+    environment = WarmEnvironment.objects.get(pk=environment_pk)
+    session_type = environment.session_type
+    # nobody waits for the environment, the sessions of the users are never purged to make room for it
+    try:
+        if session_type.ZGW_images:
+            containers, bindings = zgw_containers(session_type, environment.name)
+            ip = deploy_zgw_environment(environment, containers, [c for c, vng_endpoint in bindings], purge=False)
+        else:
+            ip = deploy_docker_environment(environment, purge=False)
+    except EnvironmentRemoved:
+        # the objects created since the removal are deleted
+        K8S(app_name=environment.name).delete()
+        return
+    if ip is None:
+        WarmEnvironment.objects.filter(pk=environment.pk).update(status=choices.StatusChoices.error_deploy)
+        return
+    ready = WarmEnvironment.objects.filter(pk=environment.pk, status=choices.StatusChoices.starting).update(
+        status=choices.StatusChoices.running, docker_url=ip, ready=timezone.now(), deploy_percentage=100
+    )
+    if not ready:
+        # removed from the pool while it was deployed
+        K8S(app_name=environment.name).delete()
+
+
+def remove_environments(environments):
+    for environment in environments:
+        K8S(app_name=environment.name).delete()
+
+
+@app.task
+def refill_warm_pools():
+    '''
+    Keep the configured number of available environments in the warm pool of
+    each session type, removing the failed ones and the ones unused for too
+    long. Return the state of each pool.
+    '''
+    report = {}
+    now = timezone.now()
+    available = [choices.StatusChoices.starting, choices.StatusChoices.running]
+    session_types = SessionType.objects.filter(
+        Q(warm_pool_size__gt=0) |
+        Q(warmenvironment__status__in=available + [choices.StatusChoices.error_deploy], warmenvironment__claimed__isnull=True)
+    ).distinct()
+    for session_type in session_types:
+        size = session_type.warm_pool_size if needs_environment(session_type) else 0
+        idle = now - timedelta(minutes=session_type.warm_pool_max_idle)
+        with transaction.atomic():
+            # the refills of the pool run one at a time
+            SessionType.objects.select_for_update().get(pk=session_type.pk)
+            pool = WarmEnvironment.objects.select_for_update(skip_locked=True).filter(
+                session_type=session_type, claimed__isnull=True
+            )
+            failed = list(pool.filter(status=choices.StatusChoices.error_deploy))
+            evicted = list(pool.filter(
+                Q(status=choices.StatusChoices.running, ready__lte=idle) |
+                Q(status=choices.StatusChoices.starting, created__lte=idle)
+            ))
+            ready = list(
+                pool.filter(status=choices.StatusChoices.running)
+                .exclude(pk__in=[e.pk for e in evicted])
+                .order_by('ready')
+            )
+            starting = len(pool.filter(status=choices.StatusChoices.starting).exclude(pk__in=[e.pk for e in evicted]))
+            surplus = ready[:max(len(ready) + starting - size, 0)]
+            removed = failed + evicted + surplus
+            WarmEnvironment.objects.filter(pk__in=[e.pk for e in removed]).update(status=choices.StatusChoices.stopped)
+
+            started = []
+            for i in range(max(size - len(ready) - starting, 0)):
+                environment = WarmEnvironment.objects.create(
+                    session_type=session_type,
+                    name=WarmEnvironment.assign_name()
+                )
+                started.append(environment)
+                transaction.on_commit(lambda pk=environment.pk: provision_environment.delay(pk))
+        remove_environments(removed)
+        report[session_type.name] = {
+            'size': size,
+            'ready': len(ready) - len(surplus),
+            'starting': starting + len(started),
+            'started': len(started),
+            'evicted': len(evicted) + len(surplus),
+            'failed': len(failed),
+        }
+    logger.info('Warm pools: %s', report)
+    return report
+
+
 @app.task
 def run_tests(session_pk):
     session = Session.objects.get(pk=session_pk)
@@ -306,10 +630,10 @@ def run_tests(session_pk):
             newman.replace_parameters({
                 ep.name: '{}:{}{}'.format(eu.docker_url, ep.port, ep.path)
             })
-        result = newman.execute_test()
+        result, result_json = newman.execute_reports()
         ts = TestSession()
         ts.save_test(result)
-        with newman.execute_test_json() as result_json:
+        with result_json:
             ts.save_test_json(result_json)
 
         ts.save()
@@ -317,6 +641,6 @@ def run_tests(session_pk):
         eu.save()
 
     session.status = choices.StatusChoices.stopped
-    session.save()
+    session.save(update_fields=['status'])
 
     VNGEndpoint.objects.filter(session_type=session.session_type)
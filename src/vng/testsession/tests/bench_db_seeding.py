@@ -0,0 +1,98 @@
+"""
+Benchmark of the seeding of the database of a ZGW session.
+
+Compares the time from the database pod running to the preconfigured models
+bound to the IP address of the session, between the replay of the dump
+(copied in the pod and loaded with psql once the database is up) and the
+snapshot loaded by the container at its initialization followed by the
+update of the hosts.
+It deploys databases on the configured Kubernetes cluster, so it is not
+collected by the test runner, run it explicitly with:
+
+    python src/manage.py test vng.testsession.tests.bench_db_seeding
+
+The number of deployments of each path can be set with BENCH_RUNS (default 3)
+"""
+import os
+import tempfile
+import time
+import uuid
+from types import SimpleNamespace
+
+from django.conf import settings
+from django.test import SimpleTestCase
+
+from ...k8s_manager.client import get_client
+from ...k8s_manager.container_manager import RESOURCES
+from ...k8s_manager.kubernetes import SESSION_LABEL
+from .. import db_snapshot
+from ..gemma_containers import postgis
+from ..task import bind_snapshot, deploy_db
+
+BENCH_IP = '10.0.0.1'
+
+
+def replay_dump(k8s_db, ip):
+    '''
+    Previous seeding: the dump bound to the IP address, copied in the pod and replayed
+    '''
+    handle, new_file = tempfile.mkstemp(suffix='.sql')
+    with os.fdopen(handle, 'w') as out_file:
+        out_file.write(db_snapshot.read_dump().replace(db_snapshot.HOST_PLACEHOLDER, ip))
+    try:
+        k8s_db.copy_to(new_file, 'dump.sql')
+    finally:
+        os.remove(new_file)
+    k8s_db.exec(['psql', '-f', 'dump.sql', '-U', 'postgres'])
+
+
+class BenchmarkDbSeeding(SimpleTestCase):
+
+    def setUp(self):
+        self.runs = int(os.getenv('BENCH_RUNS', '3'))
+        self.sessions = []
+
+    def tearDown(self):
+        client = get_client()
+        for session in self.sessions:
+            for resource in ('deployments', 'configmaps'):
+                for item in client.list(*RESOURCES[resource], label_selector='{}={}'.format(SESSION_LABEL, session.name)):
+                    client.delete(*RESOURCES[resource], item['metadata']['name'])
+
+    def deploy(self, data, filename=None):
+        session = SimpleNamespace(name='bench-{}'.format(uuid.uuid4().hex[:8]))
+        self.sessions.append(session)
+        ip, k8s_db = deploy_db(session, data, filename)
+        self.assertIsNotNone(ip)
+        return k8s_db
+
+    def assertBound(self, k8s_db):
+        domains = k8s_db.exec(['psql', '-U', 'postgres', '-d', 'zrc', '-tA', '-c', 'SELECT domain FROM django_site'])
+        self.assertIn(BENCH_IP, domains)
+
+    def replay(self):
+        k8s_db = self.deploy(postgis.data)
+        start = time.perf_counter()
+        k8s_db.wait_log(k8s_db.app_name, db_snapshot.SEEDED_LOG, settings.K8S_DB_SEED_TIMEOUT)
+        replay_dump(k8s_db, BENCH_IP)
+        elapsed = time.perf_counter() - start
+        self.assertBound(k8s_db)
+        return elapsed
+
+    def snapshot(self):
+        k8s_db = self.deploy([db_snapshot.snapshot_sql()], db_snapshot.SNAPSHOT_FILENAME)
+        start = time.perf_counter()
+        k8s_db.wait_log(k8s_db.app_name, db_snapshot.SEEDED_LOG, settings.K8S_DB_SEED_TIMEOUT)
+        bind_snapshot(k8s_db, BENCH_IP)
+        elapsed = time.perf_counter() - start
+        self.assertBound(k8s_db)
+        return elapsed
+
+    def test_benchmark(self):
+        print('\n{:>10} {:>9} {:>9} {:>9}'.format('path', 'min (s)', 'mean (s)', 'max (s)'))
+        means = {}
+        for name, seed in [('replay', self.replay), ('snapshot', self.snapshot)]:
+            timings = [seed() for i in range(self.runs)]
+            means[name] = sum(timings) / len(timings)
+            print('{:>10} {:>9.2f} {:>9.2f} {:>9.2f}'.format(name, min(timings), means[name], max(timings)))
+        print('speedup: x{:.1f}'.format(means['replay'] / means['snapshot']))
@@ -0,0 +1,180 @@
+"""
+Load test of the RunTest proxy against a local stub upstream.
+
+Every request goes through the whole proxy path (routing, header injection,
+body rewriting, scenario matching and logging) to a stub service running in
+a thread of the test process, so the numbers measure the proxy itself.
+It is not collected by the test runner, run it explicitly with:
+
+    python src/manage.py test vng.testsession.tests.bench_proxy
+
+Configuration through the environment:
+
+    BENCH_CONCURRENCY   concurrent clients, e.g. 1,8 (default 1,4,16)
+    BENCH_REQUESTS      requests per run (default 200)
+    BENCH_BODY_SIZES    size of the upstream bodies in KB, e.g. 1,256 (default 1,64,1024)
+    BENCH_MAX_P95_MS    fail when the p95 latency of a run exceeds it
+    BENCH_MAX_QUERIES   fail when the queries per request of a run exceed it
+"""
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from django.db import connection
+from django.test import Client, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from ...utils import choices, http_pool
+from .. import log_pipeline
+from ..models import SessionLog
+from .factories import ExposedUrlFactory, ScenarioCaseFactory, SessionFactory, VNGEndpointFactory
+
+N_WARMUP = 5
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    '''
+    Answers every GET with the JSON body of the server, the other methods
+    echo the request body back
+    '''
+    protocol_version = 'HTTP/1.1'
+
+    def reply(self, body):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.reply(self.server.body)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        self.reply(self.rfile.read(length))
+
+    def log_message(self, *args):
+        pass
+
+
+def build_body(base_url, size):
+    items = []
+    length = 0
+    i = 0
+    while length < size:
+        item = {
+            'url': '{}/zaken/{}'.format(base_url, i),
+            'zaaktype': '{}/zaaktypen/{}'.format(base_url, i),
+            'omschrijving': 'Zaak {}'.format(i),
+        }
+        length += len(json.dumps(item)) + 2
+        items.append(item)
+        i += 1
+    return json.dumps(items).encode('utf-8')
+
+
+def percentile(values, p):
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(p / 100 * len(values))) - 1))
+    return values[index]
+
+
+@override_settings(SUBDOMAIN_SEPARATOR='-', ALLOWED_HOSTS=['*'])
+class BenchmarkProxy(TransactionTestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+        self.server.body = b''
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base_url = 'http://127.0.0.1:{}/api/v1'.format(self.server.server_address[1])
+
+        session = SessionFactory(status=choices.StatusChoices.running)
+        vng_endpoint = VNGEndpointFactory(url=self.base_url, session_type=session.session_type)
+        for url, method in [
+            ('zaken', choices.HTTPMethodChoices.GET),
+            ('zaken', choices.HTTPMethodChoices.POST),
+            ('zaken/{uuid}', choices.HTTPMethodChoices.GET),
+            ('zaaktypen', choices.HTTPMethodChoices.GET),
+        ]:
+            ScenarioCaseFactory(vng_endpoint=vng_endpoint, url=url, http_method=method)
+        self.exposed_url = ExposedUrlFactory(session=session, vng_endpoint=vng_endpoint)
+        self.host = '{}-example.com'.format(self.exposed_url.subdomain)
+
+        self.concurrency = [int(c) for c in os.getenv('BENCH_CONCURRENCY', '1,4,16').split(',')]
+        self.requests = int(os.getenv('BENCH_REQUESTS', '200'))
+        self.sizes = [float(s) for s in os.getenv('BENCH_BODY_SIZES', '1,64,1024').split(',')]
+        self.max_p95 = os.getenv('BENCH_MAX_P95_MS')
+        self.max_queries = os.getenv('BENCH_MAX_QUERIES')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        http_pool.reset_pools()
+
+    def call(self, client, i):
+        '''
+        Perform the i-th request, return its latency and its number of queries
+        '''
+        payload = json.dumps({'zaaktype': '{}/zaaktypen/{}'.format(self.base_url, i)})
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            if i % 4 == 3:
+                response = client.post('/zaken', payload, content_type='application/json', HTTP_HOST=self.host)
+            else:
+                response = client.get('/zaken', HTTP_HOST=self.host)
+            if response.streaming:
+                b''.join(response.streaming_content)
+            elapsed = time.perf_counter() - start
+        self.assertEqual(response.status_code, 200)
+        return elapsed, len(queries)
+
+    def run_load(self, concurrency):
+        clients = threading.local()
+
+        def task(i):
+            if not hasattr(clients, 'client'):
+                clients.client = Client()
+            try:
+                return self.call(clients.client, i)
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(task, range(N_WARMUP)))
+            log_pipeline.flush()
+            start = time.perf_counter()
+            results = list(executor.map(task, range(self.requests)))
+            log_pipeline.flush()
+            elapsed = time.perf_counter() - start
+        return elapsed, results
+
+    def test_benchmark(self):
+        print('\n{:>8} {:>6} {:>9} {:>9} {:>9} {:>9} {:>9}'.format(
+            'KB', 'conc', 'p50 (ms)', 'p95 (ms)', 'p99 (ms)', 'req/s', 'queries'))
+        failures = []
+        for size in self.sizes:
+            self.server.body = build_body(self.base_url, int(size * 1024))
+            for concurrency in self.concurrency:
+                elapsed, results = self.run_load(concurrency)
+                latencies = [r[0] * 1000 for r in results]
+                queries = sum(r[1] for r in results) / len(results)
+                p95 = percentile(latencies, 95)
+                print('{:>8} {:>6} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.1f} {:>9.1f}'.format(
+                    size, concurrency, percentile(latencies, 50), p95, percentile(latencies, 99),
+                    len(results) / elapsed, queries))
+                if self.max_p95 is not None and p95 > float(self.max_p95):
+                    failures.append('{}KB x{}: p95 {:.2f}ms'.format(size, concurrency, p95))
+                if self.max_queries is not None and queries > float(self.max_queries):
+                    failures.append('{}KB x{}: {:.1f} queries per request'.format(size, concurrency, queries))
+
+        print('upstream pool: {}'.format(http_pool.pool_stats()))
+        self.assertTrue(SessionLog.objects.filter(session=self.exposed_url.session).exists())
+        self.assertFalse(failures, 'Thresholds exceeded: {}'.format(', '.join(failures)))
@@ -0,0 +1,82 @@
+"""
+Benchmark of the rewriting of the proxied bodies.
+
+Compares the single-pass rewriter with the previous implementation (one
+uncompiled re.sub per exposed url) on multi-megabyte JSON list responses.
+It is not collected by the test runner, run it explicitly with:
+
+    python src/manage.py test vng.testsession.tests.bench_rewrite
+
+The body sizes (in MB) can be set with BENCH_BODY_SIZES, e.g. BENCH_BODY_SIZES=1,8
+"""
+import json
+import os
+import re
+import time
+
+from django.test import TestCase, override_settings
+
+from ..rewriter import SessionRewriter, get_host, url_pair
+from .factories import ExposedUrlFactory, SessionFactory, VNGEndpointFactory
+
+N_ENDPOINTS = 6
+N_RUNS = 3
+
+
+def legacy_rewrite(content, endpoints):
+    parsed = content
+    for ep in endpoints:
+        source, target = url_pair(get_host(ep), ep)
+        parsed = re.sub(source, target, parsed)
+    return parsed
+
+
+def build_body(endpoints, size):
+    items = []
+    length = 0
+    i = 0
+    while length < size:
+        ep = endpoints[i % len(endpoints)]
+        item = {
+            'url': '{}/zaken/{}'.format(ep.vng_endpoint.url, i),
+            'zaaktype': '{}/zaaktypen/{}'.format(ep.vng_endpoint.url, i),
+            'omschrijving': 'Zaak {}'.format(i),
+            'status': None,
+        }
+        length += len(json.dumps(item)) + 2
+        items.append(item)
+        i += 1
+    return json.dumps(items)
+
+
+def timed(func, *args):
+    best = None
+    for _ in range(N_RUNS):
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+@override_settings(SUBDOMAIN_SEPARATOR='-')
+class BenchmarkRewriting(TestCase):
+
+    def setUp(self):
+        session = SessionFactory()
+        self.endpoints = [
+            ExposedUrlFactory(
+                session=session,
+                vng_endpoint=VNGEndpointFactory(url='https://ref.tst.vng.cloud/c{}/api/v1'.format(i))
+            ) for i in range(N_ENDPOINTS)
+        ]
+        self.sizes = [float(s) for s in os.getenv('BENCH_BODY_SIZES', '1,4,16').split(',')]
+
+    def test_benchmark(self):
+        print('\n{:>8} {:>12} {:>12} {:>8}'.format('MB', 'legacy (s)', 'single (s)', 'speedup'))
+        for size in self.sizes:
+            body = build_body(self.endpoints, int(size * 1024 * 1024))
+            legacy_time, legacy = timed(legacy_rewrite, body, self.endpoints)
+            single_time, single = timed(lambda: SessionRewriter(self.endpoints).rewrite_response(body))
+            self.assertEqual(legacy, single)
+            print('{:>8} {:>12.4f} {:>12.4f} {:>7.1f}x'.format(size, legacy_time, single_time, legacy_time / single_time))
@@ -1,13 +1,22 @@
+import asyncio
 import collections
 import re
 import json
 import copy
+import threading
+import time
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
 
 import mock
 import factory
+import jwt
 
 from django.conf import settings
+from django.core.cache import cache
+from django.db import DatabaseError, connection
 from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django.utils import timezone
 from django.utils.translation import gettext
@@ -16,12 +25,24 @@ from subdomains.utils import reverse as reverse_sub
 from django_webtest import WebTest
 
 from vng.accounts.models import User
+from vng.k8s_manager.client import DeadlineExceeded
 
-from ..task import run_tests, align_sessions_data, purge_sessions
-from ..api_views import RunTest
+from ..task import (
+    run_tests, align_sessions_data, purge_sessions, bootstrap_session, claim_environment, refill_warm_pools,
+    reconcile_sessions, provision_environment, stop_session
+)
+from ..api_views import RunTest, StopSessionView
+from ..async_proxy import ProxyRouter, build_environ, close_client, get_proxy_request
+from .. import db_snapshot, log_pipeline
+from ..deploy_pipeline import DeployPipeline
+from ..log_pipeline import LogPipeline, LogRecord, persist
+from ..matcher import get_matcher
+from ..results import SessionResult
+from ..rewriter import get_rewriter
+from ..routing import get_routing
 from ..models import (
     Session, SessionType, SessionLog, Report,
-    ScenarioCase, VNGEndpoint, ExposedUrl, TestSession
+    ScenarioCase, VNGEndpoint, ExposedUrl, TestSession, WarmEnvironment
 )
 from ..permission import IsOwner
 
@@ -30,7 +51,8 @@ from .factories import (
     ScenarioCaseFactory, ExposedUrlFactory, SessionLogFactory, VNGEndpointFactory, QueryParamsScenarioFactory,
     HeaderInjectionFactory, FilerField
 )
-from ...utils import choices
+from ...utils import auth, choices, http_pool
+from ...utils.auth import CachedClientAuth, clear_jwt_cache, jwt_cache_stats
 from ...utils.factories import UserFactory
 
 
@@ -778,6 +800,26 @@ class TestRewriteBody(WebTest):
         res = self.euv.sub_url_response(content, self.host, self.ep_d)
         self.assertEqual('dummy{}/dummy'.format(self.host), res)
 
+    def test_session_rewriter(self):
+        ep2 = ExposedUrlFactory(session=self.ep.session, vng_endpoint=VNGEndpointFactory(url='https://ref.tst.vng.cloud/zrc/api/v1'))
+        rewriter = get_rewriter([self.ep, ep2])
+        content = json.dumps([
+            {'url': '{}/zaken/1'.format(ep2.vng_endpoint.url)},
+            {'url': '{}/enkelvoudiginformatieobjecten/1'.format(self.ep.vng_endpoint.url)},
+        ])
+        rewritten = rewriter.rewrite_response(content)
+        self.assertNotIn('ref.tst.vng.cloud', rewritten)
+        self.assertIn(ep2.subdomain, rewritten)
+        self.assertIn(self.ep.subdomain, rewritten)
+        self.assertEqual(content, rewriter.rewrite_request(rewritten))
+        self.assertIs(rewriter, get_rewriter([self.ep, ep2]))
+
+    def test_session_rewriter_stream(self):
+        rewriter = get_rewriter([self.ep])
+        content = json.dumps([{'url': '{}/enkelvoudiginformatieobjecten/{}'.format(self.ep.vng_endpoint.url, i)} for i in range(50)])
+        chunks = [content[i:i + 7] for i in range(0, len(content), 7)]
+        self.assertEqual(rewriter.rewrite_response(content), ''.join(rewriter.rewrite_response_stream(chunks)))
+
 
 @override_settings(SUBDOMAIN_SEPARATOR='-')
 class TestRewriteUrl(WebTest):
@@ -914,3 +956,761 @@ class TestMultipleParams(WebTest):
             }
         ))
         self.assertEqual(call.json['message'], 'Success')
+
+
+class TestScenarioMatcher(WebTest):
+
+    def setUp(self):
+        self.ep = VNGEndpointFactory()
+        self.sc = ScenarioCaseFactory(vng_endpoint=self.ep, url='zaken/{uuid}')
+        self.sc_param = ScenarioCaseFactory(vng_endpoint=self.ep, url='zaken/{uuid}')
+        QueryParamsScenarioFactory(scenario_case=self.sc_param, name='status')
+        self.sc_post = ScenarioCaseFactory(vng_endpoint=self.ep, url='zaken', http_method=choices.HTTPMethodChoices.POST)
+        self.session_type_id = self.ep.session_type_id
+
+    def test_match(self):
+        matcher = get_matcher(self.session_type_id)
+        url = 'http://123-example.com/zaken/1234'
+        self.assertEqual(matcher.match('get', url, {}), self.sc)
+        self.assertEqual(matcher.match('get', url, {'status': 'open'}), self.sc_param)
+        self.assertEqual(matcher.match('post', 'http://123-example.com/zaken', {}), self.sc_post)
+        self.assertIsNone(matcher.match('delete', url, {}))
+        self.assertIsNone(matcher.match('get', 'http://123-example.com/besluiten/1234', {}))
+
+    def test_cached(self):
+        get_matcher(self.session_type_id)
+        with self.assertNumQueries(0):
+            get_matcher(self.session_type_id)
+
+    def test_invalidation(self):
+        matcher = get_matcher(self.session_type_id)
+        sc = ScenarioCaseFactory(vng_endpoint=self.ep, url='besluiten/{uuid}')
+        self.assertIsNone(matcher.match('get', 'http://123-example.com/besluiten/1234', {}))
+        self.assertEqual(get_matcher(self.session_type_id).match('get', 'http://123-example.com/besluiten/1234', {}), sc)
+
+
+class TestLogPipeline(WebTest):
+
+    def setUp(self):
+        self.sc = ScenarioCaseFactory()
+        self.session = SessionFactory(session_type=self.sc.vng_endpoint.session_type)
+
+    def record(self, status_code, sandbox=False):
+        session_log = SessionLog(session=self.session, request='{}', response='{}', response_status=status_code)
+        return LogRecord(
+            uuid=session_log.uuid, session_id=self.session.pk, date=session_log.date,
+            request=session_log.request, response=session_log.response, response_status=status_code,
+            status_code=status_code, scenario_case_id=self.sc.pk, sandbox=sandbox
+        )
+
+    def test_batch_keeps_order(self):
+        persist([self.record(200), self.record(404), self.record(200)])
+        self.assertEqual(SessionLog.objects.filter(session=self.session).count(), 3)
+        report = Report.objects.get(scenario_case=self.sc)
+        self.assertEqual(report.result, choices.HTTPCallChoices.failed)
+
+    def test_batch_sandbox(self):
+        persist([self.record(404, sandbox=True), self.record(200, sandbox=True)])
+        persist([self.record(201, sandbox=True)])
+        report = Report.objects.get(scenario_case=self.sc)
+        self.assertEqual(report.result, choices.HTTPCallChoices.success)
+        self.assertEqual(report.session_log.response_status, 201)
+
+    def test_report_counters(self):
+        ScenarioCaseFactory(vng_endpoint=self.sc.vng_endpoint)
+        persist([self.record(200)])
+        self.session.refresh_from_db()
+        self.assertEqual(self.session.get_report_stats(), (1, 0, 1))
+        persist([self.record(404), self.record(200)])
+        self.session.refresh_from_db()
+        self.assertEqual(self.session.get_report_stats(), (0, 1, 1))
+
+        report = Report.objects.get(scenario_case=self.sc)
+        report.result = choices.HTTPCallChoices.not_called
+        report.save()
+        self.session.refresh_from_db()
+        self.assertEqual((self.session.success_count, self.session.failed_count, self.session.not_called_count), (0, 0, 1))
+        report.delete()
+        self.session.refresh_from_db()
+        self.assertEqual(self.session.get_report_stats(), (0, 0, 2))
+
+    def test_stale_session_keeps_counters(self):
+        stale = Session.objects.get(pk=self.session.pk)
+        # a call is written while the session is stopped
+        with mock.patch('vng.testsession.api_views.stop_session') as mock_stop, \
+                mock.patch('vng.testsession.api_views.run_tests'):
+            mock_stop.delay.side_effect = lambda pk: persist([self.record(200)])
+            StopSessionView().perform_operations(stale)
+        self.session.refresh_from_db()
+        self.assertEqual(self.session.status, choices.StatusChoices.shutting_down)
+        self.assertEqual(self.session.success_count, 1)
+
+    def test_loaded_session_refreshed(self):
+        persist([self.record(200)])
+        report = Report.objects.select_related('session_log__session').get(scenario_case=self.sc)
+        report.result = choices.HTTPCallChoices.failed
+        report.save()
+        session = report.session_log.session
+        self.assertEqual((session.success_count, session.failed_count), (0, 1))
+        # a full save writes the current counters
+        session.save()
+        self.session.refresh_from_db()
+        self.assertEqual((self.session.success_count, self.session.failed_count), (0, 1))
+
+    def test_deleted_session_saved(self):
+        session = Session.objects.get(pk=self.session.pk)
+        Session.objects.filter(pk=session.pk).delete()
+        session.save()
+        self.assertTrue(Session.objects.filter(pk=session.pk).exists())
+
+    def test_written_once(self):
+        record = self.record(200)
+        persist([record])
+        persist([record])
+        self.assertEqual(SessionLog.objects.filter(session=self.session).count(), 1)
+
+
+class FakeRedis:
+    '''
+    List and lock of Redis, shared by the pipelines of several processes
+    '''
+
+    def __init__(self):
+        self.items = []
+        self.mutex = threading.Lock()
+
+    def rpush(self, key, value):
+        self.items.append(value.encode('utf-8'))
+        return len(self.items)
+
+    def lrange(self, key, start, end):
+        return self.items[start:end + 1]
+
+    def ltrim(self, key, start, end):
+        del self.items[:start]
+
+    def lock(self, name, timeout=None, blocking_timeout=None):
+        return FakeLock(self.mutex)
+
+
+class FakeLock:
+
+    def __init__(self, mutex):
+        self.mutex = mutex
+
+    def acquire(self, blocking=True):
+        return self.mutex.acquire(blocking)
+
+    def release(self):
+        self.mutex.release()
+
+
+@override_settings(SESSION_LOG_WRITE_BEHIND=True, SESSION_LOG_BATCH_SIZE=2)
+@mock.patch.object(LogPipeline, 'ensure_consumer')
+class TestLogQueue(WebTest):
+
+    def setUp(self):
+        self.sc = ScenarioCaseFactory()
+        self.session = SessionFactory(session_type=self.sc.vng_endpoint.session_type)
+        self.redis = FakeRedis()
+        # a process serving the proxy and a worker stopping the session
+        self.web, self.worker = LogPipeline(), LogPipeline()
+        self.web.connection = self.worker.connection = self.redis
+
+    def enqueue(self, *status_codes):
+        for status_code in status_codes:
+            session_log = SessionLog(session=self.session, request='{}', response='{}', response_status=status_code)
+            self.web.enqueue(LogRecord(
+                uuid=session_log.uuid, session_id=self.session.pk, date=session_log.date,
+                request=session_log.request, response=session_log.response, response_status=status_code,
+                status_code=status_code, scenario_case_id=self.sc.pk, sandbox=False
+            ))
+
+    def test_shared_queue(self, ensure_consumer):
+        self.enqueue(200, 404, 200)
+        self.assertFalse(SessionLog.objects.filter(session=self.session).exists())
+
+        # the calls queued by a process are written by another one, in order
+        self.assertTrue(self.worker.flush())
+        self.assertEqual(SessionLog.objects.filter(session=self.session).count(), 3)
+        self.assertEqual(Report.objects.get(scenario_case=self.sc).result, choices.HTTPCallChoices.failed)
+        self.assertEqual(self.redis.items, [])
+
+    def test_failed_batch(self, ensure_consumer):
+        self.enqueue(200, 404)
+        with mock.patch('vng.testsession.log_pipeline.persist', side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                self.worker.flush()
+        # the batch stays queued and is written by the next flush
+        self.assertEqual(len(self.redis.items), 2)
+        self.assertTrue(self.worker.flush())
+        self.assertEqual(SessionLog.objects.filter(session=self.session).count(), 2)
+
+    def test_flush_in_progress(self, ensure_consumer):
+        self.enqueue(200)
+        self.redis.mutex.acquire()
+        self.assertFalse(self.web.flush(blocking=False))
+        self.redis.mutex.release()
+        self.assertEqual(len(self.redis.items), 1)
+
+    @mock.patch('vng.testsession.task.run_tests')
+    def test_stop_retried(self, mock_run_tests, ensure_consumer):
+        with mock.patch('vng.testsession.task.log_pipeline.flush', side_effect=[False, True]) as mock_flush:
+            stop_session.delay(self.session.pk)
+        # scored once the queue is written
+        self.assertEqual(mock_flush.call_count, 2)
+        mock_run_tests.assert_called_once_with(self.session.pk)
+        self.assertEqual(Session.objects.get(pk=self.session.pk).status, choices.StatusChoices.stopped)
+
+    @mock.patch('vng.testsession.task.run_tests')
+    def test_stop_not_flushed(self, mock_run_tests, ensure_consumer):
+        with mock.patch('vng.testsession.task.log_pipeline.flush', return_value=False), \
+                self.assertLogs('vng.testsession.task', 'WARNING'):
+            stop_session(self.session.pk)
+        mock_run_tests.assert_called_once_with(self.session.pk)
+
+
+class TestRoutingCache(WebTest):
+
+    def setUp(self):
+        self.eu = ExposedUrlFactory()
+        HeaderInjectionFactory(session_type=self.eu.session.session_type)
+
+    def test_cached(self):
+        routing = get_routing(self.eu.subdomain)
+        self.assertEqual(routing.session, self.eu.session)
+        self.assertEqual(routing.inject_headers, [('key', 'dummy')])
+        with self.assertNumQueries(0):
+            get_routing(self.eu.subdomain)
+
+    def test_invalidation(self):
+        get_routing(self.eu.subdomain)
+        self.eu.session.status = choices.StatusChoices.stopped
+        self.eu.session.save()
+        self.assertTrue(get_routing(self.eu.subdomain).session.is_stopped())
+
+
+def inline(func):
+    async def wrapper(*args, **kwargs):
+        return func(*args, **kwargs)
+    return wrapper
+
+
+def asgi_scope(host, path, method='GET'):
+    return {
+        'type': 'http',
+        'method': method,
+        'path': path,
+        'query_string': b'',
+        'http_version': '1.1',
+        'scheme': 'http',
+        'server': (host, 80),
+        'headers': [(b'host', host.encode())],
+    }
+
+
+def call_asgi(app, scope, body=b''):
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': body, 'more_body': False}
+
+    async def send(message):
+        messages.append(message)
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(app(scope, receive, send))
+        loop.run_until_complete(close_client())
+    finally:
+        loop.close()
+    return messages
+
+
+@override_settings(SUBDOMAIN_SEPARATOR='-', ALLOWED_HOSTS=['*'])
+class TestAsyncProxy(WebTest):
+
+    def setUp(self):
+        self.eu = ExposedUrlEchoFactory()
+        self.eu.session.session_type = self.eu.vng_endpoint.session_type
+        self.eu.session.save()
+        self.host = '{}-example.com'.format(self.eu.subdomain)
+
+    def test_proxy_request(self):
+        request, match = get_proxy_request(build_environ(asgi_scope(self.host, '/get'), b''))
+        self.assertEqual(request.subdomain, self.eu.subdomain)
+        self.assertEqual(match.kwargs['relative_url'], 'get')
+
+    def test_other_request(self):
+        self.assertIsNone(get_proxy_request(build_environ(asgi_scope('example.com', '/admin/'), b'')))
+
+    @mock.patch('vng.testsession.async_proxy.run_sync', inline)
+    def test_proxy_call(self):
+        fallback = mock.Mock()
+        messages = call_asgi(ProxyRouter(fallback), asgi_scope(self.host, '/get'))
+        fallback.assert_not_called()
+        self.assertEqual(messages[0]['status'], 200)
+        log_pipeline.flush()
+        self.assertEqual(SessionLog.objects.filter(session=self.eu.session).count(), 1)
+
+    @mock.patch('vng.testsession.async_proxy.run_sync', inline)
+    def test_other_request_streamed(self):
+        received = []
+
+        async def fallback(scope, receive, send):
+            received.append(await receive())
+
+        call_asgi(ProxyRouter(fallback), asgi_scope('example.com', '/admin/', method='POST'), body=b'upload')
+        # the body was not read by the router
+        self.assertEqual(received, [{'type': 'http.request', 'body': b'upload', 'more_body': False}])
+
+    @override_settings(SECURE_CONTENT_TYPE_NOSNIFF=True, X_FRAME_OPTIONS='DENY')
+    @mock.patch('vng.testsession.async_proxy._proxy_middleware', None)
+    @mock.patch('vng.testsession.async_proxy.run_sync', inline)
+    def test_security_headers(self):
+        messages = call_asgi(ProxyRouter(mock.Mock()), asgi_scope(self.host, '/get'))
+        headers = dict(messages[0]['headers'])
+        self.assertEqual(headers[b'X-Content-Type-Options'], b'nosniff')
+        self.assertEqual(headers[b'X-Frame-Options'], b'DENY')
+
+
+class TestSessionResult(WebTest):
+
+    def setUp(self):
+        self.ep = VNGEndpointFactory()
+        self.session = SessionFactory(session_type=self.ep.session_type)
+
+    def add_cases(self, n):
+        for i in range(n):
+            sc = ScenarioCaseFactory(vng_endpoint=self.ep, url='zaken/{}'.format(i))
+            QueryParamsScenarioFactory(scenario_case=sc)
+            log = SessionLogFactory(session=self.session)
+            Report.objects.create(scenario_case=sc, session_log=log, result=choices.HTTPCallChoices.success)
+
+    def test_results(self):
+        self.add_cases(2)
+        ScenarioCaseFactory(vng_endpoint=self.ep, url='zaaktypen')
+        result = SessionResult(self.session)
+        self.assertEqual(result.outcome(), 'Gedeeltelijk succesvol')
+        self.assertEqual(result.shield(), ('Not completed', 'orange', False))
+        reports = result.ordered_reports()
+        self.assertEqual([r.result for r in reports], [choices.HTTPCallChoices.success] * 2 + [choices.HTTPCallChoices.not_called])
+        self.assertEqual(len(result.all_reports()), 3)
+
+    def test_bounded_queries(self):
+        self.add_cases(10)
+        with self.assertNumQueries(3):
+            result = SessionResult(self.session)
+            for report in result.ordered_reports():
+                report.scenario_case.url
+                list(report.scenario_case.queryparamsscenario_set.all())
+                report.session_log.response_status
+            result.shield()
+
+    def test_shield_queries(self):
+        url = reverse('apiv1session:testsession-shield', kwargs={'uuid': self.session.uuid})
+        self.add_cases(2)
+        with CaptureQueriesContext(connection) as few:
+            self.app.get(url)
+        self.add_cases(10)
+        with CaptureQueriesContext(connection) as many:
+            call = self.app.get(url)
+        self.assertEqual(len(few), len(many))
+        self.assertEqual(call.json['message'], 'Success')
+
+
+class TestDeployPipeline(WebTest):
+
+    def setUp(self):
+        self.session = SessionFactory()
+        self.progress = []
+
+    def update_status(self, session, message, percentage):
+        self.progress.append((message, percentage))
+
+    def test_concurrent_steps(self):
+        start = time.monotonic()
+        with DeployPipeline(self.session, 3, self.update_status) as pipeline:
+            first = pipeline.submit('first', time.sleep, 0.3)
+            second = pipeline.submit('second', time.sleep, 0.3)
+            pipeline.result(first, 'First')
+            pipeline.result(second, 'Second')
+            pipeline.run('third', 'Third', lambda: None)
+        self.assertLess(time.monotonic() - start, 0.55)
+        self.assertEqual(self.progress, [('First', 33), ('Second', 66), ('Third', 99)])
+
+        timings = Session.objects.get(pk=self.session.pk).get_deploy_timings()
+        self.assertEqual(set(timings), {'first', 'second', 'third', 'total'})
+        self.assertGreaterEqual(timings['first'], 0.3)
+        self.assertLess(timings['total'], timings['first'] + timings['second'])
+
+    def test_failed_step(self):
+        def fail():
+            raise ValueError('failed')
+
+        with self.assertRaises(ValueError):
+            with DeployPipeline(self.session, 2, self.update_status) as pipeline:
+                pipeline.run('first', 'First', lambda: None)
+                pipeline.result(pipeline.submit('second', fail), 'Second')
+        self.assertEqual(self.progress, [('First', 49)])
+        self.assertEqual(set(Session.objects.get(pk=self.session.pk).get_deploy_timings()), {'first', 'second', 'total'})
+
+    def test_abandoned_steps(self):
+        stopped = threading.Event()
+
+        def wait(stop):
+            stop.wait(10)
+            stopped.set()
+
+        with DeployPipeline(self.session, 3, self.update_status) as pipeline:
+            started = pipeline.submit('wait', wait, pipeline.cancelled)
+            pending = [pipeline.submit('pending', time.sleep, 0.1) for i in range(settings.K8S_DEPLOY_WORKERS)]
+        # the deployment returned before collecting the steps
+        self.assertTrue(stopped.wait(2))
+        self.assertTrue(started.done())
+        self.assertTrue(any(future.cancelled() for future in pending))
+
+
+class TestDbSnapshot(WebTest):
+
+    def test_snapshot_without_roles(self):
+        snapshot = db_snapshot.snapshot_sql()
+        self.assertNotIn('CREATE ROLE postgres;', snapshot)
+        self.assertIn('CREATE DATABASE zrc', snapshot)
+        self.assertIn(db_snapshot.HOST_PLACEHOLDER, snapshot)
+
+    def test_host_columns(self):
+        columns = db_snapshot.host_columns()
+        self.assertEqual(set(columns), {'ac', 'brc', 'drc', 'nrc', 'zrc', 'ztc'})
+        self.assertIn(('public.django_site', 'domain', 'character varying(100)'), columns['zrc'])
+        self.assertIn(('public.django_admin_log', 'change_message', 'text'), columns['zrc'])
+
+    def test_rebind_command(self):
+        command = db_snapshot.rebind_command('10.0.0.1')
+        statements = command[command.index('-c') + 1::2]
+        self.assertEqual(statements[0], '\\connect ac')
+        self.assertEqual(
+            len(statements),
+            sum(len(entries) + 1 for entries in db_snapshot.host_columns().values())
+        )
+        self.assertIn(
+            "UPDATE public.django_site SET domain = replace(domain::text, 'BASE_IP', '10.0.0.1')::character varying(100) "
+            "WHERE domain::text LIKE '%BASE_IP%';",
+            statements
+        )
+
+
+class CookieHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        body = (self.headers.get('Cookie') or '').encode('utf-8')
+        self.send_response(200)
+        self.send_header('Set-Cookie', 'sessionid=secret; Path=/')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestUpstreamPool(WebTest):
+
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), CookieHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.addCleanup(http_pool.reset_pools)
+        self.url = 'http://127.0.0.1:{}/'.format(self.server.server_port)
+
+    def test_cookies_not_replayed(self):
+        first = http_pool.request('get', self.url)
+        self.assertEqual(first.headers['Set-Cookie'], 'sessionid=secret; Path=/')
+        # the next call, of any user, does not send the cookie of the upstream
+        second = http_pool.request('get', self.url)
+        self.assertEqual(second.text, '')
+        self.assertIs(http_pool.get_session(self.url), http_pool.get_session(self.url + 'other'))
+
+
+def signed(**payload):
+    return {'Authorization': 'Bearer {}'.format(jwt.encode(payload, 'secret').decode('ascii'))}
+
+
+@override_settings(JWT_CACHE_TTL=60, JWT_CACHE_MARGIN=30)
+@mock.patch('vng.utils.auth.time.time', return_value=1000)
+@mock.patch('vng.utils.auth.ClientAuth.credentials')
+class TestJwtCache(WebTest):
+
+    def setUp(self):
+        clear_jwt_cache()
+        self.addCleanup(clear_jwt_cache)
+
+    def test_reused(self, mock_credentials, mock_time):
+        mock_credentials.side_effect = lambda: signed(iat=1000)
+        first = CachedClientAuth('client', 'secret', scopes=['a']).credentials()
+        self.assertEqual(CachedClientAuth('client', 'secret', scopes=['a']).credentials(), first)
+        self.assertEqual(mock_credentials.call_count, 1)
+        # another secret or other claims are signed again
+        CachedClientAuth('client', 'other', scopes=['a']).credentials()
+        CachedClientAuth('client', 'secret', scopes=['b']).credentials()
+        self.assertEqual(mock_credentials.call_count, 3)
+
+    def test_expiry_margin(self, mock_credentials, mock_time):
+        mock_credentials.side_effect = lambda: signed(iat=1000)
+        auth = CachedClientAuth('client', 'secret')
+        auth.credentials()
+        mock_time.return_value = 1029
+        auth.credentials()
+        self.assertEqual(mock_credentials.call_count, 1)
+        # renewed JWT_CACHE_MARGIN before the end of the lifetime
+        mock_time.return_value = 1030
+        auth.credentials()
+        self.assertEqual(mock_credentials.call_count, 2)
+
+    def test_explicit_expiration(self, mock_credentials, mock_time):
+        mock_credentials.side_effect = lambda: signed(iat=1000, exp=1300)
+        auth = CachedClientAuth('client', 'secret')
+        auth.credentials()
+        mock_time.return_value = 1269
+        auth.credentials()
+        self.assertEqual(mock_credentials.call_count, 1)
+
+    def test_stats(self, mock_credentials, mock_time):
+        mock_credentials.side_effect = lambda: signed(iat=1000)
+        for i in range(3):
+            CachedClientAuth('client', 'secret').credentials()
+        stats = jwt_cache_stats()
+        self.assertEqual((stats['hits'], stats['misses']), (2, 1))
+        self.assertAlmostEqual(stats['saved_time'], 2 * stats['signing_time'])
+
+    @override_settings(JWT_CACHE_SIZE=2)
+    def test_bounded(self, mock_credentials, mock_time):
+        mock_credentials.side_effect = lambda: signed(iat=1000)
+        CachedClientAuth('first', 'secret').credentials()
+        CachedClientAuth('second', 'secret').credentials()
+        CachedClientAuth('first', 'secret').credentials()
+        # the least recently used credentials are dropped
+        CachedClientAuth('third', 'secret').credentials()
+        CachedClientAuth('first', 'secret').credentials()
+        self.assertEqual(mock_credentials.call_count, 3)
+        CachedClientAuth('second', 'secret').credentials()
+        self.assertEqual(mock_credentials.call_count, 4)
+
+    def test_expired_dropped(self, mock_credentials, mock_time):
+        mock_credentials.side_effect = lambda: signed(iat=1000)
+        CachedClientAuth('first', 'secret').credentials()
+        mock_time.return_value = 2000
+        mock_credentials.side_effect = lambda: signed(iat=2000)
+        CachedClientAuth('second', 'secret').credentials()
+        self.assertEqual(jwt_cache_stats()['misses'], 2)
+        self.assertEqual(list(auth._tokens), [CachedClientAuth('second', 'secret').cache_key])
+
+
+@mock.patch('vng.testsession.task.K8S')
+class TestWarmPool(WebTest):
+
+    def setUp(self):
+        self.session_type = SessionTypeFactory(warm_pool_size=2)
+        self.endpoint = VNGEndpointDockerFactory(session_type=self.session_type)
+
+    def add_environment(self, **kwargs):
+        kwargs.setdefault('status', choices.StatusChoices.running)
+        kwargs.setdefault('ready', timezone.now())
+        kwargs.setdefault('docker_url', '1.2.3.4')
+        return WarmEnvironment.objects.create(
+            session_type=self.session_type, name=WarmEnvironment.assign_name(), **kwargs
+        )
+
+    def test_refill(self, mock_k8s):
+        report = refill_warm_pools()
+        self.assertEqual(report[self.session_type.name]['started'], 2)
+        self.assertEqual(WarmEnvironment.objects.filter(status=choices.StatusChoices.starting).count(), 2)
+
+        report = refill_warm_pools()
+        self.assertEqual(report[self.session_type.name]['started'], 0)
+        self.assertEqual(report[self.session_type.name]['starting'], 2)
+        self.assertEqual(WarmEnvironment.objects.count(), 2)
+        mock_k8s.return_value.delete.assert_not_called()
+
+    def test_evict(self, mock_k8s):
+        idle = self.add_environment(ready=timezone.now() - timedelta(days=2))
+        failed = self.add_environment(status=choices.StatusChoices.error_deploy)
+        self.add_environment()
+        self.session_type.warm_pool_size = 1
+        self.session_type.save()
+
+        report = refill_warm_pools()
+        self.assertEqual(report[self.session_type.name], {
+            'size': 1, 'ready': 1, 'starting': 0, 'started': 0, 'evicted': 1, 'failed': 1
+        })
+        self.assertEqual(WarmEnvironment.objects.get(pk=idle.pk).status, choices.StatusChoices.stopped)
+        self.assertEqual(WarmEnvironment.objects.get(pk=failed.pk).status, choices.StatusChoices.stopped)
+        self.assertEqual(
+            sorted(c[1]['app_name'] for c in mock_k8s.call_args_list), sorted([idle.name, failed.name])
+        )
+
+    @mock.patch('vng.testsession.task.refill_warm_pools')
+    def test_claim(self, mock_refill, mock_k8s):
+        environment = self.add_environment()
+        session = SessionFactory(session_type=self.session_type)
+        bootstrap_session(session.pk)
+
+        session = Session.objects.get(pk=session.pk)
+        self.assertEqual(session.status, choices.StatusChoices.running)
+        self.assertEqual(session.deploy_percentage, 100)
+        self.assertEqual(session.exposedurl_set.get().docker_url, '1.2.3.4')
+        environment = WarmEnvironment.objects.get(pk=environment.pk)
+        self.assertEqual(environment.session, session)
+        self.assertIsNotNone(environment.claimed)
+        mock_refill.delay.assert_called_once_with()
+        mock_k8s.assert_not_called()
+
+        # the next session does not get the claimed environment
+        self.assertFalse(claim_environment(SessionFactory(session_type=self.session_type)))
+
+    def test_no_pool(self, mock_k8s):
+        self.session_type.warm_pool_size = 0
+        self.session_type.save()
+        self.add_environment()
+        self.assertFalse(claim_environment(SessionFactory(session_type=self.session_type)))
+
+    @mock.patch('vng.testsession.task.purge_sessions')
+    @mock.patch('vng.testsession.task.Manifest')
+    def test_provision_without_purge(self, mock_manifest, mock_purge, mock_k8s):
+        mock_k8s.return_value.wait_pod_running.side_effect = DeadlineExceeded('no resources')
+        environment = self.add_environment(status=choices.StatusChoices.starting, ready=None)
+        provision_environment(environment.pk)
+
+        # the sessions of the users are left running
+        mock_purge.assert_not_called()
+        self.assertEqual(WarmEnvironment.objects.get(pk=environment.pk).status, choices.StatusChoices.error_deploy)
+
+    @mock.patch('vng.testsession.task.Manifest')
+    def test_evicted_while_starting(self, mock_manifest, mock_k8s):
+        environment = self.add_environment(status=choices.StatusChoices.starting, ready=None)
+        # the pool removes the environment during its deployment
+        mock_manifest.return_value.apply.side_effect = lambda: WarmEnvironment.objects.filter(
+            pk=environment.pk
+        ).update(status=choices.StatusChoices.stopped)
+        provision_environment(environment.pk)
+
+        environment = WarmEnvironment.objects.get(pk=environment.pk)
+        self.assertEqual(environment.status, choices.StatusChoices.stopped)
+        self.assertIsNone(environment.docker_url)
+        mock_k8s.return_value.delete.assert_called_once_with()
+
+
+@mock.patch('vng.testsession.task.delete_session_objects')
+@mock.patch('vng.testsession.task.get_client')
+class TestReconcile(WebTest):
+
+    def setUp(self):
+        self.session_type = SessionTypeFactory()
+        VNGEndpointDockerFactory(session_type=self.session_type)
+        patcher = mock.patch('vng.testsession.task.label_legacy_objects')
+        self.mock_label = patcher.start()
+        self.addCleanup(patcher.stop)
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+    def add_session(self, status=choices.StatusChoices.running, docker=True):
+        session = SessionFactory(session_type=self.session_type if docker else SessionTypeFactory(), status=status)
+        ExposedUrlFactory(session=session, vng_endpoint=session.session_type.vngendpoint_set.first() or VNGEndpointFactory())
+        return session
+
+    def cluster(self, mock_client, **objects):
+        def list_objects(api_version, kind, label_selector=None):
+            return [
+                {'metadata': {'name': '{}-{}'.format(name, kind.lower()), 'labels': {'session': name}}}
+                for name in objects.get(kind, [])
+            ]
+
+        mock_client.return_value.list.side_effect = list_objects
+
+    def test_reconcile(self, mock_client, mock_delete):
+        running = self.add_session()
+        orphaned = self.add_session()
+        proxied = self.add_session(docker=False)
+        stopped = self.add_session(status=choices.StatusChoices.stopped)
+        self.cluster(
+            mock_client,
+            Deployment=[running.name, stopped.name, 'ghost'],
+            Service=[running.name, stopped.name],
+            ConfigMap=[running.name, orphaned.name, stopped.name],
+        )
+
+        report = reconcile_sessions()
+        self.assertEqual(report, {
+            'sessions': 1,
+            'environments': 0,
+            'deployments': sorted(['{}-deployment'.format(stopped.name), 'ghost-deployment']),
+            'services': ['{}-service'.format(stopped.name)],
+            'configmaps': sorted(['{}-configmap'.format(orphaned.name), '{}-configmap'.format(stopped.name)]),
+        })
+        self.assertEqual(Session.objects.get(pk=running.pk).status, choices.StatusChoices.running)
+        self.assertEqual(Session.objects.get(pk=orphaned.pk).status, choices.StatusChoices.stopped)
+        self.assertEqual(Session.objects.get(pk=proxied.pk).status, choices.StatusChoices.running)
+        self.assertEqual(mock_client.return_value.list.call_count, 3)
+        names, services = mock_delete.call_args[0]
+        self.assertEqual(names, {orphaned.name, stopped.name, 'ghost'})
+        self.assertEqual([item['metadata']['name'] for item in services], ['{}-service'.format(stopped.name)])
+
+    def test_shutting_down_kept(self, mock_client, mock_delete):
+        shutting_down = self.add_session(status=choices.StatusChoices.shutting_down)
+        self.cluster(
+            mock_client,
+            Deployment=[shutting_down.name], Service=[shutting_down.name], ConfigMap=[shutting_down.name]
+        )
+
+        report = reconcile_sessions()
+        self.assertEqual((report['deployments'], report['services'], report['configmaps']), ([], [], []))
+        names, services = mock_delete.call_args[0]
+        self.assertEqual((names, services), (set(), []))
+        self.assertEqual(Session.objects.get(pk=shutting_down.pk).status, choices.StatusChoices.shutting_down)
+
+    def test_legacy_objects_labelled(self, mock_client, mock_delete):
+        running = self.add_session()
+        starting = self.add_session(status=choices.StatusChoices.starting)
+        self.add_session(status=choices.StatusChoices.stopped)
+        self.cluster(mock_client)
+        reconcile_sessions()
+        self.assertEqual(sorted(self.mock_label.call_args[0][0]), sorted([running.name, starting.name]))
+
+    def test_legacy_objects_labelled_once(self, mock_client, mock_delete):
+        self.cluster(mock_client)
+        self.mock_label.return_value = ['legacy']
+        reconcile_sessions()
+        # nothing left to label
+        self.mock_label.return_value = []
+        reconcile_sessions()
+        reconcile_sessions()
+        self.assertEqual(self.mock_label.call_count, 2)
+
+    def test_warm_environment(self, mock_client, mock_delete):
+        environment = WarmEnvironment.objects.create(
+            session_type=self.session_type, name=WarmEnvironment.assign_name(), status=choices.StatusChoices.running
+        )
+        claimed = self.add_session()
+        environment.session = claimed
+        environment.save()
+        idle = WarmEnvironment.objects.create(
+            session_type=self.session_type, name=WarmEnvironment.assign_name(), status=choices.StatusChoices.running
+        )
+        self.cluster(mock_client, Deployment=[environment.name], Service=[environment.name])
+
+        report = reconcile_sessions()
+        self.assertEqual(report['sessions'], 0)
+        self.assertEqual(report['environments'], 1)
+        self.assertEqual(report['deployments'], [])
+        self.assertEqual(Session.objects.get(pk=claimed.pk).status, choices.StatusChoices.running)
+        self.assertEqual(WarmEnvironment.objects.get(pk=idle.pk).status, choices.StatusChoices.stopped)
+
+    def test_routes_invalidated(self, mock_client, mock_delete):
+        session = self.add_session()
+        subdomain = session.exposedurl_set.get().subdomain
+        self.assertFalse(get_routing(subdomain).session.is_stopped())
+
+        align_sessions_data(set())
+        # the proxy no longer routes to the stopped session
+        self.assertTrue(get_routing(subdomain).session.is_stopped())
@@ -9,7 +9,7 @@ from django.views.generic.edit import FormView, UpdateView
 from django.views.generic.detail import DetailView
 from django.views.generic import TemplateView
 from django.views.generic.list import ListView
-from django.db.models import Q
+from django.db.models import Count, Q
 from django.shortcuts import get_object_or_404
 from django.urls import reverse, reverse_lazy
 from django.utils import timezone
@@ -23,6 +23,7 @@ from .models import (
     TestSession, Report, SessionType
 )
 
+from .results import SessionResult
 from .task import bootstrap_session, stop_session
 from .forms import SessionForm
 from ..utils import choices
@@ -46,7 +47,17 @@ class SessionListView(LoginRequiredMixin, ListView):
         context.update({
             'choices': _choices,
         })
-        sessions_related = [(session, *session.get_report_stats()) for session in context['object_list']]
+        case_counts = dict(
+            ScenarioCase.objects
+            .filter(vng_endpoint__session_type__in={s.session_type_id for s in context['object_list']})
+            .order_by()
+            .values_list('vng_endpoint__session_type')
+            .annotate(Count('id'))
+        )
+        sessions_related = [
+            (session, *session.get_report_stats(case_counts.get(session.session_type_id, 0)))
+            for session in context['object_list']
+        ]
         context['object_list'] = sessions_related
         return context
 
@@ -196,7 +207,7 @@ class StopSession(OwnerSingleObject, View):
             return HttpResponseRedirect(reverse('testsession:sessions'))
 
         session.status = choices.StatusChoices.shutting_down
-        session.save()
+        session.save(update_fields=['status'])
         stop_session.delay(session.pk)
         return HttpResponseRedirect(reverse('testsession:sessions'))
 
@@ -212,18 +223,7 @@ class SessionReport(DetailView):
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        scenario_case = self.model.objects.filter(vng_endpoint__session_type=self.session.session_type)
-        report = list(Report.objects.filter(session_log__session=self.session))
-        report_ordered = []
-        for case in scenario_case:
-            is_in = False
-            for rp in report:
-                if rp.scenario_case == case:
-                    report_ordered.append(rp)
-                    is_in = True
-                    break
-            if not is_in:
-                report_ordered.append(Report(scenario_case=case, result=choices.HTTPCallChoices.not_called))
+        report_ordered = SessionResult(self.session).ordered_reports()
 
         context.update({
             'session': self.session,
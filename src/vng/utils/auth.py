@@ -0,0 +1,107 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+
+import jwt
+from zds_client import ClientAuth
+
+from django.conf import settings
+
+SCOPES = [
+    'zds.scopes.zaken.lezen',
+    'zds.scopes.zaaktypes.lezen',
+    'zds.scopes.zaken.aanmaken',
+    'zds.scopes.statussen.toevoegen',
+    'zds.scopes.zaken.bijwerken'
+]
+
+_lock = threading.Lock()
+# cache key -> (expiration, credentials), least recently used first
+_tokens = OrderedDict()
+_stats = {'hits': 0, 'misses': 0, 'signing_time': 0.0}
+
+
+class CachedClientAuth(ClientAuth):
+    '''
+    ClientAuth reusing the signed credentials of the same client_id, secret
+    and claims until shortly before they expire.
+    The tokens carry only the issue time (iat), their lifetime is JWT_CACHE_TTL
+    unless they define an explicit expiration (exp).
+    The cache of a process holds at most JWT_CACHE_SIZE credentials, the expired
+    ones are dropped when new credentials are added.
+    '''
+
+    def __init__(self, client_id, secret, **claims):
+        super().__init__(client_id=client_id, secret=secret, **claims)
+        self.cache_key = (client_id, secret, json.dumps(claims, sort_keys=True))
+
+    def get_expiration(self, credentials, issued):
+        token = list(credentials.values())[0].split()[-1]
+        try:
+            payload = jwt.decode(token, verify=False)
+        except jwt.InvalidTokenError:
+            return issued
+        expiration = payload.get('exp', payload.get('iat', issued) + settings.JWT_CACHE_TTL)
+        return expiration - settings.JWT_CACHE_MARGIN
+
+    def credentials(self):
+        now = time.time()
+        with _lock:
+            cached = _tokens.get(self.cache_key)
+            if cached is not None and cached[0] > now:
+                _stats['hits'] += 1
+                _tokens.move_to_end(self.cache_key)
+                return dict(cached[1])
+        start = time.perf_counter()
+        credentials = super().credentials()
+        elapsed = time.perf_counter() - start
+        with _lock:
+            _stats['misses'] += 1
+            _stats['signing_time'] += elapsed
+            _tokens[self.cache_key] = (self.get_expiration(credentials, now), credentials)
+            _tokens.move_to_end(self.cache_key)
+            evict_tokens(now)
+        return dict(credentials)
+
+
+def evict_tokens(now):
+    '''
+    Drop the expired credentials, then the least recently used ones above
+    JWT_CACHE_SIZE. Called with the lock held.
+    '''
+    for key in [key for key, (expiration, credentials) in _tokens.items() if expiration <= now]:
+        del _tokens[key]
+    while len(_tokens) > settings.JWT_CACHE_SIZE:
+        _tokens.popitem(last=False)
+
+
+def get_jwt(obj):
+    '''
+    Return the JWT authentication of an object with a client_id and a secret
+    (e.g. SessionType, ServerRun)
+    '''
+    return CachedClientAuth(
+        client_id=obj.client_id,
+        secret=obj.secret,
+        scopes=SCOPES,
+        zaaktypes=['*']
+    )
+
+
+def jwt_cache_stats():
+    '''
+    Return the counters of the credentials cache of the current process.
+    `saved_time` estimates the signing time avoided by the cache hits, in seconds.
+    '''
+    with _lock:
+        stats = dict(_stats)
+    average = stats['signing_time'] / stats['misses'] if stats['misses'] else 0
+    stats['saved_time'] = stats['hits'] * average
+    return stats
+
+
+def clear_jwt_cache():
+    with _lock:
+        _tokens.clear()
+        _stats.update(hits=0, misses=0, signing_time=0.0)
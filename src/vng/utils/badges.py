@@ -0,0 +1,61 @@
+import hashlib
+import json
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date
+
+
+def badge_key(kind, uuid):
+    return 'vng:badge:{}:{}'.format(kind, uuid)
+
+
+def get_badge(kind, uuid, builder):
+    '''
+    Return the cached badge of the object with the given uuid, built by
+    `builder` (returning the payload of the badge) when missing.
+    '''
+    key = badge_key(kind, uuid)
+    badge = cache.get(key)
+    if badge is None:
+        content = json.dumps(builder(), sort_keys=True)
+        badge = {
+            'content': content,
+            'etag': '"{}"'.format(hashlib.sha1(content.encode('utf-8')).hexdigest()),
+            'last_modified': int(time.time()),
+        }
+        cache.set(key, badge, settings.BADGE_CACHE_TIMEOUT)
+    return badge
+
+
+def invalidate_badges(kind, uuids):
+    '''
+    Drop the cached badges. Inside a transaction they are dropped again once
+    it is committed, as a badge built meanwhile shows the previous results.
+    '''
+    keys = [badge_key(kind, uuid) for uuid in uuids]
+    if not keys:
+        return
+    cache.delete_many(keys)
+    if connection.in_atomic_block:
+        transaction.on_commit(lambda: cache.delete_many(keys))
+
+
+def badge_response(request, kind, uuid, builder):
+    '''
+    Serve the badge with its ETag and Last-Modified headers, answering the
+    conditional requests of an unchanged badge with a 304.
+    The clients have to revalidate the badge at each request.
+    '''
+    badge = get_badge(kind, uuid, builder)
+    response = get_conditional_response(request, etag=badge['etag'], last_modified=badge['last_modified'])
+    if response is None:
+        response = HttpResponse(badge['content'], content_type='application/json')
+    response['ETag'] = badge['etag']
+    response['Last-Modified'] = http_date(badge['last_modified'])
+    patch_cache_control(response, no_cache=True)
+    return response
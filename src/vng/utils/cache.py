@@ -0,0 +1,60 @@
+import threading
+import uuid
+
+from django.core.cache import cache
+
+
+class VersionedLocalCache:
+    '''
+    Per-process cache of objects that are expensive to build (e.g. compiled
+    regexes). Every entry is validated against a version token kept in the
+    shared Django cache, so an invalidation performed by any process (web
+    worker or celery worker) is picked up by all the others.
+    When the shared cache is unavailable the value is rebuilt on each access.
+    '''
+
+    def __init__(self, prefix, max_entries=1000):
+        self.prefix = prefix
+        self.max_entries = max_entries
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def _version_key(self, key):
+        return 'vng:{}:{}'.format(self.prefix, key)
+
+    def get_version(self, key):
+        version_key = self._version_key(key)
+        version = cache.get(version_key)
+        if version is None:
+            cache.add(version_key, uuid.uuid4().hex, None)
+            version = cache.get(version_key)
+        return version
+
+    def get(self, key, builder):
+        version = self.get_version(key)
+        entry = self._entries.get(key)
+        if version is not None and entry is not None and entry[0] == version:
+            return entry[1]
+        value = builder()
+        if version is not None:
+            with self._lock:
+                if len(self._entries) >= self.max_entries:
+                    self._entries.clear()
+                self._entries[key] = (version, value)
+        return value
+
+    def invalidate(self, key):
+        self.invalidate_many([key])
+
+    def invalidate_many(self, keys):
+        keys = list(keys)
+        if not keys:
+            return
+        cache.set_many({self._version_key(key): uuid.uuid4().hex for key in keys}, None)
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,126 @@
+import logging
+import os
+import threading
+from collections import defaultdict
+from http.cookiejar import DefaultCookiePolicy
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_local = threading.local()
+_sessions = {}
+_stats = defaultdict(lambda: {'hits': 0, 'misses': 0, 'waits': 0})
+_pid = None
+
+
+def _incr(host, counter):
+    with _lock:
+        _stats[host][counter] += 1
+
+
+class CountingPoolMixin:
+    '''
+    Keep track of the connections reused from the pool (hits), the new
+    connections opened (misses) and the times a caller had to wait for
+    a free connection (waits).
+    '''
+
+    def _new_conn(self):
+        _local.new_conn = True
+        return super()._new_conn()
+
+    def _get_conn(self, timeout=None):
+        host = '{}:{}'.format(self.host, self.port)
+        if self.block and self.pool is not None and self.pool.empty():
+            _incr(host, 'waits')
+        _local.new_conn = False
+        conn = super()._get_conn(timeout=timeout)
+        _incr(host, 'misses' if _local.new_conn else 'hits')
+        return conn
+
+
+class CountingHTTPConnectionPool(CountingPoolMixin, HTTPConnectionPool):
+    pass
+
+
+class CountingHTTPSConnectionPool(CountingPoolMixin, HTTPSConnectionPool):
+    pass
+
+
+class CountingHTTPAdapter(HTTPAdapter):
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': CountingHTTPConnectionPool,
+            'https': CountingHTTPSConnectionPool,
+        }
+
+
+def _build_session():
+    session = requests.Session()
+    # the session is shared by the calls of all the users to the host, the
+    # cookies set by the upstream are not stored and replayed on other calls
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    adapter = CountingHTTPAdapter(
+        pool_connections=settings.PROXY_POOL_CONNECTIONS,
+        pool_maxsize=settings.PROXY_POOL_MAXSIZE,
+        pool_block=settings.PROXY_POOL_BLOCK,
+    )
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers['Connection'] = 'keep-alive'
+    return session
+
+
+def get_session(url):
+    '''
+    Return the pooled session of the host of the given url.
+    The sessions are created once per process (the pool is rebuilt after a fork)
+    and per upstream host, so that the connections are kept alive between calls.
+    '''
+    global _pid
+    parsed = urlparse(url)
+    key = '{}://{}'.format(parsed.scheme, parsed.netloc)
+    with _lock:
+        if _pid != os.getpid():
+            _sessions.clear()
+            _stats.clear()
+            _pid = os.getpid()
+        session = _sessions.get(key)
+        if session is None:
+            logger.info('Creating the connection pool for %s', key)
+            session = _sessions[key] = _build_session()
+    return session
+
+
+def get_timeout():
+    return (settings.PROXY_CONNECT_TIMEOUT, settings.PROXY_READ_TIMEOUT)
+
+
+def request(method, url, **kwargs):
+    kwargs.setdefault('timeout', get_timeout())
+    return get_session(url).request(method, url, **kwargs)
+
+
+def pool_stats():
+    '''
+    Return a copy of the pool counters of the current process, grouped by host
+    '''
+    with _lock:
+        return {host: dict(counters) for host, counters in _stats.items()}
+
+
+def reset_pools():
+    with _lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+        _stats.clear()
@@ -1,37 +1,138 @@
+import json
 import logging
 import os
+import subprocess
+import threading
 import uuid
+from collections import OrderedDict
+from concurrent.futures import Future, TimeoutError
 from urllib.parse import urlparse
 
 from django.conf import settings
 
-from ..utils.commands import run_command_with_shell
-
 logger = logging.getLogger(__name__)
 
+TIMEOUT_REQUEST = 10000
+
+_runner = None
+_lock = threading.Lock()
+
 
 class DidNotRunException(Exception):
     pass
 
 
+class NewmanRunner:
+    '''
+    Long-lived Node process running the collections with the newman library
+    (bin/newman_runner.js), so the runs do not pay the start of Node.
+    A run is sent as a JSON line on its stdin, its outcome comes back as a
+    JSON line on its stdout. The runs of several threads share the process,
+    `pending` is only changed with `lock` held.
+    A run timing out is not stopped, the process keeps the other runs: it goes
+    on in Node (its requests are limited by TIMEOUT_REQUEST) and its outcome
+    is ignored.
+    '''
+
+    def __init__(self):
+        self.process = None
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def start(self):
+        self.process = subprocess.Popen(
+            [settings.NEWMAN_NODE, settings.NEWMAN_RUNNER_SCRIPT],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, cwd=settings.BASE_DIR
+        )
+        threading.Thread(target=self.read, args=(self.process,), daemon=True).start()
+
+    def read(self, process):
+        for line in process.stdout:
+            try:
+                outcome = json.loads(line.decode('utf-8'))
+                with self.lock:
+                    future = self.pending.pop(outcome['id'])
+            except (ValueError, KeyError, TypeError):
+                # written by a collection or a reporter, or the outcome of a timed out run
+                logger.debug('Newman runner: %s', line)
+                continue
+            if outcome.get('error'):
+                future.set_exception(DidNotRunException(outcome['error']))
+            else:
+                future.set_result(None)
+        # the process ended, its runs will not complete
+        with self.lock:
+            if self.process is process:
+                self.process = None
+            pending = [id for id, future in self.pending.items() if future.process is process]
+            for id in pending:
+                self.pending.pop(id).set_exception(DidNotRunException('The newman runner stopped'))
+
+    def run(self, collection, global_vars, html, json_export):
+        '''
+        Run the collection, its reports are written at the `html` and `json_export` paths
+        '''
+        future = Future()
+        run = {
+            'id': uuid.uuid4().hex,
+            'collection': collection,
+            'globals': global_vars,
+            'html': html,
+            'json': json_export,
+            'timeoutRequest': TIMEOUT_REQUEST,
+        }
+        with self.lock:
+            if self.process is None or self.process.poll() is not None:
+                self.start()
+            future.process = self.process
+            self.pending[run['id']] = future
+            try:
+                self.process.stdin.write(json.dumps(run).encode('utf-8') + b'\n')
+                self.process.stdin.flush()
+            except OSError as e:
+                self.pending.pop(run['id'], None)
+                raise DidNotRunException(e)
+        try:
+            return future.result(settings.NEWMAN_RUN_TIMEOUT)
+        except TimeoutError:
+            with self.lock:
+                self.pending.pop(run['id'], None)
+            raise DidNotRunException('The run of {} did not complete'.format(collection))
+
+    def stop(self):
+        with self.lock:
+            if self.process is not None:
+                self.process.stdin.close()
+                self.process.wait()
+
+
+def get_runner():
+    '''
+    Return the runner of the current process, the forked workers start their own
+    '''
+    global _runner
+    with _lock:
+        if _runner is None or _runner.pid != os.getpid():
+            _runner = NewmanRunner()
+            _runner.pid = os.getpid()
+        return _runner
+
+
 class NewmanManager:
     REPORT_FOLDER = settings.MEDIA_ROOT + '/newman'
     newman_path = os.path.join(settings.BASE_DIR, 'node_modules', 'newman', 'bin', 'newman.js')
-    RUN_HTML_REPORT = ('{} run --reporters html {} -r htmlextra '
-                       '--timeout-request 10000 '
-                       '--reporter-htmlextra-darkTheme '
-                       '--reporter-htmlextra-testPaging '
-                       '--reporter-htmlextra-title '
-                       '--reporter-htmlextra-logs '
-                       '--reporter-htmlextra-export ' + REPORT_FOLDER + '/{}.html {}')
-    RUN_JSON_REPORT = '{} run  {} -r json --reporter-json-export ' + REPORT_FOLDER + '/{}.json {} --timeout-request 10000 '
-    GLOBAL_VAR_SYNTAX = ' --global-var {}={} '
+    HTML_REPORTER = [
+        '--reporter-htmlextra-darkTheme',
+        '--reporter-htmlextra-testPaging',
+        '--reporter-htmlextra-title',
+        '--reporter-htmlextra-logs',
+    ]
     TOKEN = 'TOKEN'
 
     def __init__(self, file, api_endpoint=None):
         self.file = file
         self.file_to_be_discarted = []
-        self.global_vars = ''
+        self.global_vars = OrderedDict()
         self.api_endpoint = api_endpoint
         if not os.path.exists(self.REPORT_FOLDER):
             os.makedirs(self.REPORT_FOLDER)
@@ -42,33 +143,66 @@ class NewmanManager:
             logger.debug('Deleteing file {}'.format(full_path))
             os.remove(full_path)
 
-    def run_command(self, command, *args):
-        command = command.format(*args, self.global_vars)
-        return run_command_with_shell(command)
+    def report_path(self, filename, extension):
+        return '{}/{}.{}'.format(self.REPORT_FOLDER, filename, extension)
+
+    def run_command(self, *args):
+        '''
+        Run newman with the arguments and the global variables, without a
+        shell so the values do not have to be quoted
+        '''
+        command = [self.newman_path, 'run', self.file_path, '--timeout-request', str(TIMEOUT_REQUEST), *args]
+        for k, v in self.global_vars.items():
+            command += ['--global-var', '{}={}'.format(k, v)]
+        subp = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        return subp.communicate()
 
     def replace_parameters(self, _dict):
-        for k, v in _dict.items():
-            self.global_vars += self.GLOBAL_VAR_SYNTAX.format(k, v)
+        self.global_vars.update(_dict)
+
+    def open_reports(self, filename, *extensions):
+        reports = []
+        for extension in extensions:
+            f = open(self.report_path(filename, extension))
+            self.file_to_be_discarted.append(f)
+            reports.append(f)
+        return reports
 
     def execute_test(self):
         self.file_path = self.file.path
         filename = str(uuid.uuid4())
-        output, error = self.run_command(self.RUN_HTML_REPORT, self.newman_path, self.file_path, filename)
+        output, error = self.run_command(
+            '-r', 'htmlextra', *self.HTML_REPORTER, '--reporter-htmlextra-export', self.report_path(filename, 'html')
+        )
         if error:
-            assert False, error
             logger.exception(error)
-            raise DidNotRunException()
-        f = open('{}/{}.html'.format(self.REPORT_FOLDER, filename))
-        self.file_to_be_discarted.append(f)
-        return f
+            raise DidNotRunException(error)
+        return self.open_reports(filename, 'html')[0]
 
     def execute_test_json(self):
         self.file_path = self.file.path
         filename = str(uuid.uuid4())
-        output, error = self.run_command(self.RUN_JSON_REPORT, self.newman_path, self.file_path, filename)
+        output, error = self.run_command('-r', 'json', '--reporter-json-export', self.report_path(filename, 'json'))
         if error:
             logger.exception(error)
             raise DidNotRunException(error)
-        f = open('{}/{}.json'.format(self.REPORT_FOLDER, filename))
-        self.file_to_be_discarted.append(f)
-        return f
+        return self.open_reports(filename, 'json')[0]
+
+    def execute_reports(self):
+        '''
+        Run the collection once with both reporters, return the HTML and the JSON reports
+        '''
+        self.file_path = self.file.path
+        filename = str(uuid.uuid4())
+        html_path, json_path = self.report_path(filename, 'html'), self.report_path(filename, 'json')
+        if settings.NEWMAN_PERSISTENT_RUNNER:
+            get_runner().run(self.file_path, self.global_vars, html_path, json_path)
+        else:
+            output, error = self.run_command(
+                '-r', 'htmlextra,json', *self.HTML_REPORTER,
+                '--reporter-htmlextra-export', html_path, '--reporter-json-export', json_path
+            )
+            if error:
+                logger.exception(error)
+                raise DidNotRunException(error)
+        return self.open_reports(filename, 'html', 'json')